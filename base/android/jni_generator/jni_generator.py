@@ -7,12 +7,17 @@
 If you change this, please run and update the tests."""
 
 import collections
+import cPickle
 import errno
+import fnmatch
+import hashlib
+import multiprocessing
 import optparse
 import os
 import re
+import string
 from string import Template
-import subprocess
+import struct
 import sys
 import textwrap
 import zipfile
@@ -20,23 +25,29 @@ import zipfile
 from build.android.gyp.util import build_utils
 
 
-# Match single line comments, multiline comments, character literals, and
-# double-quoted strings.
-_COMMENT_REMOVER_REGEX = re.compile(
-    r'//.*?$|/\*.*?\*/|\'(?:\\.|[^\\\'])*\'|"(?:\\.|[^\\"])*"',
-    re.DOTALL | re.MULTILINE)
+# Tokens of java source code: string and character literals, words
+# (identifiers, keywords and numbers) and single character symbols, each
+# preceded by the whitespace and comments separating it from the previous one.
+_JAVA_TOKEN_REGEX = re.compile(
+    r'((?:\s|//[^\n]*|/\*.*?\*/)*)'
+    r'(\'(?:\\.|[^\\\'\n])*\'|"(?:\\.|[^\\"\n])*"|[\w$]+|\S)',
+    re.DOTALL)
 
-_EXTRACT_NATIVES_REGEX = re.compile(
-    r'(@NativeClassQualifiedName'
-    r'\(\"(?P<native_class_name>.*?)\"\)\s+)?'
-    r'(@NativeCall(\(\"(?P<java_class_name>.*?)\"\))\s+)?'
-    r'(?P<qualifiers>\w+\s\w+|\w+|\s+)\s*native '
-    r'(?P<return_type>\S*) '
-    r'(?P<name>native\w+)\((?P<params>.*?)\);')
+_JAVA_WORD_CHARS = frozenset(string.ascii_letters + string.digits + '_$')
 
-_MAIN_DEX_REGEX = re.compile(
-    r'^\s*(?:@(?:\w+\.)*\w+\s+)*@MainDex\b',
-    re.MULTILINE)
+# The tokens JavaSourceScan looks at, all others are only collected.
+_JAVA_SCANNED_TOKENS = frozenset([
+    ';', '{', '}', '(', '@', 'package', 'import', 'native', 'class',
+    'interface', 'enum'])
+
+# A type in a method declaration, once spaces are removed.
+_JAVA_TYPE_REGEX = re.compile(r'[\w$]+(?:\.[\w$]+)*(?:<.*>)?(?:\[\])*$')
+
+_JAVA_MODIFIERS = frozenset([
+    'abstract', 'default', 'final', 'native', 'private', 'protected', 'public',
+    'static', 'strictfp', 'synchronized', 'transient', 'volatile'])
+
+_CALLED_BY_NATIVE_ANNOTATIONS = ('CalledByNative', 'CalledByNativeUnchecked')
 
 # Use 100 columns rather than 80 because it makes many lines more readable.
 _WRAP_LINE_LENGTH = 100
@@ -47,13 +58,18 @@ _WRAPPERS_BY_INDENT = [
                          subsequent_indent=' ' * (indent + 4),
                          break_long_words=False)
     for indent in range(50)]  # 50 chosen experimentally.
+# Without hyphenated words, the TextWrappers split lines at whitespace only.
+_HYPHENATED_WORD_REGEX = re.compile(r'-\w')
+_WHITESPACE_REGEX = re.compile(r'(\s+)')
 
 
 class ParseError(Exception):
   """Exception thrown when we can't parse the input file."""
 
   def __init__(self, description, *context_lines):
-    Exception.__init__(self)
+    # Passes the arguments on, so that the exception can be unpickled, as
+    # when raised in a multiprocessing worker.
+    Exception.__init__(self, description, *context_lines)
     self.description = description
     self.context_lines = context_lines
 
@@ -156,7 +172,7 @@ def JavaDataTypeToC(java_type):
 
 def WrapCTypeForDeclaration(c_type):
   """Wrap the C datatype in a JavaRef if required."""
-  if re.match(RE_SCOPED_JNI_TYPES, c_type):
+  if RE_SCOPED_JNI_TYPES.match(c_type):
     return 'const base::android::JavaParamRef<' + c_type + '>&'
   else:
     return c_type
@@ -173,7 +189,7 @@ def JavaDataTypeToCForCalledByNativeParam(java_type):
     return 'JniIntWrapper'
   else:
     c_type = JavaDataTypeToC(java_type)
-    if re.match(RE_SCOPED_JNI_TYPES, c_type):
+    if RE_SCOPED_JNI_TYPES.match(c_type):
       return 'const base::android::JavaRef<' + c_type + '>&'
     else:
       return c_type
@@ -238,6 +254,8 @@ def GetParamsInStub(native):
 
 def _StripGenerics(value):
   """Strips Java generics from a string."""
+  if '<' not in value:
+    return value
   nest_level = 0  # How deeply we are nested inside the generics.
   start_index = 0  # Starting index of the last non-generic region.
   out = []
@@ -265,24 +283,27 @@ class JniParams(object):
     self._inner_classes = []
     self._implicit_imports = []
 
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    # Lazily loaded from android_jar.classes; not worth storing.
+    state['_implicit_imports'] = []
+    return state
+
   def ExtractImportsAndInnerClasses(self, contents):
-    contents = contents.replace('\n', '')
-    re_import = re.compile(r'import.*?(?P<class>\S*?);')
-    for match in re.finditer(re_import, contents):
-      self._imports += ['L' + match.group('class').replace('.', '/')]
-
-    re_inner = re.compile(r'(class|interface|enum)\s+?(?P<name>\w+?)\W')
-    for match in re.finditer(re_inner, contents):
-      inner = match.group('name')
+    java_source = ScanJavaSource(contents)
+    for name in java_source.imports:
+      self._imports += ['L' + name.replace('.', '/')]
+
+    for inner in java_source.type_names:
       if not self._fully_qualified_class.endswith(inner):
         self._inner_classes += [self._fully_qualified_class + '$' +
                                      inner]
 
-    re_additional_imports = re.compile(
-        r'@JNIAdditionalImport\(\s*{?(?P<class_names>.*?)}?\s*\)')
-    for match in re.finditer(re_additional_imports, contents):
-      for class_name in match.group('class_names').split(','):
-        self._AddAdditionalImport(class_name.strip())
+    for annotation in java_source.annotations:
+      if annotation.name == 'JNIAdditionalImport' and annotation.args:
+        class_names = annotation.args.lstrip('{').rstrip('}')
+        for class_name in class_names.split(','):
+          self._AddAdditionalImport(class_name.strip())
 
   def JavaToJni(self, param):
     """Converts a java param into a JNI signature type."""
@@ -438,34 +459,36 @@ class JniParams(object):
 
 
 def ExtractJNINamespace(contents):
-  re_jni_namespace = re.compile('.*?@JNINamespace\("(.*?)"\)')
-  m = re.findall(re_jni_namespace, contents)
-  if not m:
-    return ''
-  return m[0]
+  for annotation in ScanJavaSource(contents).annotations:
+    if annotation.name == 'JNINamespace':
+      return _GetStringArgument(annotation) or ''
+  return ''
 
 
 def ExtractFullyQualifiedJavaClassName(java_file_name, contents):
-  re_package = re.compile('.*?package (.*?);')
-  matches = re.findall(re_package, contents)
-  if not matches:
+  package = ScanJavaSource(contents).package
+  if not package:
     raise SyntaxError('Unable to find "package" line in %s' % java_file_name)
-  return (matches[0].replace('.', '/') + '/' +
+  return (package.replace('.', '/') + '/' +
           os.path.splitext(os.path.basename(java_file_name))[0])
 
 
 def ExtractNatives(contents, ptr_type):
   """Returns a list of dict containing information about a native method."""
-  contents = contents.replace('\n', '')
   natives = []
-  for match in _EXTRACT_NATIVES_REGEX.finditer(contents):
+  for method in ScanJavaSource(contents).methods:
+    if ('native' not in method.modifiers or
+        not method.name.startswith('native') or method.name == 'native'):
+      continue
+    annotations = dict((a.name, a) for a in method.annotations)
     native = NativeMethod(
-        static='static' in match.group('qualifiers'),
-        java_class_name=match.group('java_class_name'),
-        native_class_name=match.group('native_class_name'),
-        return_type=match.group('return_type'),
-        name=match.group('name').replace('native', ''),
-        params=JniParams.Parse(match.group('params')),
+        static='static' in method.modifiers,
+        java_class_name=_GetStringArgument(annotations.get('NativeCall')),
+        native_class_name=_GetStringArgument(
+            annotations.get('NativeClassQualifiedName')),
+        return_type=method.return_type,
+        name=method.name.replace('native', ''),
+        params=JniParams.Parse(method.params),
         ptr_type=ptr_type)
     natives += [native]
   return natives
@@ -479,7 +502,8 @@ def IsMainDexJavaClass(contents):
   needed by non-browser processes must explicitly be annotated with @MainDex
   to force JNI registration.
   """
-  return bool(_MAIN_DEX_REGEX.search(contents))
+  return any(annotation.name == 'MainDex'
+             for annotation in ScanJavaSource(contents).annotations)
 
 
 def GetBinaryClassName(fully_qualified_class):
@@ -599,23 +623,6 @@ def MangleCalledByNatives(jni_params, called_by_natives):
 RE_SCOPED_JNI_TYPES = re.compile('jobject|jclass|jstring|jthrowable|.*Array')
 
 
-# Regex to match a string like "@CalledByNative public void foo(int bar)".
-RE_CALLED_BY_NATIVE = re.compile(
-    r'@CalledByNative(?P<Unchecked>(?:Unchecked)?)(?:\("(?P<annotation>.*)"\))?'
-    r'(?:\s+@\w+(?:\(.*\))?)*'  # Ignore any other annotations.
-    r'\s+(?P<prefix>('
-    r'(private|protected|public|static|abstract|final|default|synchronized)'
-    r'\s*)*)'
-    r'(?:\s*@\w+)?'  # Ignore annotations in return types.
-    r'\s*(?P<return_type>\S*?)'
-    r'\s*(?P<name>\w+)'
-    r'\s*\((?P<params>[^\)]*)\)')
-
-# Removes empty lines that are indented (i.e. start with 2x spaces).
-def RemoveIndentedEmptyLines(string):
-  return re.sub('^(?: {2})+$\n', '', string, flags=re.MULTILINE)
-
-
 def ExtractCalledByNatives(jni_params, contents):
   """Parses all methods annotated with @CalledByNative.
 
@@ -630,10 +637,20 @@ def ExtractCalledByNatives(jni_params, contents):
   Raises:
     ParseError: if unable to parse.
   """
+  java_source = ScanJavaSource(contents)
+  # Check for any @CalledByNative occurrences that weren't matched.
+  if java_source.unparsed_called_by_natives:
+    raise ParseError('could not parse @CalledByNative method signature',
+                     *java_source.GetContextLines(
+                         java_source.unparsed_called_by_natives[0]))
   called_by_natives = []
-  for match in re.finditer(RE_CALLED_BY_NATIVE, contents):
-    return_type = match.group('return_type')
-    name = match.group('name')
+  for method in java_source.methods:
+    annotation = next((a for a in method.annotations
+                       if a.name in _CALLED_BY_NATIVE_ANNOTATIONS), None)
+    if not annotation:
+      continue
+    return_type = method.return_type
+    name = method.name
     if not return_type:
       is_constructor = True
       return_type = name
@@ -643,42 +660,221 @@ def ExtractCalledByNatives(jni_params, contents):
 
     called_by_natives += [CalledByNative(
         system_class=False,
-        unchecked='Unchecked' in match.group('Unchecked'),
-        static='static' in match.group('prefix'),
-        java_class_name=match.group('annotation') or '',
+        unchecked=annotation.name == 'CalledByNativeUnchecked',
+        static='static' in method.modifiers,
+        java_class_name=_GetStringArgument(annotation) or '',
         return_type=return_type,
         name=name,
         is_constructor=is_constructor,
-        params=JniParams.Parse(match.group('params')))]
-  # Check for any @CalledByNative occurrences that weren't matched.
-  unmatched_lines = re.sub(RE_CALLED_BY_NATIVE, '', contents).split('\n')
-  for line1, line2 in zip(unmatched_lines, unmatched_lines[1:]):
-    if '@CalledByNative' in line1:
-      raise ParseError('could not parse @CalledByNative method signature',
-                       line1, line2)
+        params=JniParams.Parse(method.params))]
   return MangleCalledByNatives(jni_params, called_by_natives)
 
 
-def RemoveComments(contents):
-  # We need to support both inline and block comments, and we need to handle
-  # strings that contain '//' or '/*'.
-  # TODO(bulach): This is a bit hacky. It would be cleaner to use a real Java
-  # parser. Maybe we could ditch JNIFromJavaSource and just always use
-  # JNIFromJavaP; or maybe we could rewrite this script in Java and use APT.
-  # http://code.google.com/p/chromium/issues/detail?id=138941
-  def replacer(match):
-    # Replace matches that are comments with nothing; return literals/strings
-    # unchanged.
-    s = match.group(0)
-    if s.startswith('/'):
-      return ''
-    else:
-      return s
-  return _COMMENT_REMOVER_REGEX.sub(replacer, contents)
+JavaAnnotation = collections.namedtuple(
+    'JavaAnnotation', [
+        'name',
+        # The text between the parentheses, or None.
+        'args',
+        # The index of the '@' token of the annotation.
+        'token_index',
+    ])
+
+JavaMethodDeclaration = collections.namedtuple(
+    'JavaMethodDeclaration',
+    ['annotations', 'modifiers', 'return_type', 'name', 'params'])
+
+
+def _GetStringArgument(annotation):
+  """Returns the value of annotation("value"), or None."""
+  if (annotation and annotation.args and len(annotation.args) >= 2 and
+      annotation.args[0] == annotation.args[-1] == '"'):
+    return annotation.args[1:-1]
+  return None
+
+
+def _IsJavaWord(text):
+  return text[0] in _JAVA_WORD_CHARS
+
+
+def _JoinTokens(tokens):
+  """Returns the text of tokens, with spaces where they were separated."""
+  return ''.join(' ' + text if space else text
+                 for space, text in tokens).lstrip()
+
+
+def _FindClosing(tokens, index, opening, closing):
+  """Returns the index of the token closing the one at tokens[index]."""
+  depth = 0
+  for i in xrange(index, len(tokens)):
+    text = tokens[i][1]
+    if text == opening:
+      depth += 1
+    elif text == closing:
+      depth -= 1
+      if depth == 0:
+        return i
+  return len(tokens)
+
+
+class JavaSourceScan(object):
+  """The declarations of a java source file, read in a single pass.
+
+  The source is split into tokens, skipping comments, and declarations are
+  recognized from the tokens since the last ';', '{' or '}'.
+
+  Attributes:
+    package: the package name, or None.
+    imports: the imported names, e.g. 'java.util.List' or 'java.util.*'.
+    type_names: the names of the declared classes, interfaces and enums.
+    annotations: all the JavaAnnotations.
+    methods: the JavaMethodDeclarations of annotated and native methods.
+    unparsed_called_by_natives: the token indexes of the @CalledByNative
+        annotations not followed by a method declaration.
+  """
+
+  def __init__(self, contents):
+    self._contents = contents
+    self.package = None
+    self.imports = []
+    self.type_names = []
+    self.annotations = []
+    self.methods = []
+    self.unparsed_called_by_natives = []
+
+    # (space, text) tuples, where space is the whitespace and comments before
+    # the token.
+    tokens = _JAVA_TOKEN_REGEX.findall(contents)
+    self._tokens = tokens
+    # The first token of the declaration being read, and its annotations as
+    # (annotation, end) tuples, where end is the index after its last token.
+    start = 0
+    annotations = []
+    has_native = False
+    i = 0
+    while i < len(tokens):
+      text = tokens[i][1]
+      if text not in _JAVA_SCANNED_TOKENS:
+        i += 1
+        continue
+      if text in (';', '{', '}'):
+        self._CheckNoCalledByNative(annotations)
+        start = i + 1
+        annotations = []
+        has_native = False
+      elif text == '(':
+        if ((annotations or has_native) and i > start and
+            _IsJavaWord(tokens[i - 1][1])):
+          closing = _FindClosing(tokens, i, '(', ')')
+          self._AddMethod(start, i, annotations,
+                          _JoinTokens(tokens[i + 1:closing]))
+          i = start = closing + 1
+          annotations = []
+          has_native = False
+          continue
+      elif text == '@':
+        if i + 1 < len(tokens) and _IsJavaWord(tokens[i + 1][1]):
+          if tokens[i + 1][1] == 'interface':
+            # An annotation type declaration.
+            i += 1
+            continue
+          end = i + 2
+          while (end + 1 < len(tokens) and tokens[end][1] == '.' and
+                 _IsJavaWord(tokens[end + 1][1])):
+            end += 2
+          name = ''.join(t[1] for t in tokens[i + 1:end])
+          args = None
+          if end < len(tokens) and tokens[end][1] == '(':
+            closing = _FindClosing(tokens, end, '(', ')')
+            args = _JoinTokens(tokens[end + 1:closing])
+            end = closing + 1
+          annotation = JavaAnnotation(name, args, i)
+          self.annotations.append(annotation)
+          annotations.append((annotation, end))
+          i = end
+          continue
+      elif text in ('package', 'import'):
+        end = i + 1
+        while end < len(tokens) and tokens[end][1] != ';':
+          end += 1
+        names = [t[1] for t in tokens[i + 1:end]]
+        if text == 'package':
+          self.package = ''.join(names)
+        else:
+          if names and names[0] == 'static':
+            names = names[1:]
+          self.imports.append(''.join(names))
+        i = start = end + 1
+        annotations = []
+        has_native = False
+        continue
+      elif text == 'native':
+        has_native = True
+      elif (i + 1 < len(tokens) and _IsJavaWord(tokens[i + 1][1]) and
+            (i == 0 or tokens[i - 1][1] != '.')):
+        # 'class', 'interface' or 'enum'.
+        self.type_names.append(tokens[i + 1][1])
+      i += 1
+    self._CheckNoCalledByNative(annotations)
+
+  def _CheckNoCalledByNative(self, annotations):
+    for annotation, _ in annotations:
+      if annotation.name in _CALLED_BY_NATIVE_ANNOTATIONS:
+        self.unparsed_called_by_natives.append(annotation.token_index)
+
+  def _AddMethod(self, start, end, annotations, params):
+    """Adds the method declared by tokens[start:end], without annotations."""
+    tokens = []
+    for annotation, annotation_end in annotations:
+      tokens.extend(self._tokens[start:annotation.token_index])
+      start = annotation_end
+    tokens.extend(self._tokens[start:end])
+    modifiers = []
+    i = 0
+    # Skip stray symbols, such as an unterminated quote.
+    while not _IsJavaWord(tokens[i][1]):
+      i += 1
+    while i < len(tokens) and tokens[i][1] in _JAVA_MODIFIERS:
+      modifiers.append(tokens[i][1])
+      i += 1
+    if i < len(tokens) and tokens[i][1] == '<':
+      # Skip type parameters.
+      i = _FindClosing(tokens, i, '<', '>') + 1
+    name = tokens[-1][1]
+    return_type = _JoinTokens(tokens[i:-1])
+    if (i >= len(tokens) or name in _JAVA_MODIFIERS or name[0].isdigit() or
+        (return_type and
+         not _JAVA_TYPE_REGEX.match(return_type.replace(' ', '')))):
+      self._CheckNoCalledByNative(annotations)
+      return
+    self.methods.append(JavaMethodDeclaration(
+        [annotation for annotation, _ in annotations], modifiers, return_type,
+        name, params))
+
+  def GetContextLines(self, token_index):
+    """Returns the line of the token at token_index and the next one."""
+    offset = sum(len(space) + len(text)
+                 for space, text in self._tokens[:token_index])
+    offset += len(self._tokens[token_index][0])
+    start = self._contents.rfind('\n', 0, offset) + 1
+    lines = self._contents[start:].split('\n', 2)
+    return lines[0], lines[1] if len(lines) > 1 else ''
+
+
+# The last scanned contents and its JavaSourceScan, which is shared by the
+# extraction functions.
+_last_java_source_scan = (None, None)
+
+
+def ScanJavaSource(contents):
+  """Returns the JavaSourceScan of contents."""
+  global _last_java_source_scan
+  if _last_java_source_scan[0] is not contents:
+    _last_java_source_scan = (contents, JavaSourceScan(contents))
+  return _last_java_source_scan[1]
 
 
 class JNIFromJavaP(object):
-  """Uses 'javap' to parse a .class file and generate the JNI header file."""
+  """Parses the output of 'javap' to generate the JNI header file."""
 
   def __init__(self, contents, options):
     self.contents = contents
@@ -756,29 +952,340 @@ class JNIFromJavaP(object):
   def GetContent(self):
     return self.inl_header_file_generator.GetContent()
 
+
+
+# Access flags of classes and their members.
+_ACC_PUBLIC = 0x0001
+_ACC_PRIVATE = 0x0002
+_ACC_STATIC = 0x0008
+_ACC_FINAL = 0x0010
+
+# Constant pool tags, and the size of the constants not read by ClassFile.
+_CONSTANT_UTF8 = 1
+_CONSTANT_INTEGER = 3
+_CONSTANT_LONG = 5
+_CONSTANT_DOUBLE = 6
+_CONSTANT_CLASS = 7
+_CONSTANT_SIZES = {
+    4: 4,  # Float
+    _CONSTANT_LONG: 8,
+    _CONSTANT_DOUBLE: 8,
+    8: 2,  # String
+    9: 4,  # Fieldref
+    10: 4,  # Methodref
+    11: 4,  # InterfaceMethodref
+    12: 4,  # NameAndType
+    15: 3,  # MethodHandle
+    16: 2,  # MethodType
+    17: 4,  # Dynamic
+    18: 4,  # InvokeDynamic
+    19: 2,  # Module
+    20: 2,  # Package
+}
+
+_DESCRIPTOR_BASE_TYPES = {
+    'B': 'byte',
+    'C': 'char',
+    'D': 'double',
+    'F': 'float',
+    'I': 'int',
+    'J': 'long',
+    'S': 'short',
+    'V': 'void',
+    'Z': 'boolean',
+}
+
+
+ClassMember = collections.namedtuple(
+    'ClassMember', ['access_flags', 'name', 'descriptor', 'constant_value'])
+
+
+class ClassFile(object):
+  """Reads the declarations of a compiled Java class.
+
+  Only the parts of the class file format needed to generate JNI headers are
+  decoded: the class name, and the access flags, name and descriptor of its
+  fields and methods, with the value of int constants.
+  """
+
+  def __init__(self, data):
+    self._data = data
+    self._offset = 0
+    if self._Read('>I')[0] != 0xCAFEBABE:
+      raise SyntaxError('Not a class file')
+    self._Read('>HH')  # minor_version, major_version
+    utf8s = {}
+    integers = {}
+    class_names = {}
+    count = self._Read('>H')[0]
+    index = 1
+    while index < count:
+      tag = self._Read('B')[0]
+      if tag == _CONSTANT_UTF8:
+        length = self._Read('>H')[0]
+        utf8s[index] = data[self._offset:self._offset + length]
+        self._offset += length
+      elif tag == _CONSTANT_INTEGER:
+        integers[index] = self._Read('>i')[0]
+      elif tag == _CONSTANT_CLASS:
+        class_names[index] = self._Read('>H')[0]
+      elif tag in _CONSTANT_SIZES:
+        self._offset += _CONSTANT_SIZES[tag]
+      else:
+        raise SyntaxError('Unknown constant pool tag %d' % tag)
+      # Long and double constants take two entries.
+      index += 2 if tag in (_CONSTANT_LONG, _CONSTANT_DOUBLE) else 1
+    self.access_flags, this_class = self._Read('>HH')
+    self.class_name = utf8s[class_names[this_class]]
+    self._Read('>H')  # super_class
+    interfaces_count = self._Read('>H')[0]
+    self._offset += 2 * interfaces_count
+    self.fields = self._ReadMembers(utf8s, integers)
+    self.methods = self._ReadMembers(utf8s, integers)
+
+  def _Read(self, fmt):
+    values = struct.unpack_from(fmt, self._data, self._offset)
+    self._offset += struct.calcsize(fmt)
+    return values
+
+  def _ReadMembers(self, utf8s, integers):
+    members = []
+    for _ in xrange(self._Read('>H')[0]):
+      access_flags, name_index, descriptor_index, attributes_count = (
+          self._Read('>HHHH'))
+      constant_value = None
+      for _ in xrange(attributes_count):
+        attribute_name_index, length = self._Read('>HI')
+        if utf8s[attribute_name_index] == 'ConstantValue':
+          constant_value = integers.get(self._Read('>H')[0])
+          length -= 2
+        self._offset += length
+      members.append(ClassMember(access_flags, utf8s[name_index],
+                                 utf8s[descriptor_index], constant_value))
+    return members
+
+
+def _ParseFieldDescriptor(descriptor, index):
+  """Returns the Java type at descriptor[index:] and the index following it.
+
+  Classes are named as in JNI signatures, e.g. 'java/lang/String[]'.
+  """
+  dimensions = 0
+  while descriptor[index] == '[':
+    dimensions += 1
+    index += 1
+  if descriptor[index] == 'L':
+    end = descriptor.index(';', index)
+    java_type = descriptor[index + 1:end]
+    index = end + 1
+  else:
+    java_type = _DESCRIPTOR_BASE_TYPES[descriptor[index]]
+    index += 1
+  return java_type + '[]' * dimensions, index
+
+
+def ParseMethodDescriptor(descriptor):
+  """Returns the list of Params and the return type of a method descriptor."""
+  params = []
+  index = 1
+  while descriptor[index] != ')':
+    datatype, index = _ParseFieldDescriptor(descriptor, index)
+    params.append(Param(datatype=datatype, name='p%s' % len(params)))
+  return_type, _ = _ParseFieldDescriptor(descriptor, index + 1)
+  return params, return_type
+
+
+class JNIFromClassFile(object):
+  """Reads a .class file to generate the JNI header file of its methods.
+
+  Generates the same header as JNIFromJavaP does from the output of javap.
+  """
+
+  def __init__(self, class_file, options):
+    self.fully_qualified_class = class_file.class_name
+    self.jni_params = JniParams(self.fully_qualified_class)
+    self.java_class_name = self.fully_qualified_class.split('/')[-1]
+    self.namespace = options.namespace or 'JNI_' + self.java_class_name
+    # Like javap, ignore private members.
+    methods = [m for m in class_file.methods
+               if not m.access_flags & _ACC_PRIVATE]
+    self.called_by_natives = []
+    for method in methods:
+      if method.name.startswith('<'):
+        continue
+      params, return_type = ParseMethodDescriptor(method.descriptor)
+      self.called_by_natives += [CalledByNative(
+          system_class=True,
+          unchecked=False,
+          static=bool(method.access_flags & _ACC_STATIC),
+          java_class_name='',
+          return_type=return_type,
+          name=method.name,
+          params=params,
+          signature='"%s"' % method.descriptor)]
+    for method in methods:
+      if method.name != '<init>' or not method.access_flags & _ACC_PUBLIC:
+        continue
+      params, _ = ParseMethodDescriptor(method.descriptor)
+      self.called_by_natives += [CalledByNative(
+          system_class=True,
+          unchecked=False,
+          static=False,
+          java_class_name='',
+          return_type=self.fully_qualified_class,
+          name='Constructor',
+          params=params,
+          signature='"%s"' % method.descriptor,
+          is_constructor=True)]
+    self.called_by_natives = MangleCalledByNatives(self.jni_params,
+                                                   self.called_by_natives)
+    constant_flags = _ACC_PUBLIC | _ACC_STATIC | _ACC_FINAL
+    self.constant_fields = [
+        ConstantField(name=field.name, value=str(field.constant_value))
+        for field in class_file.fields
+        if (field.access_flags & constant_flags == constant_flags and
+            field.descriptor == 'I' and field.constant_value is not None)]
+
+    self.inl_header_file_generator = InlHeaderFileGenerator(
+        self.namespace, self.fully_qualified_class, [], self.called_by_natives,
+        self.constant_fields, self.jni_params, options)
+
+  def GetContent(self):
+    return self.inl_header_file_generator.GetContent()
+
   @staticmethod
   def CreateFromClass(class_file, options):
-    class_name = os.path.splitext(os.path.basename(class_file))[0]
-    p = subprocess.Popen(args=[options.javap, '-c', '-verbose',
-                               '-s', class_name],
-                         cwd=os.path.dirname(class_file),
-                         stdout=subprocess.PIPE,
-                         stderr=subprocess.PIPE)
-    stdout, _ = p.communicate()
-    jni_from_javap = JNIFromJavaP(stdout.split('\n'), options)
-    return jni_from_javap
+    with open(class_file, 'rb') as f:
+      return JNIFromClassFile(ClassFile(f.read()), options)
 
 
-class JNIFromJavaSource(object):
-  """Uses the given java source file to generate the JNI header file."""
+class JavaSourceModel(object):
+  """The JNI related declarations parsed from a java source file."""
 
-  def __init__(self, contents, fully_qualified_class, options):
-    contents = RemoveComments(contents)
+  def __init__(self, contents, fully_qualified_class, ptr_type):
+    self.fully_qualified_class = fully_qualified_class
     self.jni_params = JniParams(fully_qualified_class)
     self.jni_params.ExtractImportsAndInnerClasses(contents)
-    jni_namespace = ExtractJNINamespace(contents) or options.namespace
-    natives = ExtractNatives(contents, options.ptr_type)
-    called_by_natives = ExtractCalledByNatives(self.jni_params, contents)
+    self.namespace = ExtractJNINamespace(contents)
+    self.natives = ExtractNatives(contents, ptr_type)
+    self.called_by_natives = ExtractCalledByNatives(self.jni_params, contents)
+    self.main_dex = IsMainDexJavaClass(contents)
+
+
+class ExtractionCache(object):
+  """A persistent cache of the JavaSourceModel of java source files.
+
+  Entries are pickled in cache_dir, keyed by a hash of the file name, the
+  file content, the pointer type and the content of this script, so that a
+  file is only parsed again when it or the parser changed. Writes are atomic,
+  so the cache may be shared by concurrent processes.
+  """
+
+  _script_digest = None
+  # The entry of files without natives, stored when parsing natives only.
+  _NO_NATIVES = 'no natives'
+
+  def __init__(self, cache_dir):
+    self._cache_dir = cache_dir
+
+  @classmethod
+  def _GetScriptDigest(cls):
+    if cls._script_digest is None:
+      script = os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+      with open(script) as f:
+        cls._script_digest = hashlib.sha1(f.read()).hexdigest()
+    return cls._script_digest
+
+  def _GetKey(self, java_file_name, contents, ptr_type):
+    digest = hashlib.sha1(self._GetScriptDigest())
+    digest.update('\0' + os.path.basename(java_file_name))
+    digest.update('\0' + ptr_type)
+    digest.update('\0' + contents)
+    return digest.hexdigest()
+
+  def _Load(self, path):
+    try:
+      with open(path, 'rb') as f:
+        return cPickle.load(f)
+    except IOError as e:
+      if e.errno != errno.ENOENT:
+        raise
+    except (EOFError, cPickle.UnpicklingError):
+      # A corrupt entry is parsed again and overwritten.
+      pass
+    return None
+
+  def _Store(self, path, model):
+    build_utils.MakeDirectory(self._cache_dir)
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+      cPickle.dump(model, f, cPickle.HIGHEST_PROTOCOL)
+    os.rename(tmp_path, path)
+
+  def GetModel(self, java_file_name, ptr_type, contents, natives_only=False):
+    """Returns the JavaSourceModel of java_file_name, parsing it if needed.
+
+    With natives_only, files without natives are cached as such, and None is
+    returned for them.
+    """
+    path = os.path.join(self._cache_dir,
+                        self._GetKey(java_file_name, contents, ptr_type))
+    model = self._Load(path)
+    if model == self._NO_NATIVES:
+      if natives_only:
+        return None
+      model = None
+    if model is None:
+      model = _ParseJavaSource(java_file_name, contents, ptr_type,
+                               natives_only)
+      self._Store(path, self._NO_NATIVES if model is None else model)
+    if model is None or (natives_only and not model.natives):
+      return None
+    return model
+
+
+def _ParseJavaSource(java_file_name, contents, ptr_type, natives_only):
+  """Returns the JavaSourceModel of contents, see ParseJavaSourceFile()."""
+  if natives_only and not ExtractNatives(contents, ptr_type):
+    return None
+  fully_qualified_class = ExtractFullyQualifiedJavaClassName(java_file_name,
+                                                             contents)
+  return JavaSourceModel(contents, fully_qualified_class, ptr_type)
+
+
+def ParseJavaSourceFile(java_file_name, ptr_type, cache_dir=None,
+                        natives_only=False):
+  """Returns the JavaSourceModel of a java file.
+
+  Args:
+    java_file_name: the java source file to parse.
+    ptr_type: the Java type used for native pointers.
+    cache_dir: an optional ExtractionCache directory.
+    natives_only: whether to return None for files without natives, without
+        parsing them further. Such files need not have a "package" line, nor
+        @CalledByNative methods that can be parsed.
+  """
+  with open(java_file_name) as f:
+    contents = f.read()
+  if natives_only and 'native' not in contents:
+    return None
+  if cache_dir:
+    return ExtractionCache(cache_dir).GetModel(java_file_name, ptr_type,
+                                               contents, natives_only)
+  return _ParseJavaSource(java_file_name, contents, ptr_type, natives_only)
+
+
+class JNIFromJavaSource(object):
+  """Uses the given java source file to generate the JNI header file."""
+
+  def __init__(self, contents, fully_qualified_class, options, model=None):
+    if model is None:
+      model = JavaSourceModel(contents, fully_qualified_class,
+                              options.ptr_type)
+    self.jni_params = model.jni_params
+    jni_namespace = model.namespace or options.namespace
+    natives = model.natives
+    called_by_natives = model.called_by_natives
     if len(natives) == 0 and len(called_by_natives) == 0:
       raise SyntaxError('Unable to find any JNI methods for %s.' %
                         fully_qualified_class)
@@ -792,10 +1299,9 @@ class JNIFromJavaSource(object):
 
   @staticmethod
   def CreateFromFile(java_file_name, options):
-    contents = open(java_file_name).read()
-    fully_qualified_class = ExtractFullyQualifiedJavaClassName(java_file_name,
-                                                               contents)
-    return JNIFromJavaSource(contents, fully_qualified_class, options)
+    model = ParseJavaSourceFile(java_file_name, options.ptr_type,
+                                options.extraction_cache_dir)
+    return JNIFromJavaSource(None, model.fully_qualified_class, options, model)
 
 
 class HeaderFileGeneratorHelper(object):
@@ -884,27 +1390,30 @@ JNI_REGISTRATION_EXPORT base::subtle::AtomicWord g_${JAVA_CLASS}_clazz = 0;
     return ''.join(ret)
 
 
-class InlHeaderFileGenerator(object):
-  """Generates an inline header file for JNI integration."""
+def _CompileTemplate(template):
+  """Returns a string.Template text as a '%' format string.
 
-  def __init__(self, namespace, fully_qualified_class, natives,
-               called_by_natives, constant_fields, jni_params, options):
-    self.namespace = namespace
-    self.fully_qualified_class = fully_qualified_class
-    self.class_name = self.fully_qualified_class.split('/')[-1]
-    self.natives = natives
-    self.called_by_natives = called_by_natives
-    self.header_guard = fully_qualified_class.replace('/', '_') + '_JNI'
-    self.constant_fields = constant_fields
-    self.jni_params = jni_params
-    self.options = options
-    self.helper = HeaderFileGeneratorHelper(
-        self.class_name, fully_qualified_class)
+  Formatting with '%' is done in C, and is several times faster than
+  Template.substitute(), which runs a regex over the template on each call.
+  """
+  def ToFormat(match):
+    if match.group('escaped') is not None:
+      return '$'
+    name = match.group('named') or match.group('braced')
+    if name is None:
+      raise ValueError('Invalid placeholder in template: ' + template)
+    return '%(' + name + ')s'
+  return Template.pattern.sub(ToFormat, template.replace('%', '%%'))
 
 
-  def GetContent(self):
-    """Returns the content of the JNI binding file."""
-    template = Template("""\
+def _IndentedLine(text, keep_empty=False):
+  """Returns text as an indented line, or nothing if it is empty."""
+  if text or keep_empty:
+    return '  ' + text + '\n'
+  return ''
+
+
+_HEADER_START_TEMPLATE = _CompileTemplate("""\
 // Copyright 2014 The Chromium Authors. All rights reserved.
 // Use of this source code is governed by a BSD-style license that can be
 // found in the LICENSE file.
@@ -930,31 +1439,117 @@ $CLASS_PATH_DEFINITIONS
 $CONSTANT_FIELDS\
 
 // Step 3: Method stubs.
-$METHOD_STUBS
+""")
+
+_HEADER_END_TEMPLATE = _CompileTemplate("""
 
 #endif  // ${HEADER_GUARD}
 """)
+
+_NATIVE_METHOD_STUB_TEMPLATE = _CompileTemplate("""\
+JNI_GENERATOR_EXPORT ${RETURN} ${STUB_NAME}(
+    JNIEnv* env,
+    ${PARAMS_IN_STUB}) {
+${PROFILING_ENTERED_NATIVE}\
+${TRACE_EVENT}\
+  ${P0_TYPE}* native = reinterpret_cast<${P0_TYPE}*>(${PARAM0_NAME});
+  CHECK_NATIVE_PTR(env, jcaller, native, "${NAME}"${OPTIONAL_ERROR_RETURN});
+  return native->${NAME}(${PARAMS_IN_CALL})${POST_CALL};
+}
+""")
+
+_NATIVE_FUNCTION_STUB_TEMPLATE = _CompileTemplate("""\
+static ${RETURN_DECLARATION} ${IMPL_METHOD_NAME}(JNIEnv* env, ${PARAMS});
+
+JNI_GENERATOR_EXPORT ${RETURN} ${STUB_NAME}(
+    JNIEnv* env,
+    ${PARAMS_IN_STUB}) {
+${PROFILING_ENTERED_NATIVE}\
+${TRACE_EVENT}\
+  return ${IMPL_METHOD_NAME}(${PARAMS_IN_CALL})${POST_CALL};
+}
+""")
+
+_CALLED_BY_NATIVE_SIGNATURE_TEMPLATE = _CompileTemplate("""\
+static ${RETURN_TYPE} Java_${JAVA_CLASS_ONLY}_${METHOD_ID_VAR_NAME}(\
+JNIEnv* env${FIRST_PARAM_IN_DECLARATION}${PARAMS_IN_DECLARATION})""")
+
+_CALLED_BY_NATIVE_HEADER_TEMPLATE = _CompileTemplate("""\
+${FUNCTION_SIGNATURE} {""")
+
+_CALLED_BY_NATIVE_HEADER_WITH_UNUSED_TEMPLATE = _CompileTemplate("""\
+${FUNCTION_SIGNATURE} __attribute__ ((unused));
+${FUNCTION_SIGNATURE} {""")
+
+# Lines which may be empty are passed as *_LINE values, see _IndentedLine().
+_CALLED_BY_NATIVE_STUB_TEMPLATE = _CompileTemplate("""
+static base::subtle::AtomicWord g_${JAVA_CLASS}_${METHOD_ID_VAR_NAME} = 0;
+${FUNCTION_HEADER}
+  CHECK_CLAZZ(env, ${FIRST_PARAM_IN_CALL},
+      ${JAVA_CLASS}_clazz(env)${OPTIONAL_ERROR_RETURN});
+  jmethodID method_id = base::android::MethodID::LazyGet<
+      base::android::MethodID::TYPE_${METHOD_ID_TYPE}>(
+          env, ${JAVA_CLASS}_clazz(env),
+          "${JNI_NAME}",
+          ${JNI_SIGNATURE},
+          &g_${JAVA_CLASS}_${METHOD_ID_VAR_NAME});
+
+${TRACE_EVENT}\
+${PROFILING_LEAVING_NATIVE}\
+${RETURN_DECLARATION_LINE}\
+     ${PRE_CALL}env->${ENV_CALL}(${FIRST_PARAM_IN_CALL},
+          method_id${PARAMS_IN_CALL})${POST_CALL};
+${CHECK_EXCEPTION_LINE}\
+${RETURN_CLAUSE_LINE}\
+}""")
+
+
+class InlHeaderFileGenerator(object):
+  """Generates an inline header file for JNI integration."""
+
+  def __init__(self, namespace, fully_qualified_class, natives,
+               called_by_natives, constant_fields, jni_params, options):
+    self.namespace = namespace
+    self.fully_qualified_class = fully_qualified_class
+    self.class_name = self.fully_qualified_class.split('/')[-1]
+    self.natives = natives
+    self.called_by_natives = called_by_natives
+    self.header_guard = fully_qualified_class.replace('/', '_') + '_JNI'
+    self.constant_fields = constant_fields
+    self.jni_params = jni_params
+    self.options = options
+    self.helper = HeaderFileGeneratorHelper(
+        self.class_name, fully_qualified_class)
+
+
+  def GetContent(self):
+    """Returns the content of the JNI binding file."""
     values = {
         'SCRIPT_NAME': self.options.script_name,
         'FULLY_QUALIFIED_CLASS': self.fully_qualified_class,
         'CLASS_PATH_DEFINITIONS': self.GetClassPathDefinitionsString(),
         'CONSTANT_FIELDS': self.GetConstantFieldsString(),
-        'METHOD_STUBS': self.GetMethodStubsString(),
         'HEADER_GUARD': self.header_guard,
         'INCLUDES': self.GetIncludesString(),
     }
     open_namespace = self.GetOpenNamespaceString()
+    close_namespace = self.GetCloseNamespaceString()
+    constant_fields = values['CONSTANT_FIELDS']
+    if open_namespace and constant_fields:
+      values['CONSTANT_FIELDS'] = '\n'.join([
+          open_namespace, constant_fields, close_namespace])
+
+    # The fragments are written into a single buffer, which is joined once.
+    out = [_HEADER_START_TEMPLATE % values]
     if open_namespace:
-      close_namespace = self.GetCloseNamespaceString()
-      values['METHOD_STUBS'] = '\n'.join([
-            open_namespace, values['METHOD_STUBS'], close_namespace])
-
-      constant_fields = values['CONSTANT_FIELDS']
-      if constant_fields:
-        values['CONSTANT_FIELDS'] = '\n'.join([
-            open_namespace, constant_fields, close_namespace])
-
-    return WrapOutput(template.substitute(values))
+      out += [open_namespace, '\n']
+    self.WriteMethodStubs(out)
+    if self.options.enable_entry_points_table:
+      out += ['\n', self.GetEntryPointsTableString()]
+    if open_namespace:
+      out += ['\n', close_namespace]
+    out.append(_HEADER_END_TEMPLATE % values)
+    return WrapOutput(''.join(out))
 
   def GetClassPathDefinitionsString(self):
     classes = self.helper.GetUniqueClasses(self.called_by_natives)
@@ -970,17 +1565,19 @@ $METHOD_STUBS
     ret += ['};', '']
     return '\n'.join(ret)
 
-  def GetMethodStubsString(self):
-    """Returns the code corresponding to method stubs."""
-    ret = []
+  def WriteMethodStubs(self, out):
+    """Appends the code corresponding to method stubs to out."""
+    separator = None
     for native in self.natives:
-      ret += [self.GetNativeStub(native)]
-    ret += self.GetLazyCalledByNativeMethodStubs()
-    return '\n'.join(ret)
-
-  def GetLazyCalledByNativeMethodStubs(self):
-    return [self.GetLazyCalledByNativeMethodStub(called_by_native)
-            for called_by_native in self.called_by_natives]
+      if separator:
+        out.append(separator)
+      out.append(self.GetNativeStub(native))
+      separator = '\n'
+    for called_by_native in self.called_by_natives:
+      if separator:
+        out.append(separator)
+      out.append(self.GetLazyCalledByNativeMethodStub(called_by_native))
+      separator = '\n'
 
   def GetIncludesString(self):
     if not self.options.includes:
@@ -1010,11 +1607,7 @@ $METHOD_STUBS
         for param in called_by_native.params])
 
   def GetJavaParamRefForCall(self, c_type, name):
-    return Template(
-        'base::android::JavaParamRef<${TYPE}>(env, ${NAME})').substitute({
-        'TYPE': c_type,
-        'NAME': name,
-    })
+    return 'base::android::JavaParamRef<%s>(env, %s)' % (c_type, name)
 
   def GetJNIFirstParamForCall(self, native):
     c_type = _GetJNIFirstParamType(native)
@@ -1037,7 +1630,7 @@ $METHOD_STUBS
     params_in_call = ['env'] + self.GetJNIFirstParamForCall(native)
     for p in params:
       c_type = JavaDataTypeToC(p.datatype)
-      if re.match(RE_SCOPED_JNI_TYPES, c_type):
+      if RE_SCOPED_JNI_TYPES.match(c_type):
         params_in_call.append(self.GetJavaParamRefForCall(c_type, p.name))
       else:
         params_in_call.append(p.name)
@@ -1045,7 +1638,7 @@ $METHOD_STUBS
 
     return_type = return_declaration = JavaDataTypeToC(native.return_type)
     post_call = ''
-    if re.match(RE_SCOPED_JNI_TYPES, return_type):
+    if RE_SCOPED_JNI_TYPES.match(return_type):
       post_call = '.Release()'
       return_declaration = ('base::android::ScopedJavaLocalRef<' + return_type +
                             '>')
@@ -1077,41 +1670,19 @@ $METHOD_STUBS
           'P0_TYPE': native.p0_type,
       })
       if self.options.enable_tracing:
-        values['TRACE_EVENT'] = self.GetTraceEventForNameTemplate(
-            namespace_qual + '${P0_TYPE}::${NAME}', values);
-      template = Template("""\
-JNI_GENERATOR_EXPORT ${RETURN} ${STUB_NAME}(
-    JNIEnv* env,
-    ${PARAMS_IN_STUB}) {
-${PROFILING_ENTERED_NATIVE}\
-${TRACE_EVENT}\
-  ${P0_TYPE}* native = reinterpret_cast<${P0_TYPE}*>(${PARAM0_NAME});
-  CHECK_NATIVE_PTR(env, jcaller, native, "${NAME}"${OPTIONAL_ERROR_RETURN});
-  return native->${NAME}(${PARAMS_IN_CALL})${POST_CALL};
-}
-""")
-    else:
-      if self.options.enable_tracing:
-        values['TRACE_EVENT'] = self.GetTraceEventForNameTemplate(
-            namespace_qual + '${IMPL_METHOD_NAME}', values)
-      template = Template("""\
-static ${RETURN_DECLARATION} ${IMPL_METHOD_NAME}(JNIEnv* env, ${PARAMS});
+        values['TRACE_EVENT'] = self.GetTraceEvent(
+            namespace_qual + native.p0_type + '::' + native.name)
+      return _NATIVE_METHOD_STUB_TEMPLATE % values
 
-JNI_GENERATOR_EXPORT ${RETURN} ${STUB_NAME}(
-    JNIEnv* env,
-    ${PARAMS_IN_STUB}) {
-${PROFILING_ENTERED_NATIVE}\
-${TRACE_EVENT}\
-  return ${IMPL_METHOD_NAME}(${PARAMS_IN_CALL})${POST_CALL};
-}
-""")
-
-    return RemoveIndentedEmptyLines(template.substitute(values))
+    if self.options.enable_tracing:
+      values['TRACE_EVENT'] = self.GetTraceEvent(
+          namespace_qual + values['IMPL_METHOD_NAME'])
+    return _NATIVE_FUNCTION_STUB_TEMPLATE % values
 
   def GetArgument(self, param):
     if param.datatype == 'int':
       return 'as_jint(' + param.name + ')'
-    elif re.match(RE_SCOPED_JNI_TYPES, JavaDataTypeToC(param.datatype)):
+    elif RE_SCOPED_JNI_TYPES.match(JavaDataTypeToC(param.datatype)):
       return param.name + '.obj()'
     else:
       return param.name
@@ -1158,7 +1729,7 @@ ${TRACE_EVENT}\
     if return_type != 'void':
       pre_call = ' ' + pre_call
       return_declaration = return_type + ' ret ='
-      if re.match(RE_SCOPED_JNI_TYPES, return_type):
+      if RE_SCOPED_JNI_TYPES.match(return_type):
         return_type = 'base::android::ScopedJavaLocalRef<' + return_type + '>'
         return_clause = 'return ' + return_type + '(env, ret);'
       else:
@@ -1202,52 +1773,104 @@ ${TRACE_EVENT}\
 
   def GetLazyCalledByNativeMethodStub(self, called_by_native):
     """Returns a string."""
-    function_signature_template = Template("""\
-static ${RETURN_TYPE} Java_${JAVA_CLASS_ONLY}_${METHOD_ID_VAR_NAME}(\
-JNIEnv* env${FIRST_PARAM_IN_DECLARATION}${PARAMS_IN_DECLARATION})""")
-    function_header_template = Template("""\
-${FUNCTION_SIGNATURE} {""")
-    function_header_with_unused_template = Template("""\
-${FUNCTION_SIGNATURE} __attribute__ ((unused));
-${FUNCTION_SIGNATURE} {""")
-    template = Template("""
-static base::subtle::AtomicWord g_${JAVA_CLASS}_${METHOD_ID_VAR_NAME} = 0;
-${FUNCTION_HEADER}
-  CHECK_CLAZZ(env, ${FIRST_PARAM_IN_CALL},
-      ${JAVA_CLASS}_clazz(env)${OPTIONAL_ERROR_RETURN});
-  jmethodID method_id = base::android::MethodID::LazyGet<
-      base::android::MethodID::TYPE_${METHOD_ID_TYPE}>(
-          env, ${JAVA_CLASS}_clazz(env),
-          "${JNI_NAME}",
-          ${JNI_SIGNATURE},
-          &g_${JAVA_CLASS}_${METHOD_ID_VAR_NAME});
-
-${TRACE_EVENT}\
-${PROFILING_LEAVING_NATIVE}\
-  ${RETURN_DECLARATION}
-     ${PRE_CALL}env->${ENV_CALL}(${FIRST_PARAM_IN_CALL},
-          method_id${PARAMS_IN_CALL})${POST_CALL};
-  ${CHECK_EXCEPTION}
-  ${RETURN_CLAUSE}
-}""")
     values = self.GetCalledByNativeValues(called_by_native)
     values['FUNCTION_SIGNATURE'] = (
-        function_signature_template.substitute(values))
+        _CALLED_BY_NATIVE_SIGNATURE_TEMPLATE % values)
     if called_by_native.system_class:
       values['FUNCTION_HEADER'] = (
-          function_header_with_unused_template.substitute(values))
+          _CALLED_BY_NATIVE_HEADER_WITH_UNUSED_TEMPLATE % values)
     else:
-      values['FUNCTION_HEADER'] = function_header_template.substitute(values)
+      values['FUNCTION_HEADER'] = _CALLED_BY_NATIVE_HEADER_TEMPLATE % values
     if self.options.enable_tracing:
-      values['TRACE_EVENT'] = self.GetTraceEventForNameTemplate(
-          '${JAVA_NAME_FULL}', values)
+      values['TRACE_EVENT'] = self.GetTraceEvent(values['JAVA_NAME_FULL'])
     else:
       values['TRACE_EVENT'] = ''
-    return RemoveIndentedEmptyLines(template.substitute(values))
+    # The trace event has no line break, so the line following it is never
+    # empty.
+    values['RETURN_DECLARATION_LINE'] = _IndentedLine(
+        values['RETURN_DECLARATION'],
+        keep_empty=(values['TRACE_EVENT'] and
+                    not values['PROFILING_LEAVING_NATIVE']))
+    values['CHECK_EXCEPTION_LINE'] = _IndentedLine(values['CHECK_EXCEPTION'])
+    values['RETURN_CLAUSE_LINE'] = _IndentedLine(values['RETURN_CLAUSE'])
+    return _CALLED_BY_NATIVE_STUB_TEMPLATE % values
+
+  def GetTracingSamplingRate(self, name):
+    """Returns the sampling rate of the function traced as name."""
+    for pattern, sampling_rate in self.options.tracing_method_sampling_rate:
+      if fnmatch.fnmatchcase(name, pattern):
+        return sampling_rate
+    return self.options.tracing_sampling_rate
+
+  def GetTraceEvent(self, name):
+    sampling_rate = self.GetTracingSamplingRate(name)
+    if sampling_rate == 0:
+      return ''
+    if sampling_rate == 1:
+      return '  TRACE_EVENT0("%s", "%s");' % (self.options.tracing_category,
+                                              name)
+    return '  JNI_TRACE_EVENT_SAMPLED("%s", "%s", %d);' % (
+        self.options.tracing_category, name, sampling_rate)
+
+  def GetEntryPointsTableString(self):
+    """Returns the table of the generated functions, for native profilers."""
+    ret = ['JNI_ENTRY_POINTS_TABLE const jni_generator::JniEntryPoint',
+           '    kJniEntryPoints_%s[] = {' %
+           GetBinaryClassName(self.fully_qualified_class)]
+    for native in self.natives:
+      java_class = self.fully_qualified_class
+      if native.java_class_name:
+        java_class += '$' + native.java_class_name
+      ret += ['  {"%s", "native%s", %s,' % (
+                  java_class, native.name,
+                  self.jni_params.Signature(native.params,
+                                            native.return_type)),
+              '   reinterpret_cast<const void*>(&%s), false},' %
+              self.helper.GetStubName(native)]
+    for called_by_native in self.called_by_natives:
+      java_class = self.fully_qualified_class
+      if called_by_native.java_class_name:
+        java_class += '$' + called_by_native.java_class_name
+      values = self.GetCalledByNativeValues(called_by_native)
+      ret += ['  {"%s", "%s", %s,' % (
+                  java_class, values['JNI_NAME'], values['JNI_SIGNATURE']),
+              '   reinterpret_cast<const void*>(&Java_%s_%s), true},' % (
+                  values['JAVA_CLASS_ONLY'], values['METHOD_ID_VAR_NAME'])]
+    ret += ['};', '']
+    return '\n'.join(ret)
 
-  def GetTraceEventForNameTemplate(self, name_template, values):
-    name = Template(name_template).substitute(values)
-    return '  TRACE_EVENT0("jni", "%s");' % name
+
+def _WrapLine(line, first_line_indent):
+  """Returns _WRAPPERS_BY_INDENT[first_line_indent].wrap(line).
+
+  The common case of a line without hyphenated words is wrapped here, as
+  TextWrapper's word splitting regex is slow on long lines.
+  """
+  if _HYPHENATED_WORD_REGEX.search(line):
+    return _WRAPPERS_BY_INDENT[first_line_indent].wrap(line)
+  subsequent_indent = ' ' * (first_line_indent + 4)
+  chunks = [chunk for chunk in _WHITESPACE_REGEX.split(line) if chunk]
+  chunks.reverse()
+  lines = []
+  while chunks:
+    indent = subsequent_indent if lines else ''
+    width = _WRAP_LINE_LENGTH - len(indent)
+    # Whitespace starting a continuation line is dropped.
+    if lines and not chunks[-1].strip():
+      chunks.pop()
+    current = []
+    current_len = 0
+    while chunks and current_len + len(chunks[-1]) <= width:
+      current_len += len(chunks[-1])
+      current.append(chunks.pop())
+    if chunks and not current:
+      # Long words are not broken.
+      current.append(chunks.pop())
+    if current and not current[-1].strip():
+      current.pop()
+    if current:
+      lines.append(indent + ''.join(current))
+  return lines
 
 
 def WrapOutput(output):
@@ -1260,50 +1883,14 @@ def WrapOutput(output):
       # Assumes that the line is not already indented as a continuation line,
       # which is not always true (oh well).
       first_line_indent = (len(line) - len(line.lstrip()))
-      wrapper = _WRAPPERS_BY_INDENT[first_line_indent]
-      ret.extend(wrapper.wrap(line))
+      ret.extend(_WrapLine(line, first_line_indent))
   ret += ['']
   return '\n'.join(ret)
 
 
-def ExtractJarInputFile(jar_file, input_file, out_dir):
-  """Extracts input file from jar and returns the filename.
-
-  The input file is extracted to the same directory that the generated jni
-  headers will be placed in.  This is passed as an argument to script.
-
-  Args:
-    jar_file: the jar file containing the input files to extract.
-    input_files: the list of files to extract from the jar file.
-    out_dir: the name of the directories to extract to.
-
-  Returns:
-    the name of extracted input file.
-  """
-  jar_file = zipfile.ZipFile(jar_file)
-
-  out_dir = os.path.join(out_dir, os.path.dirname(input_file))
-  try:
-    os.makedirs(out_dir)
-  except OSError as e:
-    if e.errno != errno.EEXIST:
-      raise
-  extracted_file_name = os.path.join(out_dir, os.path.basename(input_file))
-  with open(extracted_file_name, 'w') as outfile:
-    outfile.write(jar_file.read(input_file))
-
-  return extracted_file_name
-
-
 def GenerateJNIHeader(input_file, output_file, options):
   try:
-    if os.path.splitext(input_file)[1] == '.class':
-      jni_from_javap = JNIFromJavaP.CreateFromClass(input_file, options)
-      content = jni_from_javap.GetContent()
-    else:
-      jni_from_java_source = JNIFromJavaSource.CreateFromFile(
-          input_file, options)
-      content = jni_from_java_source.GetContent()
+    content = _GetJNIHeaderContent(input_file, options)
   except ParseError as e:
     print(e)
     sys.exit(1)
@@ -1313,6 +1900,69 @@ def GenerateJNIHeader(input_file, output_file, options):
     print(content)
 
 
+def _GetJNIHeaderContent(input_file, options):
+  is_class_file = os.path.splitext(input_file)[1] == '.class'
+  if options.jar_file:
+    # Read the input file straight out of the jar.
+    with zipfile.ZipFile(options.jar_file) as jar_file:
+      contents = jar_file.read(input_file)
+    if is_class_file:
+      return JNIFromClassFile(ClassFile(contents), options).GetContent()
+    fully_qualified_class = ExtractFullyQualifiedJavaClassName(input_file,
+                                                               contents)
+    return JNIFromJavaSource(contents, fully_qualified_class,
+                             options).GetContent()
+  if is_class_file:
+    jni_from_class_file = JNIFromClassFile.CreateFromClass(input_file, options)
+    return jni_from_class_file.GetContent()
+  jni_from_java_source = JNIFromJavaSource.CreateFromFile(input_file, options)
+  return jni_from_java_source.GetContent()
+
+
+def _GenerateJNIHeaderForBatch(args):
+  """Generates one header of a batch; returns an error message or None."""
+  input_file, output_file, options = args
+  try:
+    WriteOutput(output_file, _GetJNIHeaderContent(input_file, options))
+  except (ParseError, SyntaxError) as e:
+    return '%s: %s' % (input_file, e)
+  return None
+
+
+def GenerateJNIHeaders(input_files, output_files, options):
+  """Generates the headers of many input files in one process.
+
+  Headers are generated by a pool of options.jobs worker processes, and only
+  written if their content changed.
+
+  Args:
+    input_files: the list of .java or .class files.
+    output_files: the list of headers to write, one per input file.
+    options: the parsed command line options.
+
+  Returns:
+    the list of error messages of input files which failed.
+  """
+  work = [(input_file, output_file, options)
+          for input_file, output_file in zip(input_files, output_files)]
+  if options.jobs == 1 or len(work) <= 1:
+    errors = [_GenerateJNIHeaderForBatch(w) for w in work]
+  else:
+    pool = multiprocessing.Pool(options.jobs or None)
+    try:
+      errors = pool.map(_GenerateJNIHeaderForBatch, work)
+    finally:
+      pool.close()
+      pool.join()
+  return [e for e in errors if e]
+
+
+def GetOutputFileName(input_file, output_dir):
+  """Returns the header generated for input_file in output_dir."""
+  root_name = os.path.splitext(os.path.basename(input_file))[0]
+  return os.path.join(output_dir, root_name) + '_jni.h'
+
+
 def WriteOutput(output_file, content):
   if os.path.exists(output_file):
     with open(output_file) as f:
@@ -1343,19 +1993,30 @@ See SampleForTests.java for more details.
   build_utils.AddDepfileOption(option_parser)
 
   option_parser.add_option('-j', '--jar_file', dest='jar_file',
-                           help='Extract the list of input files from'
-                           ' a specified jar file.'
-                           ' Uses javap to extract the methods from a'
-                           ' pre-compiled class. --input should point'
+                           help='Read the input files from a specified jar'
+                           ' file. The methods of pre-compiled classes are'
+                           ' read from the class files. --input should point'
                            ' to pre-compiled Java .class files.')
   option_parser.add_option('-n', dest='namespace',
                            help='Uses as a namespace in the generated header '
                            'instead of the javap class name, or when there is '
                            'no JNINamespace annotation in the java source.')
-  option_parser.add_option('--input_file',
-                           help='Single input file name. The output file name '
+  option_parser.add_option('--input_file', action='append', default=[],
+                           help='Input file name. The output file name '
                            'will be derived from it. Must be used with '
-                           '--output_dir.')
+                           '--output_dir. May be repeated to generate many '
+                           'headers in one process.')
+  option_parser.add_option('--sources_file', action='append', default=[],
+                           help='A file listing input file names, one per '
+                           'line. Must be used with --output_dir.')
+  option_parser.add_option('--jobs', type='int', default=0,
+                           help='Number of worker processes when there are '
+                           'several input files. Defaults to the number of '
+                           'CPUs.')
+  option_parser.add_option('--extraction_cache_dir',
+                           help='A directory caching the declarations parsed '
+                           'from java source files across runs. May be '
+                           'shared with jni_registration_generator.py.')
   option_parser.add_option('--output_dir',
                            help='The output directory. Must be used with '
                            '--input')
@@ -1373,25 +2034,70 @@ See SampleForTests.java for more details.
   option_parser.add_option('--cpp', default='cpp',
                            help='The path to cpp command.')
   option_parser.add_option('--javap', default='javap',
-                           help='The path to javap command.')
+                           help='Ignored, class files are read directly. '
+                           'Kept for compatibility.')
   option_parser.add_option('--enable_profiling', action='store_true',
                            help='Add additional profiling instrumentation.')
   option_parser.add_option('--enable_tracing', action='store_true',
                            help='Add TRACE_EVENTs to generated functions.')
+  option_parser.add_option('--tracing_category', default='jni',
+                           help='The category of the TRACE_EVENTs.')
+  option_parser.add_option('--tracing_sampling_rate', type='int', default=1,
+                           help='Trace one out of N calls of each generated '
+                           'function. 0 disables tracing.')
+  option_parser.add_option('--tracing_method_sampling_rate', action='append',
+                           default=[], metavar='PATTERN=N',
+                           help='The tracing sampling rate of the functions '
+                           'whose trace event name matches the fnmatch '
+                           'PATTERN, e.g. "org.chromium.foo.Foo.*=100". May '
+                           'be repeated, the first match is used.')
+  option_parser.add_option('--enable_entry_points_table', action='store_true',
+                           help='Add a table of the generated functions, with '
+                           'their Java class, name and signature, that native '
+                           'profilers can use to attribute time to JNI '
+                           'calls.')
   options, args = option_parser.parse_args(argv)
-  if options.jar_file:
-    input_file = ExtractJarInputFile(options.jar_file, options.input_file,
-                                     options.output_dir)
-  elif options.input_file:
-    input_file = options.input_file
-  else:
+  if options.tracing_sampling_rate < 0:
+    option_parser.error('Invalid --tracing_sampling_rate: %d' %
+                        options.tracing_sampling_rate)
+  method_sampling_rates = []
+  for method_sampling_rate in options.tracing_method_sampling_rate:
+    pattern, _, sampling_rate = method_sampling_rate.rpartition('=')
+    # isdigit() also rejects negative rates.
+    if not pattern or not sampling_rate.isdigit():
+      option_parser.error('Invalid --tracing_method_sampling_rate: ' +
+                          method_sampling_rate)
+    method_sampling_rates.append((pattern, int(sampling_rate)))
+  options.tracing_method_sampling_rate = method_sampling_rates
+  input_files = list(options.input_file)
+  for sources_file in options.sources_file:
+    input_files += build_utils.ReadSourcesList(sources_file)
+  if not input_files:
     option_parser.print_help()
     print('\nError: Must specify --jar_file or --input_file.')
     return 1
+  if len(input_files) > 1:
+    if not options.output_dir:
+      print('\nError: Several input files must be used with --output_dir.')
+      return 1
+    output_files = [GetOutputFileName(input_file, options.output_dir)
+                    for input_file in input_files]
+    errors = GenerateJNIHeaders(input_files, output_files, options)
+    for error in errors:
+      print(error)
+    if errors:
+      return 1
+    if options.depfile:
+      # Ninja does not support multiple outputs in depfiles; the other headers
+      # are outputs of the same action.
+      build_utils.WriteDepfile(options.depfile, output_files[0],
+                               options.sources_file)
+    return 0
+
+  input_file = input_files[0]
   output_file = None
   if options.output_dir:
-    root_name = os.path.splitext(os.path.basename(input_file))[0]
-    output_file = os.path.join(options.output_dir, root_name) + '_jni.h'
+    output_file = GetOutputFileName(input_file, options.output_dir)
   GenerateJNIHeader(input_file, output_file, options)
 
   if options.depfile:
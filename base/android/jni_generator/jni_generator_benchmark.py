@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# Copyright 2020 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Benchmarks jni_generator.py on a synthetic class with many JNI methods.
+
+Reports the time spent extracting the declarations from the java source and
+the time spent emitting the header, for each combination of the
+--enable_profiling and --enable_tracing options.
+
+Usage:
+    jni_generator_benchmark.py [--natives N] [--called_by_natives N]
+                               [--repeat R] [--profile]
+"""
+
+import cProfile
+import itertools
+import optparse
+import pstats
+import sys
+import time
+
+import jni_generator
+
+
+class _Options(object):
+  """The options object passed to jni_generator.py."""
+
+  def __init__(self, enable_profiling, enable_tracing):
+    self.namespace = None
+    self.script_name = 'base/android/jni_generator/jni_generator.py'
+    self.includes = 'base/android/jni_generator/jni_generator_helper.h'
+    self.ptr_type = 'long'
+    self.cpp = 'cpp'
+    self.javap = 'javap'
+    self.native_exports_optional = True
+    self.enable_profiling = enable_profiling
+    self.enable_tracing = enable_tracing
+    self.tracing_category = 'jni'
+    self.tracing_sampling_rate = 1
+    self.tracing_method_sampling_rate = []
+    self.enable_entry_points_table = False
+    self.extraction_cache_dir = None
+    self.jar_file = None
+
+
+# Parameter and return types of the generated methods, chosen to exercise
+# both the primitive and the JavaRef-wrapped code paths.
+_TYPES = ['int', 'long', 'boolean', 'String', 'Object', 'int[]', 'byte[]',
+          'String[]', 'List<String>', 'Runnable']
+
+
+def _MakeJavaSource(natives, called_by_natives):
+  """Returns the source of a class with the given number of methods."""
+  parts = ['package org.chromium.example.jni_generator;\n\n'
+           'import java.util.List;\n\n'
+           '@JNINamespace("base::android")\n'
+           'class Benchmark {\n']
+  for i in xrange(natives):
+    param_types = [_TYPES[(i + j) % len(_TYPES)] for j in xrange(i % 4)]
+    params = ''.join(', %s p%d' % (t, j) for j, t in enumerate(param_types))
+    return_type = (['void'] + _TYPES)[i % (len(_TYPES) + 1)]
+    if i % 2:
+      # A method, called on a native object.
+      parts.append('  private native %s nativeMethod%d(long nativeBenchmark%s);'
+                   '\n' % (return_type, i, params))
+    else:
+      parts.append('  private static native %s nativeFunction%d(%s);\n' %
+                   (return_type, i, params[2:]))
+  for i in xrange(called_by_natives):
+    param_types = [_TYPES[(i + j) % len(_TYPES)] for j in xrange(i % 4)]
+    params = ', '.join('%s p%d' % (t, j) for j, t in enumerate(param_types))
+    return_type = (['void'] + _TYPES)[i % (len(_TYPES) + 1)]
+    annotation = '@CalledByNativeUnchecked' if i % 3 == 0 else '@CalledByNative'
+    static = 'static ' if i % 2 else ''
+    parts.append('  %s\n  private %s%s calledByNative%d(%s) {}\n' %
+                 (annotation, static, return_type, i, params))
+  parts.append('}\n')
+  return ''.join(parts)
+
+
+def _Benchmark(contents, options, repeat):
+  """Returns the best extraction and emission times, in seconds."""
+  fully_qualified_class = 'org/chromium/example/jni_generator/Benchmark'
+  extraction_time = emission_time = float('inf')
+  for _ in xrange(repeat):
+    # Copy contents, so that the scan is not reused between runs.
+    contents = contents[:1] + contents[1:]
+    start = time.time()
+    model = jni_generator.JavaSourceModel(contents, fully_qualified_class,
+                                          options.ptr_type)
+    extracted = time.time()
+    jni_generator.JNIFromJavaSource(contents, fully_qualified_class, options,
+                                    model=model).GetContent()
+    emitted = time.time()
+    extraction_time = min(extraction_time, extracted - start)
+    emission_time = min(emission_time, emitted - extracted)
+  return extraction_time, emission_time
+
+
+def main(argv):
+  option_parser = optparse.OptionParser(usage=__doc__)
+  option_parser.add_option('--natives', type='int', default=5000,
+                           help='Number of native methods.')
+  option_parser.add_option('--called_by_natives', type='int', default=5000,
+                           help='Number of @CalledByNative methods.')
+  option_parser.add_option('--repeat', type='int', default=3,
+                           help='Number of runs, the best time is reported.')
+  option_parser.add_option('--profile', action='store_true',
+                           help='Print the profile of one run with the '
+                           'default options instead.')
+  options, _ = option_parser.parse_args(argv)
+
+  contents = _MakeJavaSource(options.natives, options.called_by_natives)
+  if options.profile:
+    profiler = cProfile.Profile()
+    profiler.runcall(_Benchmark, contents, _Options(False, False), 1)
+    pstats.Stats(profiler).sort_stats('cumulative').print_stats(30)
+    return
+
+  print '%d natives, %d called by natives, %d bytes of java source' % (
+      options.natives, options.called_by_natives, len(contents))
+  for enable_profiling, enable_tracing in itertools.product([False, True],
+                                                            repeat=2):
+    extraction_time, emission_time = _Benchmark(
+        contents, _Options(enable_profiling, enable_tracing), options.repeat)
+    print ('profiling=%-5s tracing=%-5s extraction %.3fs emission %.3fs' %
+           (enable_profiling, enable_tracing, extraction_time, emission_time))
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
@@ -7,6 +7,8 @@
 
 #include <jni.h>
 
+#include <atomic>
+
 #include "base/android/jni_android.h"
 #include "base/android/jni_int_wrapper.h"
 #include "base/android/scoped_java_ref.h"
@@ -39,8 +41,49 @@
 #define JNI_REGISTRATION_EXPORT
 #endif
 
+// Traces one out of |sampling_rate| calls of the enclosing function, used by
+// jni_generator.py --tracing_sampling_rate.
+#define JNI_TRACE_EVENT_SAMPLED(category, name, sampling_rate)            \
+  static std::atomic<unsigned int> jni_trace_event_calls(0);              \
+  struct JniTraceEventScope {                                             \
+    explicit JniTraceEventScope(bool is_sampled) : sampled(is_sampled) {  \
+      if (sampled)                                                        \
+        TRACE_EVENT_BEGIN0(category, name);                               \
+    }                                                                     \
+    ~JniTraceEventScope() {                                               \
+      if (sampled)                                                        \
+        TRACE_EVENT_END0(category, name);                                 \
+    }                                                                     \
+    const bool sampled;                                                   \
+  } jni_trace_event_scope(                                                \
+      jni_trace_event_calls.fetch_add(1, std::memory_order_relaxed) %     \
+          (sampling_rate) ==                                              \
+      0)
+
+// Tables of JNI entry points, generated with jni_generator.py
+// --enable_entry_points_table, are all placed in this section, so that a
+// native profiler can walk them between __start_jni_entry_points and
+// __stop_jni_entry_points.
+#define JNI_ENTRY_POINTS_TABLE \
+  static __attribute__((section("jni_entry_points"), used))
+
 namespace jni_generator {
 
+// An entry of the tables of JNI entry points.
+struct JniEntryPoint {
+  // The Java class, e.g. "org/chromium/foo/Foo$Inner".
+  const char* java_class;
+  // The Java method, "<init>" for constructors.
+  const char* java_method;
+  // The JNI signature of the Java method.
+  const char* signature;
+  // The generated function: the stub called by a Java native method, or the
+  // function calling a @CalledByNative Java method.
+  const void* function;
+  // Whether the function calls into Java.
+  bool calls_java;
+};
+
 inline void HandleRegistrationError(JNIEnv* env,
                                     jclass clazz,
                                     const char* filename) {
@@ -11,12 +11,19 @@ code generator and ensures the output matches a golden
 file.
 """
 
+import argparse
+import cPickle
 import difflib
 import inspect
 import optparse
 import os
+import re
+import shutil
+import struct
 import sys
+import tempfile
 import unittest
+import zipfile
 import jni_generator
 import jni_registration_generator
 from jni_generator import CalledByNative
@@ -47,6 +54,82 @@ class TestOptions(object):
     self.native_exports_optional = True
     self.enable_profiling = False
     self.enable_tracing = False
+    self.tracing_category = 'jni'
+    self.tracing_sampling_rate = 1
+    self.tracing_method_sampling_rate = []
+    self.enable_entry_points_table = False
+    self.extraction_cache_dir = None
+    self.jar_file = None
+
+
+_JAVAP_FLAGS = {
+    'ACC_PUBLIC': 0x0001,
+    'ACC_PRIVATE': 0x0002,
+    'ACC_PROTECTED': 0x0004,
+    'ACC_STATIC': 0x0008,
+    'ACC_FINAL': 0x0010,
+    'ACC_SYNCHRONIZED': 0x0020,
+    'ACC_NATIVE': 0x0100,
+    'ACC_ABSTRACT': 0x0400,
+}
+
+
+def _MembersFromJavaP7(contents):
+  """Returns the (flags, name, descriptor, value) of members in javap output."""
+  lines = contents.split('\n')
+  members = []
+  for i, line in enumerate(lines[:-2]):
+    if not lines[i + 2].startswith('    flags:'):
+      continue
+    declaration = line.rstrip(';').split('(')[0].split()
+    name = declaration[-1]
+    if name == '{}':
+      name = '<clinit>'
+    elif '.' in name:
+      name = '<init>'
+    descriptor = lines[i + 1].split(': ')[1]
+    flags = sum(_JAVAP_FLAGS.get(f.strip(), 0)
+                for f in lines[i + 2].split(':')[1].split(','))
+    value = re.match(r'\s*ConstantValue: int (-?\d+)', lines[i + 3])
+    members.append((flags, name, descriptor,
+                    int(value.group(1)) if value else None))
+  return members
+
+
+def _MakeClassFile(class_name, fields, methods):
+  """Returns a class file declaring the given (flags, name, descriptor, value).
+  """
+  constants = []
+  def AddConstant(tag, fmt, *values):
+    constants.append(struct.pack('>B' + fmt, tag, *values))
+    index = len(constants)
+    if tag == 5:
+      # Long constants take two entries.
+      constants.append('')
+    return index
+  def AddUtf8(value):
+    return AddConstant(1, 'H%ds' % len(value), len(value), value)
+
+  this_class = AddConstant(7, 'H', AddUtf8(class_name))
+  AddConstant(5, 'q', 1 << 40)
+  AddConstant(8, 'H', AddUtf8('unused'))
+  def Members(members):
+    data = struct.pack('>H', len(members))
+    for flags, name, descriptor, value in members:
+      attributes = [struct.pack('>HI', AddUtf8('Code'), 3) + 'abc']
+      if value is not None:
+        attributes.append(struct.pack('>HIH', AddUtf8('ConstantValue'), 2,
+                                      AddConstant(3, 'i', value)))
+      data += struct.pack('>HHHH', flags, AddUtf8(name), AddUtf8(descriptor),
+                          len(attributes))
+      data += ''.join(attributes)
+    return data
+  members = Members(fields) + Members(methods)
+  return (struct.pack('>IHHH', 0xCAFEBABE, 0, 49, len(constants) + 1) +
+          ''.join(constants) +
+          struct.pack('>HHHH', 0x0021, this_class, 0, 0) + members +
+          struct.pack('>H', 0))
+
 
 class TestGenerator(unittest.TestCase):
   def assertObjEquals(self, first, second):
@@ -840,6 +923,66 @@ public class java.util.HashSet {
       self.assertEquals(86, len(jni_from_javap.called_by_natives))
       self.assertGoldenTextEquals(jni_from_javap.GetContent())
 
+  def testFromClassFile(self):
+    contents = self._ReadGoldenFile(os.path.join(os.path.dirname(sys.argv[0]),
+        'testMotionEvent.javap7'))
+    members = _MembersFromJavaP7(contents)
+    fields = [m for m in members if '(' not in m[2]]
+    methods = [m for m in members if '(' in m[2]]
+    class_file = jni_generator.ClassFile(
+        _MakeClassFile('android/view/MotionEvent', fields, methods))
+    self.assertEquals(len(fields), len(class_file.fields))
+    self.assertEquals(len(methods), len(class_file.methods))
+    jni_from_class_file = jni_generator.JNIFromClassFile(class_file,
+                                                         TestOptions())
+    self.assertEquals(86, len(jni_from_class_file.called_by_natives))
+    # Same as parsing the output of javap.
+    self.assertTextEquals(
+        self._ReadGoldenFile(os.path.join(os.path.dirname(sys.argv[0]),
+                                          'testConstantsFromJavaP.golden')),
+        jni_from_class_file.GetContent())
+
+  def testFromJarFile(self):
+    temp_dir = tempfile.mkdtemp()
+    try:
+      class_data = _MakeClassFile(
+          'java/io/Foo', [(0x0019, 'BAR', 'I', 42)],
+          [(0x0001, '<init>', '()V', None), (0x0009, 'baz', '(J)V', None),
+           (0x0002, 'hidden', '()V', None)])
+      jar_file = os.path.join(temp_dir, 'foo.jar')
+      with zipfile.ZipFile(jar_file, 'w') as f:
+        f.writestr('java/io/Foo.class', class_data)
+      options = TestOptions()
+      options.jar_file = jar_file
+      options.jobs = 1
+      output_file = os.path.join(temp_dir, 'Foo_jni.h')
+      self.assertEquals([], jni_generator.GenerateJNIHeaders(
+          ['java/io/Foo.class'], [output_file], options))
+      with open(output_file) as f:
+        content = f.read()
+      self.assertEquals(jni_generator.JNIFromClassFile(
+          jni_generator.ClassFile(class_data), TestOptions()).GetContent(),
+          content)
+      self.assertIn('BAR = 42', content)
+      self.assertIn('Java_Foo_Constructor', content)
+      self.assertIn('Java_Foo_baz', content)
+      self.assertNotIn('hidden', content)
+    finally:
+      shutil.rmtree(temp_dir)
+
+  def testParseMethodDescriptor(self):
+    params, return_type = jni_generator.ParseMethodDescriptor(
+        '(I[[JLjava/lang/String;[Landroid/view/MotionEvent$PointerCoords;)V')
+    self.assertEquals(
+        ['int', 'long[][]', 'java/lang/String',
+         'android/view/MotionEvent$PointerCoords[]'],
+        [p.datatype for p in params])
+    self.assertEquals(['p0', 'p1', 'p2', 'p3'], [p.name for p in params])
+    self.assertEquals('void', return_type)
+    self.assertEquals(
+        ([], 'java/lang/Object[]'),
+        jni_generator.ParseMethodDescriptor('()[Ljava/lang/Object;'))
+
   def testREForNatives(self):
     # We should not match "native SyncSetupFlow" inside the comment.
     test_data = """
@@ -1156,6 +1299,311 @@ class Foo {
                                                     options_with_tracing)
     self.assertGoldenTextEquals(jni_from_java.GetContent())
 
+  def testTracingSampling(self):
+    test_data = """
+    package org.chromium.foo;
+
+    class Foo {
+    @CalledByNative
+    void callbackFromNative();
+
+    @CalledByNative
+    void hotCallbackFromNative();
+
+    @CalledByNative
+    void untracedCallbackFromNative();
+
+    static native void nativeStaticMethod();
+    }
+    """
+    options = TestOptions()
+    options.enable_tracing = True
+    options.tracing_category = 'jni_foo'
+    options.tracing_sampling_rate = 10
+    options.tracing_method_sampling_rate = [('*.hot*', 1000),
+                                            ('*.untraced*', 0),
+                                            ('*.callback*', 1)]
+    jni_from_java = jni_generator.JNIFromJavaSource(test_data,
+                                                    'org/chromium/foo/Foo',
+                                                    options)
+    self.assertGoldenTextEquals(jni_from_java.GetContent())
+
+  def testEntryPointsTable(self):
+    test_data = """
+    package org.chromium.foo;
+
+    @JNINamespace("org::chromium_foo")
+    class Foo {
+    @CalledByNative
+    Foo();
+
+    @CalledByNative
+    static int callbackFromNative(String s, long[] values);
+
+    native void nativeInstanceMethod(long nativeInstance, Object o);
+
+    static native boolean nativeStaticMethod(int x);
+
+    class Inner {
+      @CalledByNative("Inner")
+      void innerCallback();
+    }
+    }
+    """
+    options = TestOptions()
+    options.enable_entry_points_table = True
+    jni_from_java = jni_generator.JNIFromJavaSource(test_data,
+                                                    'org/chromium/foo/Foo',
+                                                    options)
+    self.assertGoldenTextEquals(jni_from_java.GetContent())
+
+
+  def testGenerateJNIHeaders(self):
+    temp_dir = tempfile.mkdtemp()
+    try:
+      input_files = []
+      for class_name in ('Foo', 'Bar'):
+        input_file = os.path.join(temp_dir, class_name + '.java')
+        with open(input_file, 'w') as f:
+          f.write("""
+    package org.chromium.foo;
+    class %s {
+      private native int nativeInit();
+    }
+    """ % class_name)
+        input_files.append(input_file)
+      output_files = [jni_generator.GetOutputFileName(f, temp_dir)
+                      for f in input_files]
+      options = TestOptions()
+      options.jobs = 2
+      self.assertEquals(
+          [], jni_generator.GenerateJNIHeaders(input_files, output_files,
+                                               options))
+      for input_file, output_file in zip(input_files, output_files):
+        with open(output_file) as f:
+          self.assertEquals(
+              jni_generator.JNIFromJavaSource.CreateFromFile(
+                  input_file, options).GetContent(), f.read())
+
+      # Unchanged headers are not rewritten.
+      os.utime(output_files[0], (0, 0))
+      jni_generator.GenerateJNIHeaders(input_files, output_files, options)
+      self.assertEquals(0, os.path.getmtime(output_files[0]))
+
+      with open(input_files[1], 'w') as f:
+        f.write('class Bar { private native void nativeFoo(int a, int b); }')
+      errors = jni_generator.GenerateJNIHeaders(input_files, output_files,
+                                                options)
+      self.assertEquals(1, len(errors))
+      self.assertTrue(errors[0].startswith(input_files[1]))
+    finally:
+      shutil.rmtree(temp_dir)
+
+  def testExtractionCache(self):
+    temp_dir = tempfile.mkdtemp()
+    try:
+      java_file = os.path.join(temp_dir, 'Foo.java')
+      with open(java_file, 'w') as f:
+        f.write("""
+    package org.chromium.foo;
+    class Foo {
+      private native int nativeInit();
+      @CalledByNative
+      static void bar() {}
+    }
+    """)
+      options = TestOptions()
+      expected = jni_generator.JNIFromJavaSource.CreateFromFile(
+          java_file, options).GetContent()
+      options.extraction_cache_dir = os.path.join(temp_dir, 'cache')
+      self.assertEquals(expected,
+                        jni_generator.JNIFromJavaSource.CreateFromFile(
+                            java_file, options).GetContent())
+
+      # Cached files are not parsed again, also by the registration generator.
+      parsed = []
+      java_source_scan = jni_generator.JavaSourceScan
+      def record(contents):
+        parsed.append(contents)
+        return java_source_scan(contents)
+      jni_generator.JavaSourceScan = record
+      try:
+        self.assertEquals(expected,
+                          jni_generator.JNIFromJavaSource.CreateFromFile(
+                              java_file, options).GetContent())
+        model = jni_generator.ParseJavaSourceFile(
+            java_file, 'long', options.extraction_cache_dir)
+        self.assertEquals([], parsed)
+        self.assertEquals('org/chromium/foo/Foo', model.fully_qualified_class)
+        self.assertEquals(['Init'], [n.name for n in model.natives])
+        self.assertEquals(['bar'], [c.name for c in model.called_by_natives])
+
+        with open(java_file, 'a') as f:
+          f.write('\n')
+        jni_generator.ParseJavaSourceFile(java_file, 'long',
+                                          options.extraction_cache_dir)
+        self.assertEquals(1, len(parsed))
+      finally:
+        jni_generator.JavaSourceScan = java_source_scan
+    finally:
+      shutil.rmtree(temp_dir)
+
+  def testRegistrationSkipsFilesWithoutNatives(self):
+    temp_dir = tempfile.mkdtemp()
+    try:
+      java_files = []
+      for class_name, contents in (
+          ('Foo', 'package org.chromium.foo;\n'
+                  'class Foo { private native int nativeInit(); }\n'),
+          # Neither a "package" line, nor a parsable @CalledByNative.
+          ('Bar', 'class Bar {\n  @CalledByNative\n  int field = 3;\n}\n')):
+        java_file = os.path.join(temp_dir, class_name + '.java')
+        with open(java_file, 'w') as f:
+          f.write(contents)
+        java_files.append(java_file)
+
+      for cache_dir in (None, os.path.join(temp_dir, 'cache')):
+        args = argparse.Namespace(no_register_java=[],
+                                  extraction_cache_dir=cache_dir,
+                                  fragments_file=None)
+        output_file = os.path.join(temp_dir, 'output.h')
+        jni_registration_generator.GenerateJNIHeader(java_files, output_file,
+                                                     args)
+        with open(output_file) as f:
+          self.assertIn('nativeInit', f.read())
+    finally:
+      shutil.rmtree(temp_dir)
+
+  def testRegistrationExtractionCache(self):
+    temp_dir = tempfile.mkdtemp()
+    try:
+      java_files = []
+      for class_name, contents in (
+          ('Foo', 'package org.chromium.foo;\n'
+                  'class Foo { private native int nativeInit(); }\n'),
+          ('Bar', 'class Bar {\n  // Not native.\n  void bar() {}\n}\n'),
+          ('Baz', 'class Baz {}\n')):
+        java_file = os.path.join(temp_dir, class_name + '.java')
+        with open(java_file, 'w') as f:
+          f.write(contents)
+        java_files.append(java_file)
+
+      cache_dir = os.path.join(temp_dir, 'cache')
+      expected = [jni_registration_generator._DictForPath(java_file)
+                  for java_file in java_files]
+      self.assertEquals(expected,
+                        [jni_registration_generator._DictForPath(java_file,
+                                                                 cache_dir)
+                         for java_file in java_files])
+      self.assertEquals([True, None, None], [d and True for d in expected])
+
+      # Neither files with natives, nor files without are scanned again. The
+      # registration generator imports jni_generator by its full name.
+      registration_jni_generator = jni_registration_generator.jni_generator
+      parsed = []
+      java_source_scan = registration_jni_generator.JavaSourceScan
+      def record(contents):
+        parsed.append(contents)
+        return java_source_scan(contents)
+      registration_jni_generator.JavaSourceScan = record
+      try:
+        self.assertEquals(expected,
+                          [jni_registration_generator._DictForPath(java_file,
+                                                                   cache_dir)
+                           for java_file in java_files])
+      finally:
+        registration_jni_generator.JavaSourceScan = java_source_scan
+      self.assertEquals([], parsed)
+    finally:
+      shutil.rmtree(temp_dir)
+
+  def testParseErrorPickling(self):
+    error = cPickle.loads(cPickle.dumps(
+        jni_generator.ParseError('description', 'line 1', 'line 2')))
+    self.assertEquals('description', error.description)
+    self.assertEquals(('line 1', 'line 2'), error.context_lines)
+
+
+  def testIncrementalRegistration(self):
+    temp_dir = tempfile.mkdtemp()
+    try:
+      java_files = []
+      for class_name in ('Foo', 'Bar', 'Baz'):
+        java_file = os.path.join(temp_dir, class_name + '.java')
+        with open(java_file, 'w') as f:
+          f.write("""
+    package org.chromium.foo;
+    class %s {
+      private native int nativeInit();
+    }
+    """ % class_name)
+        java_files.append(java_file)
+
+      def Generate(fragments_file, output_name):
+        args = argparse.Namespace(no_register_java=[],
+                                  extraction_cache_dir=None,
+                                  fragments_file=fragments_file)
+        output_file = os.path.join(temp_dir, output_name)
+        jni_registration_generator.GenerateJNIHeader(java_files, output_file,
+                                                     args)
+        with open(output_file) as f:
+          return f.read()
+
+      fragments_file = os.path.join(temp_dir, 'fragments')
+      self.assertEquals(Generate(None, 'full.h'),
+                        Generate(fragments_file, 'incremental.h'))
+
+      # Only changed files are parsed again.
+      with open(java_files[1], 'a') as f:
+        f.write('class Qux { private native void nativeQux(); }')
+      parsed = []
+      dict_for_path = jni_registration_generator._DictForPath
+      def record(path, cache_dir=None):
+        parsed.append(path)
+        return dict_for_path(path, cache_dir)
+      jni_registration_generator._DictForPath = record
+      try:
+        incremental = Generate(fragments_file, 'incremental.h')
+      finally:
+        jni_registration_generator._DictForPath = dict_for_path
+      self.assertEquals([java_files[1]], parsed)
+      self.assertEquals(Generate(None, 'full.h'), incremental)
+      self.assertIn('nativeQux', incremental)
+    finally:
+      shutil.rmtree(temp_dir)
+
+  def testIncrementalRegistrationErrors(self):
+    temp_dir = tempfile.mkdtemp()
+    try:
+      java_files = []
+      for class_name, contents in (
+          ('Foo', 'package org.chromium.foo;\n'
+                  'class Foo { private native int nativeInit(); }\n'),
+          ('Bar', 'package org.chromium.foo;\n'
+                  'class Bar {\n'
+                  '  private native int nativeInit();\n'
+                  '  @CalledByNative\n'
+                  '  int field = 3;\n'
+                  '}\n')):
+        java_file = os.path.join(temp_dir, class_name + '.java')
+        with open(java_file, 'w') as f:
+          f.write(contents)
+        java_files.append(java_file)
+
+      fragments_file = os.path.join(temp_dir, 'fragments')
+      args = argparse.Namespace(no_register_java=[],
+                                extraction_cache_dir=None,
+                                fragments_file=fragments_file)
+      with self.assertRaises(SyntaxError) as context:
+        jni_registration_generator.GenerateJNIHeader(
+            java_files, os.path.join(temp_dir, 'output.h'), args)
+      message = str(context.exception)
+      self.assertTrue(message.startswith(java_files[1] + ': '), message)
+      self.assertIn('could not parse @CalledByNative', message)
+      self.assertFalse(os.path.exists(fragments_file))
+    finally:
+      shutil.rmtree(temp_dir)
+
 
 def TouchStamp(stamp_path):
   dir_name = os.path.dirname(stamp_path)
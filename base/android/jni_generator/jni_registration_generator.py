@@ -10,7 +10,11 @@ RegisterNonMainDexNatives(). Together, these will use manual JNI registration
 to register all native methods that exist within an application."""
 
 import argparse
+import cPickle
+import functools
+import hashlib
 import multiprocessing
+import os
 import string
 import sys
 
@@ -41,12 +45,13 @@ def GenerateJNIHeader(java_file_paths, output_file, args):
       output_file: A relative path to output file.
       args: All input arguments.
   """
-  # Without multiprocessing, script takes ~13 seconds for chrome_public_apk
-  # on a z620. With multiprocessing, takes ~2 seconds.
-  pool = multiprocessing.Pool()
-  paths = (p for p in java_file_paths if p not in args.no_register_java)
-  results = [d for d in pool.imap_unordered(_DictForPath, paths) if d]
-  pool.close()
+  paths = [p for p in java_file_paths if p not in args.no_register_java]
+  if args.fragments_file:
+    fragments = _UpdateFragmentsFile(args.fragments_file, paths,
+                                     args.extraction_cache_dir)
+  else:
+    fragments = _DictsForPaths(paths, args.extraction_cache_dir)
+  results = [fragments[p] for p in paths if fragments[p]]
 
   # Sort to make output deterministic.
   results.sort(key=lambda d: d['FULL_CLASS_NAME'])
@@ -62,20 +67,97 @@ def GenerateJNIHeader(java_file_paths, output_file, args):
     print(header_content)
 
 
-def _DictForPath(path):
-  with open(path) as f:
-    contents = jni_generator.RemoveComments(f.read())
-  natives = jni_generator.ExtractNatives(contents, 'long')
-  if len(natives) == 0:
+def _DictsForPaths(paths, cache_dir):
+  """Returns a {path: _DictForPath(path)} dict.
+
+  Raises:
+    SyntaxError: listing the files which could not be parsed.
+  """
+  dict_for_path = functools.partial(_DictForPathOrError, cache_dir=cache_dir)
+  if len(paths) <= 1:
+    results = map(dict_for_path, paths)
+  else:
+    # Without multiprocessing, script takes ~13 seconds for chrome_public_apk
+    # on a z620. With multiprocessing, takes ~2 seconds.
+    pool = multiprocessing.Pool()
+    try:
+      results = pool.map(dict_for_path, paths)
+    finally:
+      pool.close()
+      pool.join()
+  errors = [error for _, error in results if error]
+  if errors:
+    raise SyntaxError('\n'.join(errors))
+  return dict(zip(paths, (d for d, _ in results)))
+
+
+def _GetFragmentsVersion():
+  """Returns a digest of the code generating the fragments."""
+  digest = hashlib.sha1()
+  for module in (jni_generator, sys.modules[__name__]):
+    with open(os.path.splitext(module.__file__)[0] + '.py') as f:
+      digest.update(f.read())
+  return digest.hexdigest()
+
+
+def _UpdateFragmentsFile(fragments_file, paths, cache_dir):
+  """Returns _DictsForPaths(paths), only parsing files changed since last run.
+
+  fragments_file stores the fragments of the previous run, that is the
+  MERGEABLE_KEYS pieces and FULL_CLASS_NAME of each java file, with the digest
+  of its content.
+  """
+  version = _GetFragmentsVersion()
+  stored = {}
+  if os.path.exists(fragments_file):
+    try:
+      with open(fragments_file, 'rb') as f:
+        stored_version, stored = cPickle.load(f)
+      if stored_version != version:
+        stored = {}
+    except (EOFError, ValueError, cPickle.UnpicklingError):
+      stored = {}
+
+  entries = {}
+  changed_paths = []
+  for path in paths:
+    if path in entries:
+      continue
+    with open(path) as f:
+      digest = hashlib.sha1(f.read()).hexdigest()
+    entry = stored.get(path)
+    if entry and entry[0] == digest:
+      entries[path] = entry
+    else:
+      entries[path] = (digest, None)
+      changed_paths.append(path)
+  for path, fragment in _DictsForPaths(changed_paths, cache_dir).iteritems():
+    entries[path] = (entries[path][0], fragment)
+
+  if entries != stored:
+    tmp_file = '%s.%d.tmp' % (fragments_file, os.getpid())
+    with open(tmp_file, 'wb') as f:
+      cPickle.dump((version, entries), f, cPickle.HIGHEST_PROTOCOL)
+    os.rename(tmp_file, fragments_file)
+  return dict((path, entry[1]) for path, entry in entries.iteritems())
+
+
+def _DictForPathOrError(path, cache_dir=None):
+  """Returns (_DictForPath(path), None), or (None, an error message)."""
+  try:
+    return _DictForPath(path, cache_dir), None
+  except (jni_generator.ParseError, SyntaxError) as e:
+    return None, '%s: %s' % (path, e)
+
+
+def _DictForPath(path, cache_dir=None):
+  model = jni_generator.ParseJavaSourceFile(path, 'long', cache_dir,
+                                            natives_only=True)
+  if model is None:
     return None
-  namespace = jni_generator.ExtractJNINamespace(contents)
-  fully_qualified_class = jni_generator.ExtractFullyQualifiedJavaClassName(
-      path, contents)
-  jni_params = jni_generator.JniParams(fully_qualified_class)
-  jni_params.ExtractImportsAndInnerClasses(contents)
-  main_dex = jni_generator.IsMainDexJavaClass(contents)
   header_generator = HeaderGenerator(
-      namespace, fully_qualified_class, natives, jni_params, main_dex)
+      model.namespace, model.fully_qualified_class, model.natives,
+      model.jni_params, model.main_dex)
   return header_generator.Generate()
 
 
@@ -315,6 +397,14 @@ def main(argv):
                           'file paths. Must be used with --output.')
   arg_parser.add_argument('--output',
                           help='The output file path.')
+  arg_parser.add_argument('--extraction_cache_dir',
+                          help='A directory caching the declarations parsed '
+                          'from Java files across runs. May be shared with '
+                          'jni_generator.py.')
+  arg_parser.add_argument('--fragments_file',
+                          help='A file storing the registration fragments of '
+                          'each Java file across runs, so that only changed '
+                          'files are parsed again.')
   arg_parser.add_argument('--no_register_java',
                           help='A list of Java files which should be ignored '
                           'by the parser.', default=[])
@@ -330,7 +420,11 @@ def main(argv):
     # java_file_paths stores each Java file path as a string.
     java_file_paths += build_utils.ReadSourcesList(f)
   output_file = args.output
-  GenerateJNIHeader(java_file_paths, output_file, args)
+  try:
+    GenerateJNIHeader(java_file_paths, output_file, args)
+  except SyntaxError as e:
+    print(e)
+    return 1
 
   if args.depfile:
     build_utils.WriteDepfile(args.depfile, output_file,
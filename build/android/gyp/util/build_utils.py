@@ -561,6 +561,9 @@ def CallAndWriteDepfileIfStale(function, options, record_path=None,
   in depfile_deps. It's important to write paths to the depfile that are already
   captured by GN deps since GN args can cause GN deps to change, and such
   changes are not immediately reflected in depfiles (http://crbug.com/589311).
+
+  Digests of input files are shared with the other steps of the build through
+  MD5_CHECK_DIGEST_CACHE_DIR, see md5_check.CallAndRecordIfStale().
   """
   if not output_paths:
     raise Exception('At least one output_path must be specified.')
@@ -2,13 +2,22 @@
 # Use of this source code is governed by a BSD-style license that can be
 # found in the LICENSE file.
 
+import binascii
 import difflib
 import hashlib
 import itertools
 import json
+import marshal
+import mmap
+import multiprocessing
+import multiprocessing.pool
 import os
+import struct
 import sys
+import tempfile
+import time
 import zipfile
+import zlib
 
 
 # When set and a difference is detected, a diff of what changed is printed.
@@ -17,6 +26,21 @@ PRINT_EXPLANATIONS = int(os.environ.get('PRINT_BUILD_EXPLANATIONS', 0))
 # An escape hatch that causes all targets to be rebuilt.
 _FORCE_REBUILD = int(os.environ.get('FORCE_REBUILD', 0))
 
+# When set, the digests of input files are cached in this directory, which can
+# be shared by all the steps of a build, see _DigestCache.
+_DIGEST_CACHE_DIR = os.environ.get('MD5_CHECK_DIGEST_CACHE_DIR')
+
+# The number of threads hashing input files. Defaults to the number of CPUs.
+_JOBS = int(os.environ.get('MD5_CHECK_JOBS', 0))
+
+# The digest of input files: 'md5', or 'crc32' which is several times faster
+# and detects changes as well, but is not collision resistant.
+_FILE_DIGEST = os.environ.get('MD5_CHECK_FILE_DIGEST', 'md5')
+
+# Files of at least this size are read through a memory map, and hashed in a
+# single call, which does not hold the GIL.
+_MMAP_MIN_SIZE = 2**20
+
 
 def CallAndRecordIfStale(
     function, record_path=None, input_paths=None, input_strings=None,
@@ -31,6 +55,12 @@ def CallAndRecordIfStale(
   To debug which files are out-of-date, set the environment variable:
       PRINT_MD5_DIFFS=1
 
+  To avoid hashing unchanged input files again in every process, set the
+  environment variable MD5_CHECK_DIGEST_CACHE_DIR to a directory, which can be
+  shared by all the steps of a build. Input files are hashed by
+  MD5_CHECK_JOBS threads, with the MD5_CHECK_FILE_DIGEST digest ('md5' or
+  'crc32').
+
   Args:
     function: The function to call.
     record_path: Path to record metadata.
@@ -55,21 +85,21 @@ def CallAndRecordIfStale(
   new_metadata = _Metadata()
   new_metadata.AddStrings(input_strings)
 
+  input_tags = _ComputeInputTags(input_paths)
   for path in input_paths:
     if _IsZipFile(path):
-      entries = _ExtractZipEntries(path)
-      new_metadata.AddZipFile(path, entries)
+      new_metadata.AddZipFile(path, input_tags[path])
     else:
-      new_metadata.AddFile(path, _Md5ForPath(path))
+      new_metadata.AddFile(path, input_tags[path])
 
   old_metadata = None
   force = force or _FORCE_REBUILD
   missing_outputs = [x for x in output_paths if force or not os.path.exists(x)]
   # When outputs are missing, don't bother gathering change information.
   if not missing_outputs and os.path.exists(record_path):
-    with open(record_path, 'r') as jsonfile:
+    with open(record_path, 'rb') as stampfile:
       try:
-        old_metadata = _Metadata.FromFile(jsonfile)
+        old_metadata = _Metadata.FromFile(stampfile)
       except:  # pylint: disable=bare-except
         pass  # Not yet using new file format.
 
@@ -86,7 +116,10 @@ def CallAndRecordIfStale(
   args = (changes,) if pass_changes else ()
   function(*args)
 
-  with open(record_path, 'w') as f:
+  if pass_changes and old_metadata:
+    # The changes may still be queried once the stamp is overwritten.
+    old_metadata.LoadStampBody()
+  with open(record_path, 'wb') as f:
     new_metadata.ToFile(f)
 
 
@@ -223,7 +256,7 @@ class Changes(object):
 
 class _Metadata(object):
   """Data model for tracking change metadata."""
-  # Schema:
+  # Schema of the JSON export, and of the body of stamp files:
   # {
   #   "files-md5": "VALUE",
   #   "strings-md5": "VALUE",
@@ -241,6 +274,17 @@ class _Metadata(object):
   #   ],
   #   "input-strings": ["a", "b", ...],
   # }
+  #
+  # Stamp files start with a fixed size header (_STAMP_HEADER):
+  #   magic, format version, files md5, strings md5 (as 16 bytes digests),
+  #   size of the body.
+  # The body is the zlib compressed compact JSON of "input-files" and
+  # "input-strings". It is only read and parsed when the digests of the header
+  # differ from the current ones, and the changes need to be described.
+  _STAMP_MAGIC = b'md5stamp'
+  _STAMP_VERSION = 1
+  _STAMP_HEADER = struct.Struct('<8sB16s16sI')
+
   def __init__(self):
     self._files_md5 = None
     self._strings_md5 = None
@@ -248,20 +292,51 @@ class _Metadata(object):
     self._strings = []
     # Map of (path, subpath) -> entry. Created upon first call to _GetEntry().
     self._file_map = None
+    # Path of the stamp file whose body LoadStampBody() has yet to read.
+    self._stamp_path = None
 
   @classmethod
   def FromFile(cls, fileobj):
-    """Returns a _Metadata initialized from a file object."""
+    """Returns a _Metadata initialized from a stamp file or a JSON export.
+
+    Only the header of stamp files is read here, the body is read from the
+    same path by LoadStampBody() when needed.
+    """
     ret = cls()
-    obj = json.load(fileobj)
-    ret._files_md5 = obj['files-md5']
-    ret._strings_md5 = obj['strings-md5']
-    ret._files = obj['input-files']
-    ret._strings = obj['input-strings']
+    data = fileobj.read(cls._STAMP_HEADER.size)
+    if not data.startswith(cls._STAMP_MAGIC):
+      obj = json.loads(data + fileobj.read())
+      ret._files_md5 = obj['files-md5']
+      ret._strings_md5 = obj['strings-md5']
+      ret._files = obj['input-files']
+      ret._strings = obj['input-strings']
+      return ret
+    _, version, files_md5, strings_md5, body_size = (
+        cls._STAMP_HEADER.unpack(data))
+    if version != cls._STAMP_VERSION:
+      raise ValueError('Unsupported stamp version: %d' % version)
+    if os.fstat(fileobj.fileno()).st_size != len(data) + body_size:
+      raise ValueError('Truncated stamp file')
+    ret._stamp_path = fileobj.name
+    ret._files_md5 = binascii.hexlify(files_md5).decode('ascii')
+    ret._strings_md5 = binascii.hexlify(strings_md5).decode('ascii')
     return ret
 
   def ToFile(self, fileobj):
-    """Serializes metadata to the given file object."""
+    """Serializes metadata to the given binary file object, as a stamp."""
+    body = zlib.compress(json.dumps({
+        "input-files": self._files,
+        "input-strings": self._strings,
+    }, separators=(',', ':')).encode('utf-8'), 1)
+    fileobj.write(self._STAMP_HEADER.pack(
+        self._STAMP_MAGIC, self._STAMP_VERSION,
+        binascii.unhexlify(self.FilesMd5()),
+        binascii.unhexlify(self.StringsMd5()), len(body)))
+    fileobj.write(body)
+
+  def ToJsonFile(self, fileobj):
+    """Serializes metadata to the given file object, as readable JSON."""
+    self.LoadStampBody()
     obj = {
         "files-md5": self.FilesMd5(),
         "strings-md5": self.StringsMd5(),
@@ -270,6 +345,20 @@ class _Metadata(object):
     }
     json.dump(obj, fileobj, indent=2)
 
+  def LoadStampBody(self):
+    """Reads the body of the stamp file this was read from, if not yet.
+
+    Must be called before the stamp file is overwritten, if still queried.
+    """
+    if self._stamp_path is not None:
+      with open(self._stamp_path, 'rb') as stampfile:
+        stampfile.seek(self._STAMP_HEADER.size)
+        body = stampfile.read()
+      obj = json.loads(zlib.decompress(body).decode('utf-8'))
+      self._files = obj['input-files']
+      self._strings = obj['input-strings']
+      self._stamp_path = None
+
   def _AssertNotQueried(self):
     assert self._files_md5 is None
     assert self._strings_md5 is None
@@ -310,6 +399,7 @@ class _Metadata(object):
 
   def GetStrings(self):
     """Returns the list of input strings."""
+    self.LoadStampBody()
     return self._strings
 
   def FilesMd5(self):
@@ -329,6 +419,7 @@ class _Metadata(object):
   def _GetEntry(self, path, subpath=None):
     """Returns the JSON entry for the given path / subpath."""
     if self._file_map is None:
+      self.LoadStampBody()
       self._file_map = {}
       for entry in self._files:
         self._file_map[(entry['path'], None)] = entry
@@ -343,6 +434,7 @@ class _Metadata(object):
 
   def IterPaths(self):
     """Returns a generator for all top-level paths."""
+    self.LoadStampBody()
     return (e['path'] for e in self._files)
 
   def IterSubpaths(self, path):
@@ -358,28 +450,187 @@ class _Metadata(object):
     return (entry['path'] for entry in subentries)
 
 
-def _UpdateMd5ForFile(md5, path, block_size=2**16):
+class _DigestCache(object):
+  """Caches the digests of files, keyed by (path, size, mtime, inode).
+
+  Digests are kept in memory, and when a cache directory is given, in one file
+  per path, which is replaced atomically, so that the directory can be shared
+  by concurrent processes. Files are then only hashed once per build, rather
+  than by every step using them.
+  """
+  # A file modified less than this before being hashed may be modified again
+  # without changing its mtime, on file systems with coarse timestamps. Its
+  # digest is only trusted once computed again later.
+  _RACY_WINDOW_NS = 2 * 10**9
+
+  def __init__(self, cache_dir=None):
+    self._cache_dir = cache_dir
+    # Map of path -> (key, digest).
+    self._entries = {}
+
+  def _GetEntryPath(self, path):
+    return os.path.join(self._cache_dir,
+                        hashlib.md5(os.path.abspath(path)).hexdigest())
+
+  def _ReadEntry(self, path):
+    try:
+      with open(self._GetEntryPath(path), 'rb') as f:
+        return marshal.load(f)
+    except Exception:  # pylint: disable=broad-except
+      # Missing, or written by another version of python.
+      return None
+
+  def _WriteEntry(self, path, entry):
+    try:
+      fd, tmp_path = tempfile.mkstemp(dir=self._cache_dir)
+      with os.fdopen(fd, 'wb') as f:
+        marshal.dump(entry, f)
+      os.rename(tmp_path, self._GetEntryPath(path))
+    except (IOError, OSError):
+      pass  # The cache is best effort.
+
+  def Get(self, path, compute_digest):
+    """Returns compute_digest(path), or its cached value.
+
+    Args:
+      path: Path to a file.
+      compute_digest: The function computing the digest of the file.
+    """
+    stat = os.stat(path)
+    key = (stat.st_size, _GetMtimeNs(stat), stat.st_ino,
+           compute_digest.__name__)
+    entry = self._entries.get(path)
+    if entry is None and self._cache_dir:
+      entry = self._ReadEntry(path)
+    if entry is not None and entry[0] == key:
+      return entry[1]
+
+    hash_time_ns = int(time.time() * 1e9)
+    digest = compute_digest(path)
+    if hash_time_ns - key[1] > self._RACY_WINDOW_NS:
+      entry = (key, digest)
+      self._entries[path] = entry
+      if self._cache_dir:
+        self._WriteEntry(path, entry)
+    return digest
+
+
+_digest_cache = None
+
+
+def _GetDigestCache():
+  """Returns the _DigestCache of the process."""
+  global _digest_cache
+  if _digest_cache is None:
+    if _DIGEST_CACHE_DIR and not os.path.isdir(_DIGEST_CACHE_DIR):
+      try:
+        os.makedirs(_DIGEST_CACHE_DIR)
+      except OSError:
+        pass  # Created by a concurrent process.
+    _digest_cache = _DigestCache(_DIGEST_CACHE_DIR)
+  return _digest_cache
+
+
+def _GetMtimeNs(stat):
+  """Returns the mtime of a stat result, in nanoseconds."""
+  if hasattr(stat, 'st_mtime_ns'):
+    return stat.st_mtime_ns
+  return int(stat.st_mtime * 1e9)
+
+
+def _UpdateDigestForFile(update, path, block_size=2**20):
+  """Calls update() with the contents of the file, in one or more blocks."""
   with open(path, 'rb') as infile:
+    if os.fstat(infile.fileno()).st_size >= _MMAP_MIN_SIZE:
+      contents = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+      try:
+        update(contents)
+      finally:
+        contents.close()
+      return
     while True:
       data = infile.read(block_size)
       if not data:
         break
-      md5.update(data)
+      update(data)
 
 
-def _UpdateMd5ForDirectory(md5, dir_path):
-  for root, _, files in os.walk(dir_path):
-    for f in files:
-      _UpdateMd5ForFile(md5, os.path.join(root, f))
+def _Md5ForFile(path):
+  md5 = hashlib.md5()
+  _UpdateDigestForFile(md5.update, path)
+  return md5.hexdigest()
 
 
-def _Md5ForPath(path):
-  md5 = hashlib.md5()
-  if os.path.isdir(path):
-    _UpdateMd5ForDirectory(md5, path)
+def _Crc32ForFile(path):
+  crc = [0]
+
+  def Update(data):
+    crc[0] = zlib.crc32(data, crc[0])
+
+  _UpdateDigestForFile(Update, path)
+  return 'crc32:%08x:%d' % (crc[0] & 0xffffffff, os.path.getsize(path))
+
+
+_FILE_DIGEST_FUNCTIONS = {
+    'md5': _Md5ForFile,
+    'crc32': _Crc32ForFile,
+}
+
+
+def _ListDirectoryFiles(dir_path):
+  """Returns the paths of all files within the directory."""
+  return [os.path.join(root, f)
+          for root, _, files in os.walk(dir_path) for f in files]
+
+
+def _ComputeInputTags(input_paths):
+  """Returns a dict of input path -> tag, or entries for zip files.
+
+  The tag of a directory is computed from the tags of the files it contains.
+  All files are hashed by a pool of threads, as hashing large blocks and
+  reading files release the GIL.
+  """
+  digest_cache = _GetDigestCache()
+  file_digest_function = _FILE_DIGEST_FUNCTIONS[_FILE_DIGEST]
+  directory_files = {}
+  # (path, is_zip) tuples.
+  files = []
+  for path in input_paths:
+    if _IsZipFile(path):
+      files.append((path, True))
+    elif os.path.isdir(path):
+      directory_files[path] = _ListDirectoryFiles(path)
+      files.extend((f, False) for f in directory_files[path])
+    else:
+      files.append((path, False))
+
+  def ComputeTag(path_and_is_zip):
+    path, is_zip = path_and_is_zip
+    if is_zip:
+      return digest_cache.Get(path, _ExtractZipEntries)
+    return digest_cache.Get(path, file_digest_function)
+
+  jobs = min(_JOBS or multiprocessing.cpu_count(), len(files))
+  if jobs > 1:
+    pool = multiprocessing.pool.ThreadPool(jobs)
+    try:
+      tags = pool.map(ComputeTag, files)
+    finally:
+      pool.close()
   else:
-    _UpdateMd5ForFile(md5, path)
-  return md5.hexdigest()
+    tags = [ComputeTag(f) for f in files]
+
+  file_tags = dict(zip(files, tags))
+  input_tags = {}
+  for path in input_paths:
+    if _IsZipFile(path):
+      input_tags[path] = file_tags[(path, True)]
+    elif path in directory_files:
+      input_tags[path] = _ComputeInlineMd5(
+          file_tags[(f, False)] for f in directory_files[path])
+    else:
+      input_tags[path] = file_tags[(path, False)]
+  return input_tags
 
 
 def _ComputeInlineMd5(iterable):
@@ -408,3 +659,15 @@ def _ExtractZipEntries(path):
         entries.append(
             (zip_info.filename, zip_info.CRC + zip_info.compress_type))
   return entries
+
+
+def main(argv):
+  """Prints the given stamp files as JSON, for debugging."""
+  for path in argv[1:]:
+    with open(path, 'rb') as stampfile:
+      _Metadata.FromFile(stampfile).ToJsonFile(sys.stdout)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
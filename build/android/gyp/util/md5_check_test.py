@@ -4,7 +4,10 @@
 # found in the LICENSE file.
 
 import fnmatch
+import os
+import shutil
 import tempfile
+import time
 import unittest
 import zipfile
 
@@ -139,6 +142,142 @@ class TestMd5Check(unittest.TestCase):
                                         input_file2.name, 'path/1.txt'),
                        added_or_modified_only=False)
 
+  def testDigestCache(self):
+    cache_dir = tempfile.mkdtemp()
+    try:
+      input_file = tempfile.NamedTemporaryFile(suffix='.txt')
+      input_file.write('input file')
+      input_file.flush()
+      mtime = time.time() - 10
+      os.utime(input_file.name, (mtime, mtime))
+      hashed_paths = []
+
+      def ComputeDigest(path):
+        hashed_paths.append(path)
+        return md5_check._Md5ForFile(path)
+
+      def GetDigest():
+        # A new _DigestCache, as used by another process.
+        return md5_check._DigestCache(cache_dir).Get(input_file.name,
+                                                     ComputeDigest)
+
+      digest = md5_check._Md5ForFile(input_file.name)
+      self.assertEqual(digest, GetDigest())
+      self.assertEqual(digest, GetDigest())
+      self.assertEqual(1, len(hashed_paths),
+                       'should not hash again an unchanged file')
+
+      input_file.seek(0)
+      input_file.write('INPUT FILE')
+      input_file.flush()
+      os.utime(input_file.name, (mtime + 1, mtime + 1))
+      new_digest = md5_check._Md5ForFile(input_file.name)
+      self.assertNotEqual(digest, new_digest)
+      self.assertEqual(new_digest, GetDigest())
+      self.assertEqual(2, len(hashed_paths),
+                       'should hash again a modified file')
+
+      os.utime(input_file.name, None)
+      GetDigest()
+      GetDigest()
+      self.assertEqual(4, len(hashed_paths),
+                       'should not cache the digest of a file just modified')
+    finally:
+      shutil.rmtree(cache_dir)
+
+  def testParallelHashing(self):
+    temp_dir = tempfile.mkdtemp()
+    old_jobs = md5_check._JOBS
+    old_file_digest = md5_check._FILE_DIGEST
+    try:
+      md5_check._JOBS = 4
+      input_dir = os.path.join(temp_dir, 'dir')
+      os.makedirs(os.path.join(input_dir, 'sub'))
+      input_paths = [input_dir]
+      for i in xrange(8):
+        input_paths.append(os.path.join(temp_dir, '%d.txt' % i))
+        with open(input_paths[-1], 'w') as f:
+          f.write('input file %d' % i)
+      # A large file, read through a memory map.
+      with open(os.path.join(input_dir, 'sub', 'large.bin'), 'wb') as f:
+        f.write('x' * md5_check._MMAP_MIN_SIZE)
+      with open(os.path.join(input_dir, 'small.txt'), 'w') as f:
+        f.write('small')
+      record_path = os.path.join(temp_dir, 'record.stamp')
+
+      def CheckCallAndRecord(should_call, message):
+        self.called = False
+
+        def MarkCalled():
+          self.called = True
+
+        md5_check.CallAndRecordIfStale(MarkCalled, record_path=record_path,
+                                       input_paths=input_paths)
+        self.assertEqual(should_call, self.called, message)
+
+      for file_digest in ('md5', 'crc32'):
+        md5_check._FILE_DIGEST = file_digest
+        CheckCallAndRecord(True, 'should call when the digest changes')
+        CheckCallAndRecord(False, 'should not call when nothing changed')
+        with open(os.path.join(input_dir, 'sub', 'large.bin'), 'r+b') as f:
+          f.seek(1000)
+          f.write(file_digest)
+        CheckCallAndRecord(True, 'changed file in a directory should trigger '
+                           'call')
+        with open(input_paths[5], 'w') as f:
+          f.write('input file ' + file_digest)
+        CheckCallAndRecord(True, 'changed input file should trigger call')
+        CheckCallAndRecord(False, 'should not call when nothing changed')
+    finally:
+      md5_check._JOBS = old_jobs
+      md5_check._FILE_DIGEST = old_file_digest
+      shutil.rmtree(temp_dir)
+
+  def testStampFormat(self):
+    temp_dir = tempfile.mkdtemp()
+    try:
+      input_file = os.path.join(temp_dir, 'input.jar')
+      _WriteZipFile(input_file, [('path/1.txt', '1'), ('path/2.txt', '2')])
+      record_path = os.path.join(temp_dir, 'record.stamp')
+      input_strings = ['string1', 'string2']
+
+      def MarkCalled(changes):
+        self.called = True
+        self.changes = changes
+
+      def CheckCallAndRecord(should_call, message):
+        self.called = False
+        md5_check.CallAndRecordIfStale(MarkCalled, record_path=record_path,
+                                       input_paths=[input_file],
+                                       input_strings=input_strings,
+                                       pass_changes=True)
+        self.assertEqual(should_call, self.called, message)
+
+      CheckCallAndRecord(True, 'should call when there is no stamp')
+      with open(record_path, 'rb') as stampfile:
+        metadata = md5_check._Metadata.FromFile(stampfile)
+      self.assertIsNotNone(metadata._stamp_path,
+                           'should not read the body of the stamp eagerly')
+      self.assertEqual(['string1', 'string2'], metadata.GetStrings())
+      self.assertEqual(['path/1.txt', 'path/2.txt'],
+                       sorted(metadata.IterSubpaths(input_file)))
+
+      # Stamps exported as JSON can be read back.
+      with open(record_path, 'w') as jsonfile:
+        metadata.ToJsonFile(jsonfile)
+      CheckCallAndRecord(False, 'should not call when nothing changed')
+
+      _WriteZipFile(input_file, [('path/1.txt', '1'), ('path/2.txt', '3')])
+      CheckCallAndRecord(True, 'changed subpath should trigger call')
+      self.assertEqual(['path/2.txt'],
+                       list(self.changes.IterModifiedSubpaths(input_file)))
+
+      with open(record_path, 'r+b') as stampfile:
+        stampfile.truncate(os.path.getsize(record_path) - 1)
+      CheckCallAndRecord(True, 'truncated stamp should trigger call')
+    finally:
+      shutil.rmtree(temp_dir)
+
 
 if __name__ == '__main__':
   unittest.main()
@@ -37,6 +37,7 @@ for arg in "$@"; do
   esac
 done
 
-for file in "${files[@]}"; do
-  "${jni_generator}" "${args[@]}" --input_file="${file}"
-done
+# Generate all headers in one process.
+if [[ ${#files[@]} -gt 0 ]]; then
+  "${jni_generator}" "${args[@]}" "${files[@]/#/--input_file=}"
+fi
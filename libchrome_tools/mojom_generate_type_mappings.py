@@ -24,8 +24,8 @@ Usage:
 """
 
 import argparse
+import functools
 import os
-import subprocess
 import sys
 
 
@@ -48,6 +48,8 @@ if not os.path.isfile(_GENERATE_TYPE_MAPPINGS_PATH):
     _GENERATE_TYPE_MAPPINGS_PATH = os.path.join(
         os.path.dirname(__file__),
         'generate_type_mappings.py')
+sys.path.insert(0, os.path.dirname(os.path.abspath(_GENERATE_TYPE_MAPPINGS_PATH)))
+import generate_type_mappings
 
 def _read_typemap_config(path):
   """Reads .typemap file.
@@ -65,35 +67,54 @@ def _read_typemap_config(path):
   return gn_helpers.FromGNArgs(''.join(content))
 
 
-def _generate_type_mappings(input_paths, output):
+def _parse_typemap(path):
+  """Parses .typemap file into the form used by generate_type_mappings.py.
+
+  Args:
+    path: File path to the .typemap location.
+
+  Returns:
+    A dictionary mapping mojom types to their native type information.
+  """
+  typemap_config = _read_typemap_config(path)
+  lines = []
+  for public_header in typemap_config.get('public_headers', []):
+    lines.append('public_headers=' + public_header)
+  for traits_header in typemap_config.get('traits_headers', []):
+    lines.append('traits_headers=' + traits_header)
+  for type_mapping in typemap_config.get('type_mappings', []):
+    lines.append('type_mappings=' + type_mapping)
+  return generate_type_mappings.ParseTypemap('\n'.join(lines))
+
+
+def _generate_type_mappings(input_paths, output, cache_path):
   """Generates __type_mappings file from given .typemap files.
 
-  Builds a command line to run generate_type_mappings.py, and executes it.
+  The .typemap files are parsed in-process. Parsed typemaps are cached in
+  |cache_path| keyed by the content of each .typemap file, so only the
+  modified ones are parsed again.
 
   Args:
     input_paths: a list of file paths for .typemap files.
     output: a path to output __type_mappings file.
+    cache_path: a path to the parse cache, or None to disable it.
   """
-  command = [sys.executable, _GENERATE_TYPE_MAPPINGS_PATH, '--output', output]
-
   # TODO(hidehiko): Add dependency handling.
 
+  typemaps = []
   for path in input_paths:
-    typemap_config = _read_typemap_config(path)
-    command.append('--start-typemap')
-    for public_header in typemap_config.get('public_headers', []):
-      command.append('public_headers=' + public_header)
-    for traits_header in typemap_config.get('traits_headers', []):
-      command.append('traits_headers=' + traits_header)
-    for type_mapping in typemap_config.get('type_mappings', []):
-      command.append('type_mappings=' + type_mapping)
-
-  subprocess.check_call(command)
+    with open(path, 'rb') as f:
+      digest = generate_type_mappings.Digest(f.read())
+    typemaps.append((digest, functools.partial(_parse_typemap, path)))
+  generate_type_mappings.GenerateTypeMappings(typemaps, [], output, cache_path)
 
 
 def _parse_args():
   parser = argparse.ArgumentParser()
   parser.add_argument('--output', help='Output file path')
+  parser.add_argument('--cache',
+                      help='A path to a cache of parsed typemaps used to '
+                      'speed up subsequent runs.')
   parser.add_argument('input_paths', metavar="INPUT-PATH", nargs='+',
                       help='Input typemap files.')
   return parser.parse_args()
@@ -101,7 +122,7 @@ def _parse_args():
 
 def main():
   args = _parse_args()
-  _generate_type_mappings(args.input_paths, args.output)
+  _generate_type_mappings(args.input_paths, args.output, args.cache)
 
 
 if __name__ == '__main__':
@@ -28,10 +28,15 @@ This script does following things;
 - Clean existing libchrome code, except some manually created files and tools.
 - Copy necessary files from original Chromium repository.
 - Apply patches to the copied files, if necessary.
+
+With --incremental, existing files are kept, and only the files which differ
+from the Chromium repository (or are modified by patches) are copied again.
 """
 
 
 import argparse
+import concurrent.futures
+import filecmp
 import fnmatch
 import glob
 import os
@@ -135,6 +140,10 @@ def _find_target_files(chromium_root):
           if not exclude_pattern.match(filepath)]
 
 
+# Top level entries of the output directory which are never cleaned.
+_KEEP_DIRS = ('.git', 'libchrome_tools', 'soong')
+
+
 def _clean_existing_dir(output_root):
   """Removes existing libchrome files.
 
@@ -144,7 +153,7 @@ def _clean_existing_dir(output_root):
   os.makedirs(output_root, mode=0o755, exist_ok=True)
   for path in os.listdir(output_root):
     target_path = os.path.join(output_root, path)
-    if (not os.path.isdir(target_path) or path in ('.git', 'libchrome_tools', 'soong')):
+    if (not os.path.isdir(target_path) or path in _KEEP_DIRS):
       continue
     shutil.rmtree(target_path)
 
@@ -163,6 +172,137 @@ def _import_files(chromium_root, output_root):
     shutil.copy2(source_path, target_path)
 
 
+def _is_up_to_date(source_path, target_path):
+  """Returns whether target_path already has the content of source_path.
+
+  Files with the same size and modification time are assumed to be the same.
+  Otherwise, contents are compared; when they match, the modification time is
+  updated so that the next comparison is cheap.
+
+  Args:
+    source_path: Path to the file in Chromium's repository.
+    target_path: Path to the file in libchrome.
+  """
+  try:
+    target_stat = os.stat(target_path)
+  except FileNotFoundError:
+    return False
+  source_stat = os.stat(source_path)
+  if (source_stat.st_ino, source_stat.st_dev) == (target_stat.st_ino,
+                                                  target_stat.st_dev):
+    return True
+  if source_stat.st_size != target_stat.st_size:
+    return False
+  if (source_stat.st_mtime_ns == target_stat.st_mtime_ns and
+      source_stat.st_mode == target_stat.st_mode):
+    return True
+  if not filecmp.cmp(source_path, target_path, shallow=False):
+    return False
+  shutil.copystat(source_path, target_path)
+  return True
+
+
+def _update_file(source_path, target_path, link):
+  """Makes target_path a copy of source_path, if it differs.
+
+  Returns whether the file is updated.
+
+  Args:
+    source_path: Path to the file in Chromium's repository.
+    target_path: Path to the file in libchrome.
+    link: Whether target_path may be a hard link to source_path.
+  """
+  if _is_up_to_date(source_path, target_path):
+    return False
+  os.makedirs(os.path.dirname(target_path), mode=0o755, exist_ok=True)
+  # Replace the file atomically, without writing through an existing link.
+  temp_path = target_path + '.update_libchrome'
+  if link:
+    try:
+      os.link(source_path, temp_path)
+    except OSError:
+      # e.g. source and target are on different file systems.
+      link = False
+  if not link:
+    shutil.copy2(source_path, temp_path)
+  os.replace(temp_path, target_path)
+  return True
+
+
+def _remove_stale_files(output_root, target_files):
+  """Removes files in the cleaned directories which are not in target_files.
+
+  This removes the same files as _clean_existing_dir, except target_files.
+
+  Args:
+    output_root: Path to the output directory.
+    target_files: Paths to be imported, relative to output_root.
+  """
+  target_files = set(target_files)
+  for path in os.listdir(output_root):
+    top_path = os.path.join(output_root, path)
+    if not os.path.isdir(top_path) or path in _KEEP_DIRS:
+      continue
+    for dirpath, dirnames, filenames in os.walk(top_path, topdown=False):
+      for filename in filenames:
+        filepath = os.path.join(dirpath, filename)
+        if os.path.relpath(filepath, output_root) not in target_files:
+          os.remove(filepath)
+      if not os.listdir(dirpath):
+        os.rmdir(dirpath)
+
+
+def _import_files_incrementally(chromium_root, output_root, patched_files,
+                                jobs, link):
+  """Updates files from Chromium repository which differ in libchrome.
+
+  Args:
+    chromium_root: Path to the Chromium's repository.
+    output_root: Path to the output directory.
+    patched_files: Paths modified by patches, relative to output_root. They
+      are always copied again, and never linked, so that patches apply on
+      unmodified files.
+    jobs: Number of files compared or copied concurrently.
+    link: Whether to hard link files instead of copying them.
+  """
+  target_files = _find_target_files(chromium_root)
+  _remove_stale_files(output_root, target_files)
+  for filepath in patched_files:
+    target_path = os.path.join(output_root, filepath)
+    if os.path.exists(target_path):
+      os.remove(target_path)
+
+  def update(filepath):
+    return _update_file(os.path.join(chromium_root, filepath),
+                        os.path.join(output_root, filepath),
+                        link and filepath not in patched_files)
+  with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+    updated = sum(executor.map(update, target_files))
+  print('%d of %d files updated' % (updated, len(target_files)))
+
+
+def _list_patch_files(patch_root):
+  """Returns the patch files in patch_root, in the order to apply them."""
+  return sorted(glob.glob(os.path.join(patch_root, '*.patch')))
+
+
+def _find_patched_files(patch_root):
+  """Returns the set of paths modified by patches.
+
+  Args:
+    patch_root: Path to the directory containing patch files.
+  """
+  patched_files = set()
+  pattern = re.compile(r'^(?:---|\+\+\+) [^/\t\n]*/([^\t\n]*)')
+  for patch_file in _list_patch_files(patch_root):
+    with open(patch_file, 'r', errors='replace') as f:
+      for line in f:
+        match = pattern.match(line)
+        if match and not line.startswith(('--- /dev/null', '+++ /dev/null')):
+          patched_files.add(match.group(1).rstrip())
+  return patched_files
+
+
 def _apply_patch_files(patch_root, output_root):
   """Applies patches.
 
@@ -171,13 +311,22 @@ def _apply_patch_files(patch_root, output_root):
   the library checked in the Chromium repository.
   See each *.patch file in libchrome_tools/patch/ directory for details.
 
+  All patches are given to a single patch process, in name order.
+
   Args:
     patch_root: Path to the directory containing patch files.
     output_root: Path to the output directory.
   """
-  for patch_file in glob.iglob(os.path.join(patch_root, '*.patch')):
-    with open(patch_file, 'r') as f:
-      subprocess.check_call(['patch', '-p1'], stdin=f, cwd=output_root)
+  patches = []
+  for patch_file in _list_patch_files(patch_root):
+    with open(patch_file, 'rb') as f:
+      content = f.read()
+    if not content.endswith(b'\n'):
+      content += b'\n'
+    patches.append(content)
+  if patches:
+    subprocess.run(['patch', '-p1'], input=b''.join(patches),
+                   cwd=output_root, check=True)
 
 
 def _parse_args():
@@ -196,14 +345,35 @@ def _parse_args():
       '--patch_dir',
       default=os.path.join(_TOOLS_DIR, 'patch'),
       help='Directory containing patch files to be applied.')
+  parser.add_argument(
+      '--incremental',
+      action='store_true',
+      help='Keep existing files, and only copy the files which changed.')
+  parser.add_argument(
+      '--jobs', '-j',
+      type=int,
+      default=os.cpu_count(),
+      help='Number of files to compare and copy in parallel, with '
+      '--incremental.')
+  parser.add_argument(
+      '--hardlink',
+      action='store_true',
+      help='With --incremental, hard link unpatched files to the Chromium '
+      'repository instead of copying them, when on the same file system.')
 
   return parser.parse_args()
 
 
 def main():
   args = _parse_args()
-  _clean_existing_dir(args.output_root)
-  _import_files(args.chromium_root, args.output_root)
+  if args.incremental:
+    os.makedirs(args.output_root, mode=0o755, exist_ok=True)
+    _import_files_incrementally(args.chromium_root, args.output_root,
+                                _find_patched_files(args.patch_dir),
+                                args.jobs, args.hardlink)
+  else:
+    _clean_existing_dir(args.output_root)
+    _import_files(args.chromium_root, args.output_root)
   _apply_patch_files(args.patch_dir, args.output_root)
   # TODO(hidehiko): Create a git commit with filling templated message.
 
@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+# Copyright 2020 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Benchmarks the uprev tools on synthetic data.
+
+Each benchmark also checks that the optimized code gives the same results as
+the reference implementation.
+
+Usage:
+    benchmark.py filters [--paths N] [--seed S]
+    benchmark.py history [--commits N] [--seed S]
+"""
+
+import argparse
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import filtered_utils
+import filters
+import utils
+
+# Top level directories of a Chromium checkout, with their relative size.
+_TOP_LEVEL_DIRECTORIES = [
+    (b'android_webview', 2), (b'ash', 3), (b'base', 3), (b'build', 1),
+    (b'cc', 2), (b'chrome', 20), (b'chromecast', 1), (b'chromeos', 3),
+    (b'components', 12), (b'content', 8), (b'crypto', 1), (b'dbus', 1),
+    (b'device', 2), (b'extensions', 2), (b'gpu', 2), (b'ios', 4),
+    (b'ipc', 1), (b'media', 4), (b'mojo', 1), (b'net', 4), (b'services', 3),
+    (b'testing', 1), (b'third_party', 30), (b'tools', 4), (b'ui', 6),
+]
+
+# Words used to make directory and file names. Platform names exercise the
+# WANT_EXCLUDE rules.
+_NAME_WORDS = [
+    b'allocator', b'android', b'bluetooth', b'browser', b'common', b'core',
+    b'debug', b'fuchsia', b'geometry', b'gfx', b'icu', b'internal', b'ios',
+    b'json_schema', b'linux', b'mac', b'memory', b'message_loop', b'metrics',
+    b'nacl', b'policy', b'posix', b'public', b'range', b'renderer',
+    b'strings', b'task', b'test', b'third_party', b'threading', b'timers',
+    b'trace_event', b'util', b'win',
+]
+
+_FILE_EXTENSIONS = [b'.cc', b'.h', b'.mojom', b'.py', b'.java', b'.gn',
+                    b'.json', b'.md', b'.js', b'.html']
+
+# Special file names found in most directories.
+_SPECIAL_FILES = [b'BUILD.gn', b'OWNERS', b'DEPS', b'PRESUBMIT.py',
+                  b'SECURITY_OWNERS', b'buildflags.h']
+
+# Paths named explicitly by the rules.
+_RULE_PATHS = [
+    b'base/allocator/allocator_shim.cc',
+    b'base/allocator/allocator_shim.h',
+    b'base/allocator/partition_allocator/page_allocator.cc',
+    b'base/android/java/src/org/chromium/base/BuildConfig.java',
+    b'base/third_party/dynamic_annotations/dynamic_annotations.h',
+    b'base/third_party/libevent/event.h',
+    b'build/android/gyp/util/build_utils.py',
+    b'build/android/pylib/constants/__init__.py',
+    b'build/build_config.h',
+    b'components/policy/core/common/policy_map.h',
+    b'components/policy/policy_export.h',
+    b'device/bluetooth/bluetooth_uuid.h',
+    b'device/bluetooth/bluez/bluetooth_service_attribute_value_bluez.cc',
+    b'dbus/test_server.cc',
+    b'testing/gtest/include/gtest/gtest.h',
+    b'ui/gfx/gfx_export.h',
+    b'Android.bp',
+    b'libchrome_tools/uprev/filters.py',
+]
+
+
+def _name(rng):
+    words = rng.sample(_NAME_WORDS, rng.choice([1, 1, 2, 2, 3]))
+    return b'_'.join(words)
+
+
+def synthetic_tree(num_paths, seed):
+    """Returns a sorted list of about num_paths paths looking like Chromium.
+
+    Args:
+        num_paths: number of paths to generate.
+        seed: seed of the random generator, for reproducible trees.
+    """
+    rng = random.Random(seed)
+    total_weight = sum(weight for _, weight in _TOP_LEVEL_DIRECTORIES)
+    paths = set(_RULE_PATHS)
+    for top, weight in _TOP_LEVEL_DIRECTORIES:
+        budget = num_paths * weight // total_weight
+        # Depth first walk creating directories until the budget is spent.
+        stack = [top]
+        while budget > 0 and stack:
+            directory = stack.pop()
+            for special in _SPECIAL_FILES:
+                if rng.random() < 0.3:
+                    paths.add(directory + b'/' + special)
+            for _ in range(rng.randint(2, 12)):
+                paths.add(b'%s/%s%s' % (directory, _name(rng),
+                                        rng.choice(_FILE_EXTENSIONS)))
+                budget -= 1
+            if directory.count(b'/') < 7:
+                for _ in range(rng.randint(0, 4)):
+                    stack.append(directory + b'/' + _name(rng))
+            if not stack:
+                stack.append(top + b'/' + _name(rng))
+    return sorted(paths)
+
+
+def _measure(name, fn):
+    start = time.perf_counter()
+    result = fn()
+    print('%-32s %8.3f s' % (name, time.perf_counter() - start))
+    return result
+
+
+def benchmark_filters(args):
+    """Compares filters.filter_file to the per-rule reference."""
+    paths = synthetic_tree(args.paths, args.seed)
+    files = [utils.GitFile(path, b'100644', b'0' * 40) for path in paths]
+    print(len(files), 'paths in',
+          len(set(path.rsplit(b'/', 1)[0] for path in paths)), 'directories')
+
+    def reference():
+        return ([f for f in files if filters._want_file(f.path)] +
+                [f for f in files if filters._keep_file(f.path)])
+
+    expected = _measure('reference', reference)
+    # Start from empty classifiers to measure the cold run as well.
+    filters._want_classifier = filters.PathClassifier(filters.WANT,
+                                                      filters.WANT_EXCLUDE)
+    filters._keep_classifier = filters.PathClassifier(filters.KEEP,
+                                                      filters.KEEP_EXCLUDE)
+    actual = _measure('filter_file (cold)',
+                      lambda: filters.filter_file(files, files))
+    assert actual == expected, 'filter_file differs from the reference'
+    actual = _measure('filter_file (memoized)',
+                      lambda: filters.filter_file(files, files))
+    assert actual == expected, 'filter_file differs from the reference'
+    print(len(expected), 'files selected, identical to the reference')
+
+
+# A side branch is merged into the main line every _MERGE_DISTANCE commits.
+_MERGE_DISTANCE = 50
+
+
+def synthetic_history(git_dir, num_commits, seed):
+    """Creates a bare repository at git_dir with a synthetic history.
+
+    The main line, refs/heads/main, has num_commits commits with messages
+    looking like the ones of the filtered branch, and regularly merges short
+    side branches.
+
+    Args:
+        git_dir: path of the repository to create.
+        num_commits: number of commits on the main line.
+        seed: seed of the random generator, for reproducible histories.
+    """
+    rng = random.Random(seed)
+    subprocess.check_call(['git', 'init', '--quiet', '--bare', git_dir])
+    process = subprocess.Popen(['git', '--git-dir', git_dir, 'fast-import',
+                                '--quiet', '--date-format=raw'],
+                               stdin=subprocess.PIPE)
+    mark = 0
+    for i in range(num_commits):
+        side = None
+        if i > 10 and i % _MERGE_DISTANCE == 0:
+            mark += 1
+            side = mark
+            process.stdin.write(b'commit refs/heads/side\nmark :%d\n'
+                                b'committer S <s@example.com> %d +0000\n'
+                                b'data 4\nside\nfrom :%d\n\n' %
+                                (side, 1500000000 + i, mark - 5))
+        mark += 1
+        body = b'\n'.join(b'%s %s' % (_name(rng), _name(rng))
+                          for _ in range(rng.randint(0, 20)))
+        message = (b'Commit %d\n\n%s\n\n%s: %040x\n' %
+                   (i, body, filtered_utils.CROS_LIBCHROME_ORIGINAL_COMMIT,
+                    rng.getrandbits(160)))
+        command = (b'commit refs/heads/main\nmark :%d\n'
+                   b'author A <a@example.com> %d -0700\n'
+                   b'committer C <c@example.com> %d +0000\n'
+                   b'data %d\n%s\n' %
+                   (mark, 1500000000 + i, 1500000000 + i, len(message),
+                    message))
+        if mark > 1:
+            command += b'from :%d\n' % (mark - 2 if side else mark - 1)
+        if side:
+            command += b'merge :%d\n' % side
+        process.stdin.write(command + b'\n')
+    process.stdin.close()
+    assert process.wait() == 0, 'git fast-import failed'
+
+
+def _reference_git_revlist(to_commit):
+    """utils.git_revlist(None, to_commit) reading all output at once."""
+    ret = subprocess.check_output(['git', 'rev-list', to_commit,
+                                   '--topo-order', '--parents'])
+    commits = []
+    for line in ret.split(b'\n'):
+        if not line:
+            continue
+        hashes = line.split(b' ')
+        commits.append((hashes[0], hashes[1:]))
+    return list(reversed(commits))
+
+
+def _reference_parse_metadata(content):
+    """filtered_utils._parse_metadata copying the remaining lines per line."""
+    ret = content.split(b'\n')
+    parents = []
+    tree_hash = None
+    authorship = None
+    author_re = re.compile(rb'^(.*) <(.*)> ([0-9]+) ([^ ]+)$')
+    while ret:
+        line = ret[0]
+        ret = ret[1:]
+        if not line.strip():
+            break
+        tag, reminder = line.split(b' ', 1)
+        if tag == b'tree':
+            tree_hash = reminder
+        elif tag == b'author':
+            m = author_re.match(reminder)
+            authorship = filtered_utils.GitCommitAuthorship(*m.groups())
+        elif tag == b'parent':
+            parents.append(reminder)
+    title = ret[0] if ret else None
+    original_commits = []
+    is_root = False
+    for line in ret:
+        if line.startswith(filtered_utils.CROS_LIBCHROME_ORIGINAL_COMMIT):
+            original_commits.append(line.split(b':')[1].strip())
+        if line == filtered_utils.CROS_LIBCHROME_INITIAL_COMMIT:
+            is_root = True
+    return filtered_utils.GitCommitMetadata(parents, original_commits,
+                                            tree_hash, authorship, title,
+                                            b'\n'.join(ret), is_root)
+
+
+def _measure_memory(name, fn):
+    tracemalloc.start()
+    result = _measure(name, fn)
+    print('%-32s %8.1f MB peak' % ('', tracemalloc.get_traced_memory()[1] / 1e6))
+    tracemalloc.stop()
+    return result
+
+
+def benchmark_history(args):
+    """Compares streaming rev-list and commit parsing to the references."""
+    temp_dir = tempfile.mkdtemp(prefix='libchrome_benchmark')
+    try:
+        git_dir = os.path.join(temp_dir, 'history.git')
+        _measure('create history',
+                 lambda: synthetic_history(git_dir, args.commits, args.seed))
+        os.environ['GIT_DIR'] = git_dir
+
+        expected = _measure_memory(
+            'reference rev-list', lambda: _reference_git_revlist('main'))
+        print(len(expected), 'commits')
+        # Compare while streaming, keeping only the current commit.
+        def compare_revlist():
+            count = 0
+            for commit, reference in zip(utils.iter_revlist(None, 'main'),
+                                         expected):
+                assert commit == reference, (commit, reference)
+                count += 1
+            assert count == len(expected)
+        _measure_memory('iter_revlist', compare_revlist)
+
+        hashes = [commit for commit, _ in expected]
+        contents = []
+        for i in range(0, len(hashes), 1024):
+            contents.extend(utils.get_object_reader().read_many(
+                hashes[i:i + 1024], b'commit'))
+        reference_metas = _measure(
+            'reference parse',
+            lambda: [_reference_parse_metadata(c) for c in contents])
+        metas = _measure(
+            '_parse_metadata',
+            lambda: [filtered_utils._parse_metadata(h, c)
+                     for h, c in zip(hashes, contents)])
+        assert metas == reference_metas, '_parse_metadata differs'
+        del contents, metas
+
+        def read_all_metadata():
+            for (commit, meta), reference in zip(
+                    filtered_utils.iter_metadata(hashes), reference_metas):
+                assert meta == reference, commit
+        _measure_memory('iter_metadata', read_all_metadata)
+        print('all commits identical to the reference')
+    finally:
+        utils.get_object_reader().close()
+        shutil.rmtree(temp_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+    parser_filters = subparsers.add_parser(
+        'filters', help='filters.filter_file on a synthetic Chromium tree.')
+    parser_filters.add_argument('--paths', type=int, default=400000,
+                                help='number of paths in the synthetic tree.')
+    parser_filters.add_argument('--seed', type=int, default=0,
+                                help='seed of the synthetic tree.')
+    parser_filters.set_defaults(func=benchmark_filters)
+    parser_history = subparsers.add_parser(
+        'history', help='rev-list and commit parsing on a synthetic history.')
+    parser_history.add_argument('--commits', type=int, default=200000,
+                                help='number of commits in the history.')
+    parser_history.add_argument('--seed', type=int, default=0,
+                                help='seed of the synthetic history.')
+    parser_history.set_defaults(func=benchmark_history)
+    args = parser.parse_args(sys.argv[1:])
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,9 +3,12 @@
 # found in the LICENSE file.
 """ Provides utilities for filtered branch handling. """
 
+import binascii
 import collections
+import itertools
+import os
 import re
-import subprocess
+import threading
 
 import utils
 
@@ -15,6 +18,21 @@ CROS_LIBCHROME_INITIAL_COMMIT = b'CrOS-Libchrome-History-Initial-Commit'
 CROS_LIBCHROME_ORIGINAL_COMMIT = b'CrOS-Libchrome-Original-Commit'
 
 
+# Number of parsed commits kept by get_metadata.
+_METADATA_CACHE_SIZE = 65536
+# Number of commits read at once when walking a branch.
+_METADATA_BATCH_SIZE = 1024
+
+# First line of a commits map cache file, followed by the tip of the filtered
+# branch and the ROOT commit. The rest of the file is a sequence of records of
+# two binary object ids: original commit, then filtered commit.
+_COMMITS_MAP_CACHE_MAGIC = b'libchrome-commits-map 1'
+_OBJECT_ID_SIZE = 20
+
+# Matches the author line of a commit: name, email, time and timezone.
+_AUTHOR_RE = re.compile(rb'^(.*) <(.*)> ([0-9]+) ([^ ]+)$')
+
+
 # Stores metadata required for a git commit.
 GitCommitMetadata = collections.namedtuple(
     'GitCommitMetadata',
@@ -29,6 +47,33 @@ GitCommitAuthorship = collections.namedtuple(
 )
 
 
+class _LRUCache:
+  """A thread-safe cache keeping the most recently used max_size entries."""
+
+  def __init__(self, max_size):
+    self._max_size = max_size
+    self._entries = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  def get(self, key):
+    """Returns the entry of key, or None if it is not cached."""
+    with self._lock:
+      if key not in self._entries:
+        return None
+      self._entries.move_to_end(key)
+      return self._entries[key]
+
+  def __setitem__(self, key, value):
+    with self._lock:
+      self._entries[key] = value
+      self._entries.move_to_end(key)
+      if len(self._entries) > self._max_size:
+        self._entries.popitem(last=False)
+
+
+_metadata_cache = _LRUCache(_METADATA_CACHE_SIZE)
+
+
 def get_metadata(commit_hash):
   """Returns the metadata of the commit specified by the commit_hash.
 
@@ -39,27 +84,76 @@ def get_metadata(commit_hash):
   Returns metadata from the commit message about commit_hash on the filtered
   branch.
 
+  The commit is read through the shared utils.GitObjectReader, and results are
+  kept in an LRU cache; callers must not modify the returned metadata.
+
   Args:
       commit_hash: the commit hash on the filtered branch.
   """
+  return get_metadata_many([commit_hash])[0]
+
+
+def get_metadata_many(commit_hashes):
+  """Returns a list of GitCommitMetadata for commit_hashes.
+
+  Commits that are not cached are read in one pipelined batch.
+
+  Args:
+      commit_hashes: commit hashes to read.
+  """
+  found = {}
+  missing = []
+  for commit in commit_hashes:
+    if commit in found:
+      continue
+    found[commit] = _metadata_cache.get(commit)
+    if found[commit] is None:
+      missing.append(commit)
+  if missing:
+    contents = utils.get_object_reader().read_many(missing, b'commit')
+    for commit, content in zip(missing, contents):
+      found[commit] = _metadata_cache[commit] = _parse_metadata(commit,
+                                                                content)
+  return [found[commit] for commit in commit_hashes]
+
 
-  ret = subprocess.check_output(['git', 'cat-file', 'commit',
-                                 commit_hash]).split(b'\n')
+def iter_metadata(commit_hashes):
+  """Yields (commit hash, GitCommitMetadata) for each of commit_hashes.
+
+  Commits are read in batches of _METADATA_BATCH_SIZE and are not added to
+  the cache used by get_metadata, so memory use doesn't grow with the number
+  of commits.
+
+  Args:
+      commit_hashes: iterable of commit hashes.
+  """
+  commit_hashes = iter(commit_hashes)
+  while True:
+    batch = list(itertools.islice(commit_hashes, _METADATA_BATCH_SIZE))
+    if not batch:
+      return
+    contents = utils.get_object_reader().read_many(batch, b'commit')
+    for commit, content in zip(batch, contents):
+      yield commit, _parse_metadata(commit, content)
+
+
+def _parse_metadata(commit_hash, content):
+  """Parses the raw content of a commit object into GitCommitMetadata."""
+  lines = content.split(b'\n')
   parents = []
   tree_hash = None
   authorship = None
-  author_re = re.compile(rb'^(.*) <(.*)> ([0-9]+) ([^ ])+$')
-  while ret:
-      line = ret[0]
-      ret = ret[1:]
+  body_start = len(lines)
+  for index, line in enumerate(lines):
       if not line.strip():
           # End of header. break.
+          body_start = index + 1
           break
       tag, reminder = line.split(b' ', 1)
       if tag == b'tree':
           tree_hash = reminder
       elif tag == b'author':
-          m = author_re.match(reminder)
+          m = _AUTHOR_RE.match(reminder)
           assert m, (line, commit_hash)
           authorship = GitCommitAuthorship(m.group(1),
                                            m.group(2),
@@ -67,6 +161,7 @@ def get_metadata(commit_hash):
                                            m.group(4))
       elif tag == b'parent':
           parents.append(reminder)
+  ret = lines[body_start:]
 
   title = ret[0] if ret else None
 
@@ -82,27 +177,100 @@ def get_metadata(commit_hash):
                            title, msg, is_root)
 
 
-def get_commits_map(commit_hash, progress_callback):
+def _read_commits_map_cache(path):
+    """Returns (tip, commits_map) stored in the cache at path.
+
+    Returns (None, None) if the cache doesn't exist or can't be used.
+
+    Args:
+        path: path of the cache file.
+    """
+    try:
+        with open(path, 'rb') as f:
+            header = f.readline().split()
+            records = f.read()
+    except IOError:
+        return None, None
+    if (len(header) != 4 or
+            b' '.join(header[:2]) != _COMMITS_MAP_CACHE_MAGIC or
+            len(records) % (2 * _OBJECT_ID_SIZE) != 0):
+        return None, None
+    tip, root = header[2], header[3]
+    records = binascii.hexlify(records)
+    step = 2 * _OBJECT_ID_SIZE
+    commits_map = {
+        records[i:i + step]: records[i + step:i + 2 * step]
+        for i in range(0, len(records), 2 * step)
+    }
+    if root != b'-':
+        commits_map['ROOT'] = root
+    return tip, commits_map
+
+
+def write_commits_map_cache(path, tip, commits_map):
+    """Stores commits_map, valid for the filtered branch at tip, into path.
+
+    Args:
+        path: path of the cache file.
+        tip: commit hash of the filtered branch the map was built from.
+        commits_map: map from original commit hashes to filtered ones.
+    """
+    records = []
+    for original, filtered in commits_map.items():
+        if original == 'ROOT':
+            continue
+        if (len(original) != 2 * _OBJECT_ID_SIZE or
+                len(filtered) != 2 * _OBJECT_ID_SIZE):
+            # Not representable; don't store an incomplete map.
+            return
+        records.append(original + filtered)
+    header = b' '.join([_COMMITS_MAP_CACHE_MAGIC, tip,
+                        commits_map.get('ROOT', b'-')])
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(header + b'\n')
+        f.write(binascii.unhexlify(b''.join(records)))
+    os.replace(tmp_path, path)
+
+
+def get_commits_map(commit_hash, progress_callback, cache_path=None):
     """Returns a map from original commit hashes to filtered commit hashes.
 
     This function traverses the filtered branch from the commit specified by
     commit_hash to its root, then parses each commit message and constructs the
     map of those commits.
 
+    If cache_path is given, the map is also stored there together with the
+    commit it was built for. On the next call, only commits added on top of
+    the cached commit are read; if the cached commit is not an ancestor of
+    commit_hash, the map is rebuilt from scratch.
+
     Args:
         commit_hash: the commit hash on the filtered branch.
         progress_callback: called every commit is being read. Parameters taken
             are (idx, total_commits, current_commit)
+        cache_path: optional path of the on-disk cache.
     """
-    commits_map = {}
-    commits_filtered_tree = utils.git_revlist(None, commit_hash)
-    for index, commit in enumerate(commits_filtered_tree, start=1):
+    tip = utils.git_rev_parse(commit_hash)
+    cached_tip, commits_map = None, None
+    if cache_path:
+        cached_tip, commits_map = _read_commits_map_cache(cache_path)
+    if cached_tip == tip:
+        return commits_map
+    if cached_tip and utils.git_is_ancestor(cached_tip, tip):
+        commits_filtered_tree = utils.git_revlist(cached_tip, tip)
+    else:
+        commits_map = {}
+        commits_filtered_tree = utils.git_revlist(None, tip)
+    metas = iter_metadata(commit[0] for commit in commits_filtered_tree)
+    for index, (commit, meta) in enumerate(metas, start=1):
         if progress_callback:
-            progress_callback(index, len(commits_filtered_tree), commit[0])
-        meta = get_metadata(commit[0])
+            progress_callback(index, len(commits_filtered_tree), commit)
         for original_commit in meta.original_commits:
-            commits_map[original_commit] = commit[0]
+            commits_map[original_commit] = commit
         if meta.is_root:
             assert 'ROOT' not in commits_map
-            commits_map['ROOT'] = commit[0]
+            commits_map['ROOT'] = commit
+    if cache_path:
+        write_commits_map_cache(cache_path, tip, commits_map)
     return commits_map
@@ -4,6 +4,7 @@
 
 """Provide filters for libchrome tools."""
 
+import collections
 import re
 
 # Libchrome wants WANT but not WANT_EXCLUDE
@@ -93,6 +94,218 @@ def _keep_file(path):
             break
     return keep
 
+# Characters that end the literal prefix of a pattern.
+_REGEX_SPECIAL_CHARS = b'.^$*+?{}[]\\|()'
+# Characters making the preceding item optional or repeated.
+_REGEX_QUANTIFIERS = b'*+?{'
+# Constructs that look beyond the consumed characters.
+_REGEX_ASSERTIONS = [b'$', b'(?=', b'(?!', b'(?<', b'\\']
+
+
+def _has_top_level_alternative(pattern):
+    """Returns whether pattern has a '|' outside of any group."""
+    depth = 0
+    i = 0
+    while i < len(pattern):
+        c = pattern[i:i + 1]
+        if c == b'\\':
+            i += 1
+        elif c == b'[':
+            # Skip the character set; a ']' right after '[' or '[^' is part
+            # of it.
+            i += 1
+            if pattern[i:i + 1] == b'^':
+                i += 1
+            if pattern[i:i + 1] == b']':
+                i += 1
+            while i < len(pattern) and pattern[i:i + 1] != b']':
+                if pattern[i:i + 1] == b'\\':
+                    i += 1
+                i += 1
+        elif c == b'(':
+            depth += 1
+        elif c == b')':
+            depth -= 1
+        elif c == b'|' and depth == 0:
+            return True
+        i += 1
+    return False
+
+
+def _literal_prefix(regex):
+    """Returns a string every path matched by regex starts with."""
+    pattern = regex.pattern
+    if _has_top_level_alternative(pattern):
+        return b''
+    prefix = b''
+    for i in range(len(pattern)):
+        c = pattern[i:i + 1]
+        if c in _REGEX_SPECIAL_CHARS:
+            if c in _REGEX_QUANTIFIERS:
+                # The last character is optional or repeated.
+                prefix = prefix[:-1]
+            break
+        prefix += c
+    return prefix
+
+
+def _is_prefix_closed(regex):
+    """Returns whether regex matching a path implies it matches its suffixes.
+
+    That is the case if the pattern only depends on the characters it
+    consumes, i.e. it has no end anchor, lookaround or escape (escapes are
+    rejected conservatively).
+    """
+    return not any(assertion in regex.pattern
+                   for assertion in _REGEX_ASSERTIONS)
+
+
+class PathClassifier:
+    """Matches paths against include rules minus exclude rules.
+
+    PathClassifier(include, exclude).matches(path) is equivalent to testing
+    each regex of include, then of exclude, with match() in order, but rules
+    are merged into one alternation per directory, keeping only those whose
+    literal prefix is compatible with the directory. Decisions are memoized
+    per directory, and computed from the parent directory: once a directory
+    cannot contain any included file, or is fully excluded, its whole subtree
+    is decided without running any regex.
+    """
+
+    def __init__(self, include, exclude):
+        # Rules are combined into patterns compiled without flags.
+        assert all(regex.flags == re.compile(regex.pattern).flags
+                   for regex in include + exclude)
+        self._rules = [(regex, _literal_prefix(regex), _is_prefix_closed(regex))
+                       for regex in include + exclude]
+        self._exclude_start = len(include)
+        # Map from directory path (with trailing '/', or b'' for the top
+        # directory) to its _DirectoryRules.
+        self._directories = {}
+        # Map from tuple of rule indexes to a compiled alternation of them.
+        self._combined = {}
+        self._directories[b''] = self._make_directory_rules(
+            b'', range(len(self._rules)), False)
+
+    _DirectoryRules = collections.namedtuple(
+        '_DirectoryRules',
+        [
+            # Rule indexes that may match paths in the directory.
+            'candidates',
+            # False if no path of the subtree matches, True if all do, None
+            # if include and exclude must be run on each path.
+            'constant',
+            # Whether all paths of the subtree match include, so that only
+            # exclude has to be run.
+            'all_included',
+            'include',
+            'exclude',
+        ])
+
+    def _combine(self, indexes):
+        """Returns one regex matching where any of the given rules match."""
+        if not indexes:
+            return None
+        indexes = tuple(indexes)
+        combined = self._combined.get(indexes)
+        if combined is None:
+            combined = re.compile(b'|'.join(
+                b'(?:%s)' % self._rules[i][0].pattern for i in indexes))
+            self._combined[indexes] = combined
+        return combined
+
+    def _make_directory_rules(self, directory, parent_candidates,
+                              all_included):
+        candidates = []
+        for i in parent_candidates:
+            regex, prefix, prefix_closed = self._rules[i]
+            if not (prefix.startswith(directory) or
+                    directory.startswith(prefix)):
+                continue
+            if prefix_closed and directory and regex.match(directory):
+                # Every path under directory matches this rule.
+                if i >= self._exclude_start:
+                    return self._DirectoryRules((), False, False, None, None)
+                all_included = True
+                continue
+            candidates.append(i)
+        include = [i for i in candidates if i < self._exclude_start]
+        exclude = [i for i in candidates if i >= self._exclude_start]
+        constant = None
+        if not include and not all_included:
+            constant = False
+        elif all_included and not exclude:
+            constant = True
+        if constant is not None:
+            return self._DirectoryRules((), constant, all_included, None, None)
+        if all_included:
+            # Include rules can no longer change the result.
+            candidates = exclude
+        return self._DirectoryRules(candidates, None, all_included,
+                                    self._combine(include),
+                                    self._combine(exclude))
+
+    def _get_directory_rules(self, directory):
+        """Returns _DirectoryRules of directory, which ends with '/'."""
+        rules = self._directories.get(directory)
+        if rules is None:
+            parent = directory[:directory.rfind(b'/', 0, -1) + 1]
+            parent_rules = self._get_directory_rules(parent)
+            if parent_rules.constant is not None:
+                rules = parent_rules
+            else:
+                rules = self._make_directory_rules(directory,
+                                                   parent_rules.candidates,
+                                                   parent_rules.all_included)
+            self._directories[directory] = rules
+        return rules
+
+    def matches(self, path):
+        """Returns whether path matches include and not exclude."""
+        rules = self._get_directory_rules(path[:path.rfind(b'/') + 1])
+        if rules.constant is not None:
+            return rules.constant
+        if not rules.all_included and not rules.include.match(path):
+            return False
+        return not (rules.exclude and rules.exclude.match(path))
+
+    def may_match_under(self, directory):
+        """Returns whether any path under directory may match.
+
+        Args:
+            directory: directory path, without trailing '/'.
+        """
+        return self._get_directory_rules(directory + b'/').constant is not False
+
+
+_want_classifier = PathClassifier(WANT, WANT_EXCLUDE)
+_keep_classifier = PathClassifier(KEEP, KEEP_EXCLUDE)
+
+
+def want_file(path):
+    """Returns whether the path wants to be a new file.
+
+    Same as _want_file, using a PathClassifier.
+    """
+    return _want_classifier.matches(path)
+
+
+def keep_file(path):
+    """Returns whether the path wants to be kept untouched in local files.
+
+    Same as _keep_file, using a PathClassifier.
+    """
+    return _keep_classifier.matches(path)
+
+
+def dir_may_want(directory):
+    """Returns whether any file under directory may be wanted.
+
+    Args:
+        directory: directory path, without trailing '/'.
+    """
+    return _want_classifier.may_match_under(directory)
+
 
 def filter_file(our_files, upstream_files):
     """Generates a list of files we want based on hard-coded rules.
@@ -106,10 +319,10 @@ def filter_file(our_files, upstream_files):
 
     files = []
     for upstream_file in upstream_files:
-      if _want_file(upstream_file.path):
+      if want_file(upstream_file.path):
             files.append(upstream_file)
     for our_file in our_files:
-      if _keep_file(our_file.path):
+      if keep_file(our_file.path):
             files.append(our_file)
     return files
 
@@ -123,7 +336,7 @@ def filter_diff(diff):
     filtered = []
     for change in diff:
         path = change.file.path
-        if _want_file(path):
-            assert not _keep_file(path)
+        if want_file(path):
+            assert not keep_file(path)
             filtered.append(change)
     return filtered
@@ -5,10 +5,13 @@
 
 import argparse
 import collections
+import concurrent.futures
 import datetime
+import itertools
 import os
 import subprocess
 import sys
+import tempfile
 import time
 
 import filtered_utils
@@ -22,6 +25,11 @@ _TIMING_DISTANCE = 100
 # after every _VERIFY_INTEGRITY_DISTANCE in browser repository.
 # Merge commits are always verified.
 _VERIFY_INTEGRITY_DISTANCE = 1000
+# Number of (path, tree) pairs whose filtered tree is remembered by
+# filtered_tree_hash between verifications.
+_FILTERED_TREE_CACHE_SIZE = 1 << 20
+# Number of upcoming commits prepared ahead by each process_commits worker.
+_PREFETCH_PER_JOB = 16
 
 
 def timing(timing_deque, update=True):
@@ -81,7 +89,188 @@ def find_filtered_commit(commit, commits_map):
     return commits_map[look_for]
 
 
-def do_commit(treehash, commithash, meta, commits_map):
+class CommitTreeBackend:
+    """Makes every filtered commit with its own git commit-tree."""
+
+    # Trees must be in the repository before git commit-tree uses them.
+    writes_trees = True
+
+    def get_lazytree(self, commit):
+        """Returns a LazyTree of the tree of a commit in filtered branch."""
+        return lazytree.LazyTree(self.get_tree(commit))
+
+    def get_tree(self, commit):
+        """Returns the tree hash of a commit in filtered branch."""
+        return filtered_utils.get_metadata(commit).tree
+
+    def commit(self, tree, treehash, diff, parents, meta, message):
+        """Makes a commit and returns its id.
+
+        Args:
+            tree: LazyTree of the commit.
+            treehash: tree object id for this commit.
+            diff: filtered diff from the first parent, in utils.git_difftree()
+                format.
+            parents: commit ids of the parents in filtered branch.
+            meta: meta data of the original commit.
+            message: commit message.
+        """
+        parents_parameters = []
+        for parent in parents:
+            parents_parameters.append('-p')
+            parents_parameters.append(parent)
+        return subprocess.check_output(
+            ['git', 'commit-tree'] + parents_parameters + [treehash],
+            env=dict(os.environ,
+                     GIT_AUTHOR_NAME=meta.authorship.name,
+                     GIT_AUTHOR_EMAIL=meta.authorship.email,
+                     GIT_AUTHOR_DATE=b' '.join([meta.authorship.time,
+                                                meta.authorship.timezone])),
+            input=message).strip(b'\n')
+
+    def finish(self):
+        """Waits until all commits are stored in the repository."""
+        pass
+
+    def resolve(self, commit):
+        """Returns the commit hash of a commit id returned by commit()."""
+        return commit
+
+
+def _fast_import_path(path):
+    """Returns path quoted for git fast-import if needed."""
+    if not path.startswith(b'"') and b'\n' not in path:
+        return path
+    return b'"%s"' % (path.replace(b'\\', b'\\\\').replace(b'"', b'\\"')
+                      .replace(b'\n', b'\\n'))
+
+
+class FastImportBackend:
+    """Streams all filtered commits into a single git fast-import process.
+
+    Each commit is sent as the filtered diff from its first parent, so that
+    git fast-import creates the trees, and is identified by a mark (b':<n>')
+    until finish() is called. The committer identity and date are read once
+    from git var GIT_COMMITTER_IDENT.
+    """
+
+    # git fast-import creates the trees from the diffs.
+    writes_trees = False
+
+    def __init__(self, ref):
+        """Starts git fast-import.
+
+        Args:
+            ref: the ref git fast-import updates. It is overwritten.
+        """
+        self._ref = ref.encode('utf-8')
+        self._committer = subprocess.check_output(
+            ['git', 'var', 'GIT_COMMITTER_IDENT']).strip(b'\n')
+        fd, self._marks_path = tempfile.mkstemp(prefix='libchrome_marks')
+        os.close(fd)
+        self._process = subprocess.Popen(
+            ['git', 'fast-import', '--quiet', '--force', '--date-format=raw',
+             '--export-marks=' + self._marks_path],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self._next_mark = 1
+        # Map from mark to tree hash.
+        self._trees = {}
+        # The last commit made and its LazyTree, reused by its child.
+        self._last_commit = None
+        self._last_tree = None
+        # Whether commits were sent after the last checkpoint.
+        self._dirty = False
+        # Map from mark to commit hash, filled by finish().
+        self._marks = None
+
+    def _checkpoint(self):
+        """Waits until git fast-import stores everything sent so far."""
+        if not self._dirty:
+            return
+        self._process.stdin.write(b'checkpoint\nprogress checkpoint\n')
+        self._process.stdin.flush()
+        assert (self._process.stdout.readline() ==
+                b'progress checkpoint\n'), 'git fast-import failed'
+        self._dirty = False
+
+    def get_lazytree(self, commit):
+        """Returns a LazyTree of the tree of a commit in filtered branch."""
+        if commit == self._last_commit:
+            return self._last_tree
+        if commit in self._trees:
+            # The tree must be readable from the repository.
+            self._checkpoint()
+        return lazytree.LazyTree(self.get_tree(commit))
+
+    def get_tree(self, commit):
+        """Returns the tree hash of a commit in filtered branch."""
+        if commit in self._trees:
+            return self._trees[commit]
+        return filtered_utils.get_metadata(self.resolve(commit)).tree
+
+    def commit(self, tree, treehash, diff, parents, meta, message):
+        """Sends a commit to git fast-import and returns its mark.
+
+        See CommitTreeBackend.commit() for the arguments.
+        """
+        mark = b':%d' % self._next_mark
+        self._next_mark += 1
+        command = []
+        if not parents:
+            command.append(b'reset %s\n' % self._ref)
+        command.append(b'commit %s\nmark %s\n' % (self._ref, mark))
+        command.append(b'author %s <%s> %s %s\n' % (
+            meta.authorship.name, meta.authorship.email, meta.authorship.time,
+            meta.authorship.timezone))
+        command.append(b'committer %s\n' % self._committer)
+        command.append(b'data %d\n%s\n' % (len(message), message))
+        if parents:
+            command.append(b'from %s\n' % parents[0])
+        for parent in parents[1:]:
+            command.append(b'merge %s\n' % parent)
+        for op, f in diff:
+            if op == utils.DiffOperations.DEL:
+                command.append(b'D %s\n' % _fast_import_path(f.path))
+            else:
+                command.append(b'M %s %s %s\n' % (f.mode, f.id,
+                                                   _fast_import_path(f.path)))
+        command.append(b'\n')
+        self._process.stdin.write(b''.join(command))
+        self._trees[mark] = treehash
+        self._last_commit = mark
+        self._last_tree = tree
+        self._dirty = True
+        return mark
+
+    def finish(self):
+        """Waits until git fast-import exits, and reads the marks."""
+        self._process.stdin.close()
+        self._process.stdout.close()
+        if self._process.wait() != 0:
+            raise subprocess.CalledProcessError(self._process.returncode,
+                                                'git fast-import')
+        self._marks = {}
+        with open(self._marks_path, 'rb') as f:
+            for line in f:
+                mark, commit = line.split()
+                self._marks[mark] = commit
+        os.remove(self._marks_path)
+        self._trees = {}
+        self._last_commit = None
+        self._last_tree = None
+
+    def resolve(self, commit):
+        """Returns the commit hash of a commit id returned by commit().
+
+        Marks can only be resolved after finish().
+        """
+        if commit.startswith(b':'):
+            return self._marks[commit]
+        return commit
+
+
+def do_commit(treehash, commithash, meta, commits_map, backend=None,
+              tree=None, diff=()):
     """Makes a commit with the given arguments.
 
     This creates a commit on the filtered branch with preserving the original
@@ -96,36 +285,131 @@ def do_commit(treehash, commithash, meta, commits_map):
         commithash: original commit hash, used to append to commit message.
         meta: meta data of the original commit.
         commits_map: current known commit mapping. commits_map may be altered.
+        backend: CommitTreeBackend (default) or FastImportBackend.
+        tree: LazyTree of treehash, used by FastImportBackend.
+        diff: filtered diff from the first parent, used by FastImportBackend.
     """
-    parents_parameters = []
-    for parent in meta.parents:
-        parents_parameters.append('-p')
-        parents_parameters.append(find_filtered_commit(parent, commits_map))
+    parents = [find_filtered_commit(parent, commits_map)
+               for parent in meta.parents]
     msg = (meta.message + b'\n\n' +
            filtered_utils.CROS_LIBCHROME_ORIGINAL_COMMIT +
            b': ' + commithash + b'\n')
-    return subprocess.check_output(
-        ['git', 'commit-tree'] + parents_parameters + [treehash],
-        env=dict(os.environ,
-                 GIT_AUTHOR_NAME=meta.authorship.name,
-                 GIT_AUTHOR_EMAIL=meta.authorship.email,
-                 GIT_AUTHOR_DATE=b' '.join([meta.authorship.time,
-                                            meta.authorship.timezone])),
-        input=msg).strip(b'\n')
+    return (backend or CommitTreeBackend()).commit(
+        tree, treehash, diff, parents, meta, msg)
+
+
+# Map from (path, original tree hash) to the hash of the filtered tree, or
+# None if nothing is wanted in it.
+_filtered_trees = {}
+
+
+def _filtered_subtree_hash(path, treehash):
+    """Returns the hash of the tree at path after filters, None if empty.
 
+    Args:
+        path: path of the tree, with a trailing '/', or b'' for the root.
+        treehash: tree object id in Chromium browser tree.
+    """
+    key = (path, treehash)
+    if key in _filtered_trees:
+        return _filtered_trees[key]
+    entries = []
+    content = utils.get_object_reader().read(treehash, b'tree')
+    for mode, name, objecthash in utils.parse_tree_object(content):
+        if mode == utils.GIT_TREE_MODE:
+            if not filters.dir_may_want(path + name):
+                continue
+            subtree = _filtered_subtree_hash(path + name + b'/', objecthash)
+            if subtree:
+                entries.append((mode, name, subtree))
+        elif mode != b'160000' and filters.want_file(path + name):
+            # Submodules are not files, as in utils.get_file_list.
+            entries.append((mode, name, objecthash))
+    result = None
+    if entries:
+        result = utils.git_hash_object(b'tree', utils.make_tree_object(entries))
+    if len(_filtered_trees) >= _FILTERED_TREE_CACHE_SIZE:
+        _filtered_trees.clear()
+    _filtered_trees[key] = result
+    return result
+
+
+def filtered_tree_hash(original_commit):
+    """Returns the hash of the tree of original_commit after filters.
 
-def verify_commit(original_commit, new_tree):
+    The tree is walked top-down, only into directories where the filters may
+    want files, and filtered subtrees are remembered across calls so that
+    unchanged directories are not read again. The resulting trees are not
+    written to the repository.
+
+    Args:
+        original_commit: commit hash in Chromium browser tree.
+    """
+    treehash = filtered_utils.get_metadata(original_commit).tree
+    return (_filtered_subtree_hash(b'', treehash) or
+            utils.git_hash_object(b'tree', b''))
+
+
+def verify_commit(original_commit, new_tree, full=False):
     """Verifies if new_tree is exactly original_commit after filters.
 
     Args:
         original_commit: commit hash in Chromium browser tree.
         new_tree: tree hash created for upstream branch commit.
+        full: if True, lists all files of original_commit and filters them
+            instead of using filtered_tree_hash.
     """
+    if not full:
+        assert filtered_tree_hash(original_commit) == new_tree
+        return
     expected_file_list = filters.filter_file([], utils.get_file_list(original_commit))
     assert utils.git_mktree(expected_file_list) == new_tree
 
 
-def process_commits(pending_commits, commits_map, progress_callback, commit_callback):
+def read_commit_diff(commit):
+    """Returns the metadata of a browser commit and its filtered diff.
+
+    The diff is taken from the first parent of the commit, and filtered with
+    filters.filter_diff.
+
+    Args:
+        commit: commit hash in browser repository.
+    """
+    meta = filtered_utils.get_metadata(commit)
+    diff = filters.filter_diff(utils.git_difftree(
+        meta.parents[0] if meta.parents else None, commit))
+    return meta, diff
+
+
+def iter_commit_diffs(pending_commits, jobs=1):
+    """Yields read_commit_diff() of each commit in pending_commits, in order.
+
+    With more than one job, the upcoming commits are read by a pool of jobs
+    threads while the caller consumes the current one. At most
+    jobs * _PREFETCH_PER_JOB commits are read ahead.
+
+    Args:
+        pending_commits: list of tuple (commit hash, parent hashes).
+        jobs: number of worker threads.
+    """
+    if jobs <= 1:
+        for commit in pending_commits:
+            yield read_commit_diff(commit[0])
+        return
+    commits = iter(pending_commits)
+    with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+        futures = collections.deque(
+            executor.submit(read_commit_diff, commit[0])
+            for commit in itertools.islice(commits, jobs * _PREFETCH_PER_JOB))
+        while futures:
+            result = futures.popleft().result()
+            for commit in itertools.islice(commits, 1):
+                futures.append(executor.submit(read_commit_diff, commit[0]))
+            yield result
+
+
+def process_commits(pending_commits, commits_map, progress_callback, commit_callback,
+                    backend=None, jobs=1, full_verify=False):
     """Processes new commits in browser repository.
 
     Returns the commit hash of the last commit made.
@@ -138,32 +422,39 @@ def process_commits(pending_commits, commits_map, progress_callback, commit_call
             should take (idx, total, orig_commit_hash, meta) as parameters.
         commit_callback: callback when a commit is made to filtered branch. It
             should take (orig_commit_hash, new_commit_hash, meta) as parameters.
+        backend: CommitTreeBackend (default) or FastImportBackend. The commit
+            ids passed to commit_callback and stored in commits_map are the
+            ones returned by the backend. finish() is called before returning.
+        jobs: number of threads reading the metadata and diffs of upcoming
+            commits, see iter_commit_diffs. Commits are still made in order.
     """
+    backend = backend or CommitTreeBackend()
     last_commit = None
     last_verified = -1
-    for i, commit in enumerate(pending_commits, start=1):
-        meta = filtered_utils.get_metadata(commit[0])
+    commit_diffs = iter_commit_diffs(pending_commits, jobs)
+    for i, (commit, (meta, diff_with_parent)) in enumerate(
+            zip(pending_commits, commit_diffs), start=1):
         if progress_callback:
             progress_callback(i, len(pending_commits), commit[0], meta)
-        diff_with_parent = filters.filter_diff(utils.git_difftree(
-            meta.parents[0] if meta.parents else None, commit[0]))
-        git_lazytree = lazytree.LazyTree(
-            filtered_utils.get_metadata(
-                find_filtered_commit(meta.parents[0], commits_map)).tree
-            if meta.parents else None)
+        filtered_parent = (find_filtered_commit(meta.parents[0], commits_map)
+                           if meta.parents else None)
         if len(meta.parents) <= 1 and len(diff_with_parent) == 0:
             # not merge commit    AND no diff
             if len(meta.parents) == 1 and meta.parents[0] in commits_map:
                 commits_map[commit[0]] = commits_map[meta.parents[0]]
             continue
+        git_lazytree = (backend.get_lazytree(filtered_parent)
+                        if filtered_parent else lazytree.LazyTree())
         for op, f in diff_with_parent:
             if op == utils.DiffOperations.ADD or op == utils.DiffOperations.REP:
                 git_lazytree[f.path] = f
             elif op == utils.DiffOperations.DEL:
                 del git_lazytree[f.path]
-        treehash_after_diff_applied = git_lazytree.hash()
+        treehash_after_diff_applied = git_lazytree.hash(
+            write=backend.writes_trees)
         filtered_commit = do_commit(treehash_after_diff_applied, commit[0],
-                                    meta, commits_map)
+                                    meta, commits_map, backend, git_lazytree,
+                                    diff_with_parent)
         if commit_callback:
             commit_callback(commit[0], filtered_commit, meta)
         commits_map[commit[0]] = filtered_commit
@@ -172,9 +463,12 @@ def process_commits(pending_commits, commits_map, progress_callback, commit_call
                                      _VERIFY_INTEGRITY_DISTANCE):
             # merge commit    OR  every _VERIFY_INTEGRITY_DISTANCE
             last_verified = i
-            verify_commit(commit[0], treehash_after_diff_applied)
+            verify_commit(commit[0], treehash_after_diff_applied, full_verify)
+    backend.finish()
+    last_commit = backend.resolve(last_commit)
     # Verify last commit
-    verify_commit(pending_commits[-1][0], filtered_utils.get_metadata(last_commit).tree)
+    verify_commit(pending_commits[-1][0],
+                  filtered_utils.get_metadata(last_commit).tree, full_verify)
     return last_commit
 
 
@@ -190,7 +484,37 @@ def main():
         help='commit hash in browser master branch.')
     parser.add_argument(
         '--dry_run', dest='dry_run', action='store_const', const=True, default=False)
+    parser.add_argument(
+        '--commits_map_cache', dest='commits_map_cache', type=str,
+        default=None,
+        help='file caching the commits mapping of the filtered branch. '
+        'Defaults to libchrome_commits_map in the git directory. Set to an '
+        'empty string to disable.')
+    parser.add_argument(
+        '--fast_import', dest='fast_import', action='store_const', const=True,
+        default=False,
+        help='stream the filtered commits into a single git fast-import '
+        'instead of running git commit-tree for each of them. Commits are '
+        'printed as fast-import marks until all of them are written.')
+    parser.add_argument(
+        '--fast_import_ref', dest='fast_import_ref', type=str,
+        default='refs/libchrome/fast-import',
+        help='ref updated by git fast-import to the new HEAD. It is '
+        'overwritten.')
+    parser.add_argument(
+        '-j', '--jobs', dest='jobs', type=int, default=os.cpu_count(),
+        help='number of threads reading the diffs of upcoming commits. '
+        'Defaults to the number of CPUs.')
+    parser.add_argument(
+        '--full_verify', dest='full_verify', action='store_const', const=True,
+        default=False,
+        help='verify commits by filtering the full file list of the original '
+        'commit, instead of walking the changed directories only.')
     arg = parser.parse_args(sys.argv[1:])
+    if arg.commits_map_cache is None:
+        arg.commits_map_cache = os.path.join(
+            subprocess.check_output(['git', 'rev-parse', '--git-dir']).strip(
+                b'\n').decode('utf-8'), 'libchrome_commits_map')
 
     # Look for last known commit made by the script in filtered branch.
     print('Looking for last known commit from', arg.parent_filtered[0])
@@ -213,7 +537,8 @@ def main():
             print('Reading', cur_hash, '%d/%d' % (cur_idx, tot_cnt),
                   '%f c/s' % timing(timing_deque),
                   end='\r', flush=True),
-        ))
+        ),
+        arg.commits_map_cache)
     if not 'ROOT' in commits_map:
         commits_map['ROOT'] =subprocess.check_output(
             ['git', 'commit-tree', '-p', arg.parent_filtered[0],
@@ -230,6 +555,10 @@ def main():
         meta_last_known.original_commits[0] if meta_last_known else None,
         arg.goal_browser[0])
     print(len(pending_commits), 'commits to process')
+    backend = (FastImportBackend(arg.fast_import_ref) if arg.fast_import
+               else CommitTreeBackend())
+    # Commits made to the filtered branch, to update the commits map cache.
+    new_commits = {}
     new_head = process_commits(
         pending_commits,
         commits_map,
@@ -245,11 +574,28 @@ def main():
                   end='\r', flush=True),
         ),
         # Print new commits
-        lambda orig_hash, new_hash, commit_meta:
+        lambda orig_hash, new_hash, commit_meta: (
+            new_commits.__setitem__(orig_hash, new_hash),
             print(b'%s is commited as %s: %s' % (orig_hash, new_hash,
-                                                 commit_meta.title[:50]))
+                                                 commit_meta.title[:50])),
+        ),
+        backend,
+        arg.jobs,
+        arg.full_verify
     )
     print()
+    if arg.commits_map_cache:
+        # The filtered branch is expected to be updated to new_head. Its
+        # commits map is the one of parent_filtered plus the new commits.
+        new_commits_map = filtered_utils.get_commits_map(
+            arg.parent_filtered[0], None, arg.commits_map_cache)
+        for orig_hash, new_hash in new_commits.items():
+            new_commits_map[orig_hash] = backend.resolve(new_hash)
+        if ('ROOT' not in new_commits_map and
+                utils.git_is_ancestor(commits_map['ROOT'], new_head)):
+            new_commits_map['ROOT'] = commits_map['ROOT']
+        filtered_utils.write_commits_map_cache(arg.commits_map_cache,
+                                               new_head, new_commits_map)
     print('New HEAD should be', new_head.decode('ascii'))
 
 
@@ -3,17 +3,16 @@
 # Use of this source code is governed by a BSD-style license that can be
 # found in the LICENSE file.
 
-import re
-import subprocess
-
 import utils
 
 
-GIT_LSTREE_RE_LINE = re.compile(rb'^([^ ]*) ([^ ]*) ([^ ]*)\t(.*)$')
-
-
 class LazyTree:
-    """LazyTree does git mktree lazily."""
+    """LazyTree does git mktree lazily.
+
+    Tree objects are read through the shared utils.GitObjectReader, and new
+    trees are hashed in-process and written with the shared
+    utils.GitTreeWriter.
+    """
 
     def __init__(self, treehash=None):
         """Initializes a LazyTree.
@@ -38,20 +37,16 @@ class LazyTree:
         """Loads _treehash into _subtrees and _files."""
         if self._files is not None: # _subtrees is also not None too here.
             return
-        output = subprocess.check_output(['git', 'ls-tree', self._treehash]).split(b'\n')
+        content = utils.get_object_reader().read(self._treehash, b'tree')
         self._files = {}
         self._subtrees = {}
-        for line in output:
-            if not line:
-                continue
-            m = GIT_LSTREE_RE_LINE.match(line)
-            mode, gittype, objecthash, name = m.groups()
-            assert gittype == b'blob' or gittype == b'tree'
+        for mode, name, objecthash in utils.parse_tree_object(content):
+            assert mode != b'160000', (self._treehash, name)
             assert name not in self._files and name not in self._subtrees
-            if gittype == b'blob':
-                self._files[name] = utils.GitFile(None, mode, objecthash)
-            elif gittype == b'tree':
+            if mode == utils.GIT_TREE_MODE:
                 self._subtrees[name] = LazyTree(objecthash)
+            else:
+                self._files[name] = utils.GitFile(None, mode, objecthash)
 
     def _remove(self, components):
         """Removes components from self tree.
@@ -140,30 +135,36 @@ class LazyTree:
         """Returns if self is an empty tree."""
         return not self._subtrees and not self._files
 
-    def hash(self):
+    def hash(self, write=True):
         """Returns the hash of current tree object.
 
         If the object doesn't exist, create it.
+
+        Args:
+            write: if False, only computes the hash. The tree objects are then
+                expected to be created by someone else, e.g. git fast-import.
         """
+        treehash = self._hash(write)
+        if write:
+            utils.get_tree_writer().flush()
+        return treehash
+
+    def _hash(self, write=True):
+        """Returns the hash of current tree object, without flushing it."""
         if not self._treehash:
-            self._treehash = self._mktree()
+            self._treehash = self._mktree(write)
         return self._treehash
 
-    def _mktree(self):
+    def _mktree(self, write=True):
         """Recreates a tree object recursively.
 
         Lazily if subtree is unchanged.
         """
-        keys = list(self._files.keys()) + list(self._subtrees.keys())
-        mktree_input = []
-        for name in sorted(keys):
-            file = self._files.get(name)
-            if file:
-                mktree_input.append(b'%s blob %s\t%s' % (file.mode, file.id,
-                                                         name))
-            else:
-                mktree_input.append(
-                    b'040000 tree %s\t%s' % (self._subtrees[name].hash(), name))
-        return subprocess.check_output(
-            ['git', 'mktree'],
-            input=b'\n'.join(mktree_input)).strip(b'\n')
+        entries = []
+        for name, file in self._files.items():
+            entries.append((file.mode, name, file.id))
+        for name, subtree in self._subtrees.items():
+            entries.append((utils.GIT_TREE_MODE, name, subtree._hash(write)))
+        if not write:
+            return utils.git_hash_object(b'tree', utils.make_tree_object(entries))
+        return utils.get_tree_writer().write(entries)
@@ -10,6 +10,8 @@ a different branch.
 
 import argparse
 import collections
+import concurrent.futures
+import os
 import subprocess
 import sys
 
@@ -28,6 +30,42 @@ class CommitMetadataFactory(dict):
         return value
 
 
+class BlameCache(dict):
+    """Dict-like class mapping (commit, path) to utils.git_blame(commit, path).
+
+    Blames missing when read are run on demand. prefetch() runs the missing
+    blames of many files concurrently, with up to jobs git blame processes.
+    """
+
+    def __init__(self, jobs=1):
+        super().__init__()
+        self._jobs = jobs
+
+    def __missing__(self, key):
+        """Blames the file if missing"""
+        value = utils.git_blame(*key)
+        self.__setitem__(key, value)
+        return value
+
+    def prefetch(self, keys):
+        """Blames all (commit, path) in keys that are not cached yet."""
+        missing = [key for key in dict.fromkeys(keys) if key not in self]
+        if self._jobs <= 1 or len(missing) <= 1:
+            for key in missing:
+                self[key]
+            return
+        with concurrent.futures.ThreadPoolExecutor(self._jobs) as executor:
+            for key, value in zip(missing, executor.map(
+                    lambda key: utils.git_blame(*key), missing)):
+                self.__setitem__(key, value)
+
+    def prune(self, commits):
+        """Forgets the blames of commits other than the given ones."""
+        commits = set(commits)
+        for key in [key for key in self if key[0] not in commits]:
+            del self[key]
+
+
 def disconnect(source_commit, ref_commit):
     """Creates a commit that disconnects files from source_commit.
 
@@ -64,15 +102,18 @@ def connect_base(current_commit, base_commit):
         message=b'Connect history with base %s' % (base_commit.encode('ascii')))
 
 
-def blame_files(commithash, files):
+def blame_files(commithash, files, blame_cache=None):
     """Blames files on givven commithash"""
+    blame_cache = BlameCache() if blame_cache is None else blame_cache
+    blame_cache.prefetch((commithash, path) for path in files)
     blames = {}
     for path in files:
-        blames[path] = utils.git_blame(commithash, path)
+        blames[path] = blame_cache[(commithash, path)]
     return blames
 
 
-def search_blame_line(blames, amend_commits, target_commit_hash):
+def search_blame_line(blames, amend_commits, target_commit_hash,
+                      blame_cache=None):
     """Searches blames matching target_commit_hash in amend_commits
 
     Returns a map from file path to a list of tuple, each tuple has
@@ -84,11 +125,16 @@ def search_blame_line(blames, amend_commits, target_commit_hash):
             target_commit_hash.
         amend_commits: a list of commit hashes to provide actual history.
         target_commit_hash: commit hash that blames are blaemd on.
+        blame_cache: BlameCache to read the blames of amend_commits from.
     """
+    blame_cache = BlameCache() if blame_cache is None else blame_cache
+    blame_cache.prefetch((commit, blame_file_path)
+                         for blame_file_path in blames
+                         for commit in amend_commits)
     blames_combined = {}
     for blame_file_path, blame_file in blames.items():
         blames_amend = [
-            utils.git_blame(commit, blame_file_path) for commit in amend_commits
+            blame_cache[(commit, blame_file_path)] for commit in amend_commits
         ]
         blames_combined[blame_file_path] = [
             blame_combined for blame_combined in zip(blame_file, *blames_amend)
@@ -203,7 +249,8 @@ def reconstruct_file(blame_goal, blame_base, lines_to_reconstruct,
 
 
 def reconstruct_files(track_commit, blame_untracked_lines, blames,
-                      current_base_commit, virtual_goal_commit):
+                      current_base_commit, virtual_goal_commit,
+                      blame_cache=None):
     """Reconstructs files to reflect changes in track_commit.
 
     Returns a map from file path to file content for reconstructed files.
@@ -218,16 +265,21 @@ def reconstruct_files(track_commit, blame_untracked_lines, blames,
         virtual_goal_commit: commit hash for one giant commit that has no
             history.  virtual_goal_commit is one commit ahead of
             current_base_commit.
+        blame_cache: BlameCache to read the blames of current_base_commit
+            from.
     """
+    blame_cache = BlameCache() if blame_cache is None else blame_cache
     lines_to_track = collections.defaultdict(list)
     for file, lines in blame_untracked_lines.items():
         for line in lines:
             if line[1] == track_commit:
                 lines_to_track[file].append(line[0])
+    blame_cache.prefetch((current_base_commit, current_file)
+                         for current_file in lines_to_track)
     constructed_files = {}
     for current_file, current_file_lines in lines_to_track.items():
         print('Reconstructing', current_file, 'for', track_commit)
-        blame_base = utils.git_blame(current_base_commit, current_file)
+        blame_base = blame_cache[(current_base_commit, current_file)]
         constructed_files[current_file] = reconstruct_file(
             blames[current_file], blame_base, current_file_lines,
             virtual_goal_commit)
@@ -255,6 +307,10 @@ def main():
         type=str,
         nargs='+',
         help='commits to amend histories from base_commit')
+    parser.add_argument(
+        '-j', '--jobs', dest='jobs', type=int, default=os.cpu_count(),
+        help='number of git blame to run concurrently. Defaults to the number '
+        'of CPUs.')
 
     arg = parser.parse_args(sys.argv[1:])
     empty_commit = disconnect(arg.disconnect_from[0], arg.base_commit[0])
@@ -262,6 +318,7 @@ def main():
 
     commit_msg_cache = CommitMetadataFactory()
     commit_choice_cache = {}
+    blame_cache = BlameCache(arg.jobs)
     last_commit = connected_base
     # In each iteration of the loop, it
     #  - re-create the new goal commit, (base + committed history + (one giant)
@@ -270,8 +327,8 @@ def main():
     #  from uncommited to past histories.
     #  - choose one of the past commits, reconstruct files to reflect changes in
     #  that commit, and create a new commits.
-    # last_commit, commit_msg_cache, commit_choice_cache will be persistent
-    # across iteratins.
+    # last_commit, commit_msg_cache, commit_choice_cache and the blames of
+    # amend commits in blame_cache will be persistent across iteratins.
     while True:
         # One commit is processed per iteration.
 
@@ -285,9 +342,9 @@ def main():
             break
 
         blames = blame_files(virtual_goal,
-                             [diff.file.path for diff in diffs])
+                             [diff.file.path for diff in diffs], blame_cache)
         blames_combined = search_blame_line(blames, arg.amend_commits,
-                                            virtual_goal)
+                                            virtual_goal, blame_cache)
 
         commits_to_track, blame_untracked_lines = get_track_from_blames(
             blames_combined, virtual_goal, arg.amend_commits,
@@ -302,7 +359,10 @@ def main():
               (track_commit, commit_msg_cache[track_commit].title))
         constructed_files = reconstruct_files(track_commit,
                                               blame_untracked_lines, blames,
-                                              last_commit, virtual_goal)
+                                              last_commit, virtual_goal,
+                                              blame_cache)
+        # Goal and base commits change in every iteration.
+        blame_cache.prune(arg.amend_commits)
 
         # Mktree and commit with re-constructed_files.
         tree = lazytree.LazyTree(filtered_utils.get_metadata(last_commit).tree)
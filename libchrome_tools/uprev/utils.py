@@ -4,11 +4,15 @@
 
 """Provide some basic utility functions for libchrome tools."""
 
+import atexit
+import binascii
 import collections
 import enum
+import hashlib
 import os
 import re
 import subprocess
+import threading
 
 class DiffOperations(enum.Enum):
     """
@@ -34,6 +38,9 @@ GitBlameLine = collections.namedtuple(
 )
 
 
+# Mode of subtree entries in tree objects, as stored by git.
+GIT_TREE_MODE = b'40000'
+
 GIT_DIFFTREE_RE_LINE = re.compile(rb'^:([^ ]*) ([^ ]*) ([^ ]*) ([^ ]*) ([^ ]*)\t(.*)$')
 
 
@@ -146,8 +153,152 @@ def gen_op(current_files, target_files):
     return op
 
 
+def git_hash_object(object_type, content):
+    """Returns the id git assigns to an object, without writing it.
+
+    Args:
+        object_type: b'blob', b'tree' or b'commit'.
+        content: raw content of the object.
+    """
+    header = b'%s %d\0' % (object_type, len(content))
+    return hashlib.sha1(header + content).hexdigest().encode('ascii')
+
+
+def _is_tree_mode(mode):
+    return mode.lstrip(b'0') == GIT_TREE_MODE
+
+
+def _object_type_for_mode(mode):
+    if _is_tree_mode(mode):
+        return b'tree'
+    if mode == b'160000':
+        return b'commit'
+    return b'blob'
+
+
+def make_tree_object(entries):
+    """Returns the raw content of a tree object.
+
+    Args:
+        entries: list of (mode, name, object id) tuples. Subtrees have the mode
+            GIT_TREE_MODE (leading zeros are accepted, as in git mktree).
+    """
+    def sort_key(entry):
+        # git sorts subtrees as if their name ended with a slash.
+        mode, name, _ = entry
+        return name + b'/' if _is_tree_mode(mode) else name
+
+    content = []
+    for mode, name, object_id in sorted(entries, key=sort_key):
+        if _is_tree_mode(mode):
+            mode = GIT_TREE_MODE
+        content.append(b'%s %s\0%s' % (mode, name,
+                                        binascii.unhexlify(object_id)))
+    return b''.join(content)
+
+
+def parse_tree_object(content):
+    """Returns a list of (mode, name, object id) for a raw tree object."""
+    entries = []
+    pos = 0
+    while pos < len(content):
+        space = content.index(b' ', pos)
+        nul = content.index(b'\0', space)
+        object_id = binascii.hexlify(content[nul + 1:nul + 21])
+        entries.append((content[pos:space], content[space + 1:nul], object_id))
+        pos = nul + 21
+    return entries
+
+
+# Number of written tree ids GitTreeWriter remembers to avoid rewriting them.
+_MAX_KNOWN_TREES = 1 << 20
+
+
+class GitTreeWriter:
+    """Writes tree objects whose ids are computed in-process.
+
+    Tree ids are returned immediately by write(), while the objects are queued
+    and stored in bulk on flush() through one long-running git mktree --batch.
+    Trees must be flushed before git commands use them.
+    """
+
+    def __init__(self):
+        self._process = None
+        self._pending = []
+        self._written = set()
+        self._lock = threading.Lock()
+
+    def write(self, entries):
+        """Queues a tree and returns its id.
+
+        Args:
+            entries: see make_tree_object(). Subtrees must have been written
+                with this writer (or exist in the repository) before.
+        """
+        tree_id = git_hash_object(b'tree', make_tree_object(entries))
+        with self._lock:
+            if len(self._written) > _MAX_KNOWN_TREES:
+                # Writing a tree again is harmless; bound the memory use.
+                self._written = set()
+            if tree_id not in self._written:
+                self._written.add(tree_id)
+                self._pending.append((tree_id, entries))
+        return tree_id
+
+    def flush(self):
+        """Stores all queued trees in the repository."""
+        with self._lock:
+            pending, self._pending = self._pending, []
+            if not pending:
+                return
+            if self._process is None:
+                self._process = subprocess.Popen(['git', 'mktree', '--batch'],
+                                                 stdin=subprocess.PIPE,
+                                                 stdout=subprocess.PIPE)
+            process = self._process
+            mktree_input = []
+            for _, entries in pending:
+                for mode, name, object_id in entries:
+                    object_type = _object_type_for_mode(mode)
+                    mktree_input.append(b'%s %s %s\t%s\n' % (
+                        mode, object_type, object_id, name))
+                mktree_input.append(b'\n')
+            def write_input():
+                process.stdin.write(b''.join(mktree_input))
+                process.stdin.flush()
+            writer = threading.Thread(target=write_input)
+            writer.start()
+            try:
+                for tree_id, _ in pending:
+                    written_id = process.stdout.readline().strip(b'\n')
+                    assert written_id == tree_id, (written_id, tree_id)
+            finally:
+                writer.join()
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            if self._process is not None:
+                self._process.stdin.close()
+                self._process.wait()
+                self._process = None
+
+
+_tree_writer = GitTreeWriter()
+atexit.register(_tree_writer.close)
+
+
+def get_tree_writer():
+    """Returns the GitTreeWriter shared by the libchrome tools."""
+    return _tree_writer
+
+
 def git_mktree(files):
-    """Returns a git tree object hash after mktree recursively."""
+    """Returns a git tree object hash after mktree recursively.
+
+    Tree ids are computed in-process and all new trees are written with a
+    single request to the shared GitTreeWriter.
+    """
 
     def recursive_default_dict():
         return collections.defaultdict(recursive_default_dict)
@@ -165,24 +316,24 @@ def git_mktree(files):
         assert filename not in cwd
         cwd[filename] = f
 
+    writer = get_tree_writer()
+
     def _mktree(prefix, node):
-        objects = []
+        entries = []
         for name, val in node.items():
             prefix.append(name)
             if isinstance(val, collections.defaultdict):
-                tree_hash = _mktree(prefix, val)
-                objects.append(b'\t'.join(
-                    [b' '.join([b'040000', b'tree', tree_hash]), name]))
+                entries.append((GIT_TREE_MODE, name, _mktree(prefix, val)))
             else:
                 path = b'/'.join(prefix)
                 assert path == val.path, '%s\n%s' % (str(path), str(val.path))
-                objects.append(b'\t'.join(
-                    [b' '.join([val.mode, b'blob', val.id]), name]))
+                entries.append((val.mode, name, val.id))
             prefix.pop(-1)
-        return subprocess.check_output(['git', 'mktree'],
-                                       input=b'\n'.join(objects)).strip(b'\n')
+        return writer.write(entries)
 
-    return _mktree([], tree)
+    tree_hash = _mktree([], tree)
+    writer.flush()
+    return tree_hash
 
 
 def git_commit(tree, parents, message=b"", extra_env={}):
@@ -204,19 +355,40 @@ def git_commit(tree, parents, message=b"", extra_env={}):
         env=dict(os.environ, **extra_env)).strip(b'\n')
 
 
-def git_revlist(from_commit, to_commit):
-    """Returns a list of commits and their parents.
+def git_rev_parse(rev):
+    """Returns the commit hash rev points to.
 
-    Each item in the list is a tuple, containing two elements.
-    The first element is the commit hash; the second element is a list of parent
-    commits' hash.
+    Args:
+        rev: a revision, e.g. commit hash or branch name.
     """
+    if type(rev) == bytes:
+        rev = rev.decode('ascii')
+    return subprocess.check_output(
+        ['git', 'rev-parse', '--verify', rev + '^{commit}']).strip(b'\n')
+
+
+def git_is_ancestor(ancestor, commit):
+    """Returns whether ancestor is an ancestor of (or equal to) commit."""
+    return subprocess.call(
+        ['git', 'merge-base', '--is-ancestor', ancestor, commit]) == 0
+
+
+def iter_revlist(from_commit, to_commit):
+    """Yields commits and their parents, oldest first.
 
-    commits = []
-    ret = None
+    Each item is a tuple, containing two elements. The first element is the
+    commit hash; the second element is a list of parent commits' hash.
+    Commits are in reverse topological order, i.e. parents come before
+    children, and are read from git rev-list as they are produced.
+
+    Args:
+        from_commit: commit to start after, or None to list all ancestors of
+            to_commit. Commits reachable from either, but not both, are
+            listed.
+        to_commit: commit to stop at.
+    """
     if from_commit is None:
-        ret = subprocess.check_output(['git', 'rev-list', to_commit,
-                                       '--topo-order', '--parents'])
+        commit_range = to_commit
     else:
         # b'...'.join() later requires all variable to be binary-typed.
         if type(from_commit) == str:
@@ -224,15 +396,138 @@ def git_revlist(from_commit, to_commit):
         if type(to_commit) == str:
             to_commit = to_commit.encode('ascii')
         commit_range = b'...'.join([from_commit, to_commit])
-        ret = subprocess.check_output(['git', 'rev-list', commit_range,
-                                       '--topo-order', '--parents'])
-    ret = ret.split(b'\n')
-    for line in ret:
-        if not line:
-            continue
-        hashes = line.split(b' ')
-        commits.append((hashes[0], hashes[1:]))
-    return list(reversed(commits))
+    process = subprocess.Popen(['git', 'rev-list', commit_range,
+                                '--topo-order', '--reverse', '--parents'],
+                               stdout=subprocess.PIPE)
+    try:
+        for line in process.stdout:
+            hashes = line.split()
+            if hashes:
+                yield (hashes[0], hashes[1:])
+    finally:
+        process.stdout.close()
+        # A negative code means git was killed by SIGPIPE, when the caller
+        # stopped iterating early.
+        if process.wait() > 0:
+            raise subprocess.CalledProcessError(process.returncode,
+                                                'git rev-list')
+
+
+def git_revlist(from_commit, to_commit):
+    """Returns a list of commits and their parents.
+
+    Each item in the list is a tuple, containing two elements.
+    The first element is the commit hash; the second element is a list of parent
+    commits' hash. See iter_revlist.
+    """
+    return list(iter_revlist(from_commit, to_commit))
+
+
+class GitObjectReader:
+    """Reads git objects through a single long-running git cat-file --batch.
+
+    Spawning one git process per object dominates the cost of reading
+    thousands of commits, so requests are sent to one persistent process
+    instead. The reader is thread-safe.
+    """
+
+    def __init__(self):
+        self._process = None
+        self._lock = threading.Lock()
+
+    def _get_process(self):
+        if self._process is None:
+            self._process = subprocess.Popen(['git', 'cat-file', '--batch'],
+                                             stdin=subprocess.PIPE,
+                                             stdout=subprocess.PIPE)
+        return self._process
+
+    @staticmethod
+    def _request(object_name, object_type):
+        if type(object_name) == str:
+            object_name = object_name.encode('ascii')
+        if object_type:
+            # Peel the object like git cat-file <type> <object> would do.
+            object_name = b'%s^{%s}' % (object_name, object_type)
+        return object_name + b'\n'
+
+    @staticmethod
+    def _read_response(process, request):
+        header = process.stdout.readline()
+        if not header:
+            raise Exception(b'git cat-file exited while reading ' + request)
+        fields = header.split()
+        if fields[-1] == b'missing' or fields[-1] == b'ambiguous':
+            raise Exception(b'Cannot read git object ' + header)
+        size = int(fields[2])
+        data = process.stdout.read(size)
+        # Skip the trailing newline.
+        process.stdout.read(1)
+        return fields[1], data
+
+    def read(self, object_name, object_type=None):
+        """Returns the content of a git object.
+
+        Args:
+            object_name: object id or any name accepted by git rev-parse.
+            object_type: if set, the object is peeled to that type (e.g.
+                b'commit' or b'tree') and an error is raised if it can't be.
+        """
+        return self.read_many([object_name], object_type)[0]
+
+    def read_many(self, object_names, object_type=None):
+        """Returns a list with the content of each object in object_names.
+
+        All requests are pipelined to git cat-file before the responses are
+        read, so there is only one round trip to the git process.
+
+        Args:
+            object_names: list of object ids or names.
+            object_type: see read().
+        """
+        if type(object_type) == str:
+            object_type = object_type.encode('ascii')
+        requests = [self._request(name, object_type) for name in object_names]
+        with self._lock:
+            process = self._get_process()
+            # Write from another thread so that neither side blocks on a full
+            # pipe when there are many requests.
+            def write_requests():
+                process.stdin.write(b''.join(requests))
+                process.stdin.flush()
+            writer = threading.Thread(target=write_requests)
+            writer.start()
+            results = []
+            try:
+                for request in requests:
+                    read_type, data = self._read_response(process, request)
+                    assert not object_type or read_type == object_type, request
+                    results.append(data)
+            except:
+                # Unread responses would be mistaken for the next ones.
+                process.kill()
+                self._process = None
+                raise
+            finally:
+                writer.join()
+        return results
+
+    def close(self):
+        """Terminates the git process. It is restarted on the next read."""
+        with self._lock:
+            if self._process is not None:
+                self._process.stdin.close()
+                self._process.wait()
+                self._process = None
+
+
+_object_reader = GitObjectReader()
+atexit.register(_object_reader.close)
+
+
+def get_object_reader():
+    """Returns the GitObjectReader shared by the libchrome tools."""
+    return _object_reader
 
 
 def git_blame(commit, filepath):
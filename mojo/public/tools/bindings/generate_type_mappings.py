@@ -55,9 +55,15 @@ generates a bar.typemap containing
     }
   }
 }
+
+If --cache is given, the parsed form of each typemap is stored there keyed by
+the hash of its arguments, and the output is left untouched when none of the
+typemaps or dependencies changed since the previous run.
 """
 
 import argparse
+import functools
+import hashlib
 import json
 import os
 import re
@@ -73,10 +79,75 @@ def ReadTypemap(path):
     return json.load(f)['c++']
 
 
+def Digest(data):
+  if not isinstance(data, bytes):
+    data = data.encode('utf-8')
+  return hashlib.sha1(data).hexdigest()
+
+
+class TypemapCache(object):
+  """Persistent cache of parsed typemaps, keyed by content digest.
+
+  Only the entries used by the last run are written back, so the cache does
+  not grow as typemaps change. The cache file is not rewritten when it would
+  not change.
+  """
+
+  _VERSION = 1
+
+  def __init__(self, path=None):
+    self._path = path
+    self._entries = {}
+    self._used = {}
+    self.merge_key = None
+    if not path or not os.path.exists(path):
+      return
+    try:
+      with open(path) as f:
+        data = json.load(f)
+    except ValueError:
+      return
+    if data.get('version') == self._VERSION:
+      self._entries = data['entries']
+      self.merge_key = data['merge_key']
+
+  def Parse(self, digest, parse_function):
+    """Returns the parsed typemap for |digest|, calling |parse_function| only
+    if it is not cached."""
+    value = self._entries.get(digest)
+    if value is None:
+      value = parse_function()
+    self._used[digest] = value
+    return value
+
+  def Keep(self, digests):
+    """Keeps the entries for |digests| without parsing them."""
+    for digest in digests:
+      if digest in self._entries:
+        self._used[digest] = self._entries[digest]
+
+  def Write(self, merge_key):
+    if not self._path:
+      return
+    if merge_key == self.merge_key and self._used == self._entries:
+      return
+    data = {
+        'version': self._VERSION,
+        'entries': self._used,
+        'merge_key': merge_key,
+    }
+    with open(self._path, 'w') as f:
+      json.dump(data, f)
+
+
+def SplitTypemapArgs(args):
+  """Splits the command-line arguments into one string per typemap."""
+  return [s for s in '\n'.join(args).split('--start-typemap\n') if s]
+
+
 def ParseTypemapArgs(args):
-  typemaps = [s for s in '\n'.join(args).split('--start-typemap\n') if s]
   result = {}
-  for typemap in typemaps:
+  for typemap in SplitTypemapArgs(args):
     result.update(ParseTypemap(typemap))
   return result
 
@@ -126,6 +197,42 @@ def ParseTypemap(typemap):
   return result
 
 
+def GenerateTypeMappings(typemaps, dependencies, output, cache_path=None):
+  """Merges |typemaps| and |dependencies| into the JSON typemap |output|.
+
+  Args:
+    typemaps: a list of (digest, parse_function) pairs, one per typemap, where
+        |digest| identifies the typemap's content and |parse_function| returns
+        its parsed form as ParseTypemap() does.
+    dependencies: a list of paths to other JSON typemaps to merge.
+    output: the path of the JSON typemap to write.
+    cache_path: optional path of the TypemapCache to use.
+  """
+  missing = [path for path in dependencies if not os.path.exists(path)]
+  if missing:
+    raise IOError('Missing dependencies: %s' % ', '.join(missing))
+
+  cache = TypemapCache(cache_path)
+  digests = [digest for digest, _ in typemaps]
+  for path in dependencies:
+    with open(path, 'rb') as f:
+      digests.append(Digest(f.read()))
+  merge_key = Digest('\n'.join(digests))
+  if cache.merge_key == merge_key and os.path.exists(output):
+    cache.Keep(digest for digest, _ in typemaps)
+    cache.Write(merge_key)
+    return
+
+  result = {}
+  for digest, parse_function in typemaps:
+    result.update(cache.Parse(digest, parse_function))
+  for path in dependencies:
+    result.update(ReadTypemap(path))
+
+  WriteFile(json.dumps({'c++': result}, indent=2).encode(), output)
+  cache.Write(merge_key)
+
+
 def main():
   parser = argparse.ArgumentParser(
       description=__doc__,
@@ -141,15 +248,14 @@ def main():
                       type=str,
                       required=True,
                       help='The path to which to write the generated JSON.')
+  parser.add_argument('--cache',
+                      type=str,
+                      help='A path to a cache of parsed typemaps used to '
+                      'speed up subsequent runs.')
   params, typemap_params = parser.parse_known_args()
-  typemaps = ParseTypemapArgs(typemap_params)
-  missing = [path for path in params.dependency if not os.path.exists(path)]
-  if missing:
-    raise IOError('Missing dependencies: %s' % ', '.join(missing))
-  for path in params.dependency:
-    typemaps.update(ReadTypemap(path))
-
-  WriteFile(json.dumps({'c++': typemaps}, indent=2).encode(), params.output)
+  typemaps = [(Digest(typemap), functools.partial(ParseTypemap, typemap))
+              for typemap in SplitTypemapArgs(typemap_params)]
+  GenerateTypeMappings(typemaps, params.dependency, params.output, params.cache)
 
 
 if __name__ == '__main__':
@@ -495,7 +495,8 @@ class Generator(generator.Generator):
     return exports
 
   def _DoGenerateFiles(self):
-    fileutil.EnsureDirectoryExists(self.output_dir)
+    if self.output_sink is None:
+      fileutil.EnsureDirectoryExists(self.output_dir)
 
     for struct in self.module.structs:
       self.Write(self._GenerateStructSource(struct),
@@ -531,19 +532,27 @@ class Generator(generator.Generator):
     args = parser.parse_args(unparsed_args)
     package_path = GetPackage(self.module).replace('.', '/')
 
-    # Generate the java files in a temporary directory and place a single
-    # srcjar in the output directory.
-    basename = "%s.srcjar" % self.module.path
-    zip_filename = os.path.join(self.output_dir, basename)
-    with TempDir() as temp_java_root:
-      self.output_dir = os.path.join(temp_java_root, package_path)
-      self._DoGenerateFiles();
-      build_utils.ZipDir(zip_filename, temp_java_root)
+    sink = self.output_sink
+    if sink is not None:
+      # The sink takes the place of the srcjar, so keep its package layout.
+      self.output_sink = generator.SubdirectorySink(sink, package_path)
+      self._DoGenerateFiles()
+      self.output_sink = None
+    else:
+      # Generate the java files in a temporary directory and place a single
+      # srcjar in the output directory.
+      basename = "%s.srcjar" % self.module.path
+      zip_filename = os.path.join(self.output_dir, basename)
+      with TempDir() as temp_java_root:
+        self.output_dir = os.path.join(temp_java_root, package_path)
+        self._DoGenerateFiles();
+        build_utils.ZipDir(zip_filename, temp_java_root)
 
     if args.java_output_directory:
       # If requested, generate the java files directly into indicated directory.
       self.output_dir = os.path.join(args.java_output_directory, package_path)
       self._DoGenerateFiles();
+    self.output_sink = sink
 
   def GetJinjaParameters(self):
     return {
@@ -43,6 +43,7 @@ import mojom.fileutil as fileutil
 from mojom.generate import template_expander
 from mojom.generate import translate
 from mojom.generate.generator import AddComputedData, WriteFile
+from mojom.generate.generator import StagingSink, ZipSink
 from mojom.parse.conditional_features import RemoveDisabledDefinitions
 from mojom.parse.parser import Parse
 
@@ -145,8 +146,9 @@ class MojomProcessor(object):
     _processed_files: {Dict[str, mojom.generate.module.Module]} Mapping from
         relative mojom filename paths to the module AST for that mojom file.
   """
-  def __init__(self, should_generate):
+  def __init__(self, should_generate, output_sink=None):
     self._should_generate = should_generate
+    self._output_sink = output_sink
     self._processed_files = {}
     self._typemap = {}
 
@@ -217,7 +219,8 @@ class MojomProcessor(object):
             disallow_native_types=args.disallow_native_types,
             disallow_interfaces=args.disallow_interfaces,
             generate_message_ids=args.generate_message_ids,
-            generate_fuzzing=args.generate_fuzzing)
+            generate_fuzzing=args.generate_fuzzing,
+            output_sink=self._output_sink)
         filtered_args = []
         if hasattr(generator_module, 'GENERATOR_PREFIX'):
           prefix = '--' + generator_module.GENERATOR_PREFIX + '_'
@@ -244,7 +247,14 @@ def _Generate(args, remaining_args):
 
   fileutil.EnsureDirectoryExists(args.output_dir)
 
-  processor = MojomProcessor(lambda filename: filename in args.filename)
+  output_sink = None
+  if args.output_zip:
+    output_sink = ZipSink(args.output_zip)
+  elif args.output_staging_dir:
+    output_sink = StagingSink(args.output_staging_dir)
+
+  processor = MojomProcessor(lambda filename: filename in args.filename,
+                             output_sink)
   processor.LoadTypemaps(set(args.typemaps))
 
   if args.filelist:
@@ -255,6 +265,9 @@ def _Generate(args, remaining_args):
     processor._GenerateModule(args, remaining_args, generator_modules,
                               RelativePath(filename, args.depth), [])
 
+  if output_sink:
+    output_sink.Close()
+
   return 0
 
 
@@ -409,6 +422,17 @@ def main():
   generate_parser.add_argument("-o", "--output_dir", dest="output_dir",
                                default=".",
                                help="output directory for generated files")
+  output_sink_group = generate_parser.add_mutually_exclusive_group()
+  output_sink_group.add_argument(
+      "--output_zip", dest="output_zip",
+      help="write all generated files into this zip archive instead of the "
+      "output directory; paths in the archive are relative to the output "
+      "directory")
+  output_sink_group.add_argument(
+      "--output_staging_dir", dest="output_staging_dir",
+      help="write all generated files into this content-addressed staging "
+      "directory (objects/ and manifest.json) instead of the output "
+      "directory")
   generate_parser.add_argument("-g", "--generators",
                                dest="generators_string",
                                metavar="GENERATORS",
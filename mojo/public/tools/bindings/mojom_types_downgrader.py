@@ -6,6 +6,8 @@
 
 import argparse
 import fnmatch
+import mmap
+import multiprocessing
 import os
 import re
 import shutil
@@ -28,6 +30,11 @@ _REGEXP_PATTERN = re.compile(
         ['{}\s*<\s*(.*?)\s*>'.format(k) for k in _MOJO_REPLACEMENTS.keys()]),
     flags=re.DOTALL)
 
+# Cheap pre-check run over the raw bytes of a file to find out whether it uses
+# any of the new types at all, before decoding and substituting its contents.
+_QUICK_CHECK_PATTERN = re.compile(
+    br'pending_(?:associated_)?(?:remote|receiver)\s*<')
+
 
 def ReplaceFunction(match_object):
   """Returns the right replacement for the string matched against the regexp."""
@@ -36,25 +43,75 @@ def ReplaceFunction(match_object):
       return repl.format(match_object.group(index))
 
 
+def HasNewTypes(path):
+  """Returns whether the file at |path| may contain any of the new mojo types.
+
+  The file is scanned through mmap so that the common case of a file without
+  any new types is decided without reading it into memory.
+  """
+  with open(path, 'rb') as f:
+    if os.fstat(f.fileno()).st_size == 0:
+      return False
+    mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+      return _QUICK_CHECK_PATTERN.search(mapped) is not None
+    finally:
+      mapped.close()
+
+
+def _ReadFile(path):
+  with open(path) as f:
+    return f.read()
+
+
 def DowngradeFile(path, output_dir=None):
   """Downgrades the mojom file specified by |path| to the old mojo types.
 
   Optionally pass |output_dir| to place the result under a separate output
   directory, preserving the relative path to the file included in |path|.
-  """
-  # Use a temporary file to dump the new contents after replacing the patterns.
-  with open(path) as src_mojo_file:
-    with tempfile.NamedTemporaryFile(mode='w', delete=False) as tmp_mojo_file:
-      tmp_contents = _REGEXP_PATTERN.sub(ReplaceFunction, src_mojo_file.read())
-      tmp_mojo_file.write(tmp_contents)
 
+  Returns True if the output file was (re)written. Files whose output already
+  has the downgraded contents are left untouched.
+  """
   # Files should be placed in the desired output directory
   if output_dir:
     output_filepath = os.path.join(output_dir, os.path.basename(path))
-    if not os.path.exists(output_dir):
-      os.makedirs(output_dir)
   else:
     output_filepath = path
+  # DowngradeDirectory() passes an absolute |output_dir| even for relative
+  # paths, so compare absolute paths to detect in-place downgrades.
+  in_place = os.path.abspath(output_filepath) == os.path.abspath(path)
+
+  if in_place and not HasNewTypes(path):
+    return False
+
+  src_contents = _ReadFile(path)
+  tmp_contents = _REGEXP_PATTERN.sub(ReplaceFunction, src_contents)
+  if in_place:
+    if tmp_contents == src_contents:
+      return False
+  elif (os.path.exists(output_filepath) and
+        _ReadFile(output_filepath) == tmp_contents):
+    # The output is up to date; only make sure that it is not older than its
+    # source so that ninja does not consider it dirty.
+    if os.path.getmtime(output_filepath) < os.path.getmtime(path):
+      os.utime(output_filepath, None)
+    return False
+
+  if output_dir and not os.path.exists(output_dir):
+    try:
+      os.makedirs(output_dir)
+    except OSError:
+      # Another worker may have created it concurrently.
+      if not os.path.isdir(output_dir):
+        raise
+
+  # Use a temporary file next to the output to dump the new contents, so that
+  # the final move is an atomic rename and readers never see partial files.
+  with tempfile.NamedTemporaryFile(
+      mode='w', dir=os.path.dirname(os.path.abspath(output_filepath)),
+      delete=False) as tmp_mojo_file:
+    tmp_mojo_file.write(tmp_contents)
 
   # Write the new contents preserving the original file's attributes.
   shutil.copystat(path, tmp_mojo_file.name)
@@ -65,13 +122,21 @@ def DowngradeFile(path, output_dir=None):
   # as per the call to shutil.copystat(), causing unnecessary generations of the
   # output file in subsequent builds due to ninja considering it dirty.
   os.utime(output_filepath, None)
+  return True
+
 
+def _DowngradeFileStar(args):
+  return DowngradeFile(*args)
 
-def DowngradeDirectory(path, output_dir=None):
+
+def DowngradeDirectory(path, output_dir=None, jobs=1):
   """Downgrades mojom files inside directory |path| to the old mojo types.
 
   Optionally pass |output_dir| to place the result under a separate output
   directory, preserving the relative path to the file included in |path|.
+
+  Files are processed by |jobs| worker processes. Returns the number of files
+  that were written.
   """
   # We don't have recursive glob.glob() nor pathlib.Path.rglob() in Python 2.7
   mojom_filepaths = []
@@ -79,23 +144,35 @@ def DowngradeDirectory(path, output_dir=None):
     for filename in fnmatch.filter(filenames, "*mojom"):
       mojom_filepaths.append(os.path.join(dir_path, filename))
 
+  tasks = []
   for path in mojom_filepaths:
     absolute_dirpath = os.path.dirname(os.path.abspath(path))
     if output_dir:
       dest_dirpath = output_dir + absolute_dirpath
     else:
       dest_dirpath = absolute_dirpath
-    DowngradeFile(path, dest_dirpath)
+    tasks.append((path, dest_dirpath))
+
+  if jobs > 1 and len(tasks) > 1:
+    pool = multiprocessing.Pool(jobs)
+    try:
+      written = pool.map(_DowngradeFileStar, tasks, chunksize=16)
+    finally:
+      pool.close()
+      pool.join()
+  else:
+    written = [_DowngradeFileStar(task) for task in tasks]
+  return sum(written)
 
 
-def DowngradePath(src_path, output_dir=None):
+def DowngradePath(src_path, output_dir=None, jobs=1):
   """Downgrades the mojom files pointed by |src_path| to the old mojo types.
 
   Optionally pass |output_dir| to place the result under a separate output
   directory, preserving the relative path to the file included in |path|.
   """
   if os.path.isdir(src_path):
-    DowngradeDirectory(src_path, output_dir)
+    DowngradeDirectory(src_path, output_dir, jobs)
   elif os.path.isfile(src_path):
     DowngradeFile(src_path, output_dir)
   else:
@@ -110,9 +187,17 @@ def main():
       "srcpath", help="path to the file or directory to apply the conversion")
   parser.add_argument(
       "--outdir", help="the directory to place the converted file(s) under")
+  parser.add_argument(
+      "-j",
+      "--jobs",
+      type=int,
+      default=1,
+      help="number of worker processes used to convert a directory "
+      "(0 means one per CPU)")
   args = parser.parse_args()
 
-  DowngradePath(args.srcpath, args.outdir)
+  DowngradePath(args.srcpath, args.outdir,
+                args.jobs or multiprocessing.cpu_count())
 
 
 if __name__ == "__main__":
@@ -0,0 +1,55 @@
+# Copyright 2020 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import mojom_types_downgrader
+
+
+class MojomTypesDowngraderTest(unittest.TestCase):
+  """Tests mojom_types_downgrader."""
+
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp()
+    self.old_cwd = os.getcwd()
+    os.chdir(self.temp_dir)
+    os.makedirs(os.path.join('mojoms', 'sub'))
+
+  def tearDown(self):
+    os.chdir(self.old_cwd)
+    shutil.rmtree(self.temp_dir)
+
+  def testDowngradeRelativeDirectoryInPlace(self):
+    """Tests DowngradeDirectory() on a relative directory, in place."""
+    new_path = os.path.join('mojoms', 'sub', 'new.mojom')
+    with open(new_path, 'w') as f:
+      f.write('interface Foo { Bar(pending_remote<Baz> baz); };\n')
+    old_path = os.path.join('mojoms', 'old.mojom')
+    with open(old_path, 'w') as f:
+      f.write('interface Foo { Bar(Baz baz); };\n')
+
+    checked = []
+    has_new_types = mojom_types_downgrader.HasNewTypes
+    def RecordHasNewTypes(path):
+      checked.append(path)
+      return has_new_types(path)
+    mojom_types_downgrader.HasNewTypes = RecordHasNewTypes
+    try:
+      written = mojom_types_downgrader.DowngradeDirectory('mojoms')
+    finally:
+      mojom_types_downgrader.HasNewTypes = has_new_types
+
+    self.assertEquals(1, written)
+    self.assertEquals(sorted([new_path, old_path]), sorted(checked))
+    with open(new_path) as f:
+      self.assertEquals('interface Foo { Bar(Baz baz); };\n', f.read())
+    self.assertEquals([], [f for f in os.listdir(os.path.join('mojoms', 'sub'))
+                           if f != 'new.mojom'])
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -5,8 +5,12 @@
 """Code shared by the various language-specific code generators."""
 
 from functools import partial
+import hashlib
+import io
+import json
 import os.path
 import re
+import zipfile
 
 import mojom.generate.module as mojom
 import mojom.fileutil as fileutil
@@ -69,22 +73,129 @@ class Stylizer(object):
     return mojom_namespace
 
 
+def IsFileUnchanged(contents, full_path):
+  """Returns True if the file at |full_path| already holds |contents|."""
+  if not os.path.isfile(full_path):
+    return False
+  if os.path.getsize(full_path) != len(contents):
+    return False
+  with open(full_path, 'rb') as destination_file:
+    return destination_file.read() == contents
+
+
 def WriteFile(contents, full_path):
   # If |contents| is same with the file content, we skip updating.
-  if os.path.isfile(full_path):
-    with open(full_path, 'rb') as destination_file:
-      if destination_file.read() == contents:
-        return
+  if IsFileUnchanged(contents, full_path):
+    return
 
   # Make sure the containing directory exists.
   full_dir = os.path.dirname(full_path)
-  fileutil.EnsureDirectoryExists(full_dir)
+  if full_dir:
+    fileutil.EnsureDirectoryExists(full_dir)
 
   # Dump the data to disk.
   with open(full_path, "wb") as f:
     f.write(contents)
 
 
+class OutputSink(object):
+  """Destination of the files emitted by generators.
+
+  Paths passed to Write() are relative to the root of the sink. Close() must
+  be called once all generators are done writing.
+  """
+
+  def Write(self, contents, path):
+    raise NotImplementedError("Subclasses must override/implement this method")
+
+  def Close(self):
+    pass
+
+
+class FileSystemSink(OutputSink):
+  """Writes each file under |output_dir|, skipping unchanged files."""
+
+  def __init__(self, output_dir):
+    self.output_dir = output_dir
+
+  def Write(self, contents, path):
+    WriteFile(contents, os.path.join(self.output_dir, path))
+
+
+class MemorySink(OutputSink):
+  """Keeps all files in the |files| dictionary, mapping paths to contents."""
+
+  def __init__(self):
+    self.files = {}
+
+  def Write(self, contents, path):
+    self.files[path] = contents
+
+
+class SubdirectorySink(OutputSink):
+  """Forwards all files to |sink|, placing them under |subdir|."""
+
+  def __init__(self, sink, subdir):
+    self._sink = sink
+    self._subdir = subdir
+
+  def Write(self, contents, path):
+    self._sink.Write(contents, os.path.join(self._subdir, path))
+
+  def Close(self):
+    self._sink.Close()
+
+
+class ZipSink(MemorySink):
+  """Collects all files into a single zip archive written on Close().
+
+  The archive is deterministic (sorted entries, fixed timestamps) and is not
+  rewritten if it already has the same contents.
+  """
+
+  _TIMESTAMP = (2001, 1, 1, 0, 0, 0)
+
+  def __init__(self, zip_path):
+    super(ZipSink, self).__init__()
+    self.zip_path = zip_path
+
+  def Close(self):
+    # Build the archive in memory first so that it can be compared with the
+    # existing one.
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as archive:
+      for path in sorted(self.files):
+        info = zipfile.ZipInfo(path.replace(os.sep, '/'), self._TIMESTAMP)
+        info.compress_type = zipfile.ZIP_DEFLATED
+        info.external_attr = 0o644 << 16
+        archive.writestr(info, self.files[path])
+    WriteFile(buf.getvalue(), self.zip_path)
+
+
+class StagingSink(OutputSink):
+  """Content-addressed staging area suited to remote caches.
+
+  Each distinct file content is stored once as |root|/objects/<sha1>, and
+  |root|/manifest.json maps every output path to its content digest. Objects
+  that already exist are never rewritten.
+  """
+
+  def __init__(self, root):
+    self.root = root
+    self._manifest = {}
+
+  def Write(self, contents, path):
+    digest = hashlib.sha1(contents).hexdigest()
+    self._manifest[path.replace(os.sep, '/')] = digest
+    object_path = os.path.join(self.root, 'objects', digest[:2], digest[2:])
+    if not os.path.exists(object_path):
+      WriteFile(contents, object_path)
+
+  def Close(self):
+    manifest = json.dumps(self._manifest, indent=2, sort_keys=True)
+    WriteFile(manifest.encode(), os.path.join(self.root, 'manifest.json'))
+
+
 def AddComputedData(module):
   """Adds computed data to the given module. The data is computed once and
   used repeatedly in the generation process."""
@@ -158,16 +269,18 @@ def AddComputedData(module):
 
 class Generator(object):
   # Pass |output_dir| to emit files to disk. Omit |output_dir| to echo all
-  # files to stdout.
+  # files to stdout. Pass |output_sink| to send the files to an OutputSink
+  # instead; paths are then relative to the root of the sink.
   def __init__(self, module, output_dir=None, typemap=None, variant=None,
                bytecode_path=None, for_blink=False, use_once_callback=False,
                js_bindings_mode="new", export_attribute=None,
                export_header=None, generate_non_variant_code=False,
                support_lazy_serialization=False, disallow_native_types=False,
                disallow_interfaces=False, generate_message_ids=False,
-               generate_fuzzing=False):
+               generate_fuzzing=False, output_sink=None):
     self.module = module
     self.output_dir = output_dir
+    self.output_sink = output_sink
     self.typemap = typemap or {}
     self.variant = variant
     self.bytecode_path = bytecode_path
@@ -184,6 +297,9 @@ class Generator(object):
     self.generate_fuzzing = generate_fuzzing
 
   def Write(self, contents, filename):
+    if self.output_sink is not None:
+      self.output_sink.Write(contents.encode(), filename)
+      return
     if self.output_dir is None:
       print(contents)
       return
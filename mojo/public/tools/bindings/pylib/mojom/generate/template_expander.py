@@ -4,8 +4,13 @@
 
 # Based on third_party/WebKit/Source/build/scripts/template_expander.py.
 
+import hashlib
+import io
+import json
+import marshal
 import os.path
 import sys
+import zipfile
 
 _current_dir = os.path.dirname(os.path.realpath(__file__))
 # jinja2 is in chromium's third_party directory
@@ -14,18 +19,87 @@ sys.path.insert(
     1, os.path.join(_current_dir, *([os.pardir] * 7 + ['third_party'])))
 import jinja2
 
+from mojom.generate.generator import WriteFile
+
+# Name of the manifest stored in each precompiled template bundle. It records
+# what went into the bundle so that it can be updated incrementally and
+# checked against the generator that loads it.
+_MANIFEST_NAME = "manifest.json"
+_MANIFEST_VERSION = 1
+
+# Templates are stored as .pyc files on Python 2 only; as in
+# jinja2.Environment.compile_templates(), Python 3 does not pick them up.
+_PY_COMPILE = sys.version_info[0] == 2
+
+# Verified bundles, keyed by (path, size, mtime, filters digest). A bundle that
+# is rewritten while the process runs is verified (and loaded) again.
+_verified_bundles = {}
+
+
+def _GetPythonMagic():
+  if not _PY_COMPILE:
+    return "source"
+  import imp
+  return imp.get_magic().encode("hex")
+
+
+def _GetFiltersDigest(filters):
+  return hashlib.sha1(",".join(sorted(filters)).encode()).hexdigest()
+
+
+def _GetBundleHeader(filters):
+  """Returns the manifest fields a bundle must match to be loadable."""
+  return {
+      "version": _MANIFEST_VERSION,
+      "jinja2": jinja2.__version__,
+      "python_magic": _GetPythonMagic(),
+      "filters": _GetFiltersDigest(filters),
+  }
+
+
+def _ReadManifest(zip_file):
+  try:
+    return json.loads(zip_file.read(_MANIFEST_NAME).decode("utf-8"))
+  except (KeyError, ValueError):
+    return None
+
+
+def _VerifyBundle(bundle_path, filters, template_name):
+  stat = os.stat(bundle_path)
+  key = (bundle_path, stat.st_size, stat.st_mtime, _GetFiltersDigest(filters))
+  manifest = _verified_bundles.get(key)
+  if manifest is None:
+    with zipfile.ZipFile(bundle_path) as zip_file:
+      manifest = _ReadManifest(zip_file)
+    if manifest is None:
+      raise Exception("%s: Error: Missing template manifest; run the "
+                      "precompile command again" % bundle_path)
+    expected = _GetBundleHeader(filters)
+    for field, value in expected.items():
+      if manifest.get(field) != value:
+        raise Exception("%s: Error: Stale template bundle (%s is %r, expected "
+                        "%r); run the precompile command again" %
+                        (bundle_path, field, manifest.get(field), value))
+    _verified_bundles[key] = manifest
+  if template_name not in manifest["templates"]:
+    raise Exception("%s: Error: Template %s is not in the bundle; run the "
+                    "precompile command again" % (bundle_path, template_name))
+
 
 def ApplyTemplate(mojo_generator, path_to_template, params, **kwargs):
-  loader = jinja2.ModuleLoader(os.path.join(
+  bundle_path = os.path.join(
       mojo_generator.bytecode_path, "%s.zip" % mojo_generator.GetTemplatePrefix(
-      )))
+      ))
+  filters = mojo_generator.GetFilters()
+  _VerifyBundle(bundle_path, filters, path_to_template)
+  loader = jinja2.ModuleLoader(bundle_path)
   final_kwargs = dict(mojo_generator.GetJinjaParameters())
   final_kwargs.update(kwargs)
   jinja_env = jinja2.Environment(loader=loader,
                                  keep_trailing_newline=True,
                                  **final_kwargs)
   jinja_env.globals.update(mojo_generator.GetGlobals())
-  jinja_env.filters.update(mojo_generator.GetFilters())
+  jinja_env.filters.update(filters)
   template = jinja_env.get_template(path_to_template)
   return template.render(params)
 
@@ -40,15 +114,79 @@ def UseJinja(path_to_template, **kwargs):
   return RealDecorator
 
 
+def _CompileTemplate(jinja_env, name):
+  """Returns the bundle entry name and contents for template |name|.
+
+  This mirrors what jinja2.Environment.compile_templates() stores.
+  """
+  source, filename, _ = jinja_env.loader.get_source(jinja_env, name)
+  code = jinja_env.compile(source, name, filename, True, True)
+  module_filename = jinja2.ModuleLoader.get_module_filename(name)
+  if not _PY_COMPILE:
+    return module_filename, code.encode("utf-8")
+  import imp
+  compiled = jinja_env._compile(code, module_filename)
+  return (module_filename + "c",
+          imp.get_magic() + b"\xff\xff\xff\xff" + marshal.dumps(compiled))
+
+
+def _PrecompileBundle(jinja_env, filters, bundle_path):
+  """Writes the templates of |jinja_env| to the zip at |bundle_path|.
+
+  Templates whose source is unchanged since the previous bundle was written
+  with the same interpreter, jinja2 version and filters are copied over
+  instead of being compiled again.
+  """
+  header = _GetBundleHeader(filters)
+  previous = None
+  previous_zip = None
+  if os.path.isfile(bundle_path):
+    try:
+      previous_zip = zipfile.ZipFile(bundle_path)
+      previous = _ReadManifest(previous_zip)
+    except zipfile.BadZipfile:
+      previous_zip = None
+  if previous is not None and any(
+      previous.get(field) != value for field, value in header.items()):
+    previous = None
+
+  manifest = dict(header)
+  manifest["templates"] = {}
+  entries = []
+  try:
+    for name in jinja_env.list_templates(extensions=["tmpl"]):
+      source, _, _ = jinja_env.loader.get_source(jinja_env, name)
+      digest = hashlib.sha1(source.encode("utf-8")).hexdigest()
+      cached = previous and previous["templates"].get(name)
+      if cached and cached["sha1"] == digest:
+        entry_name = cached["file"]
+        data = previous_zip.read(entry_name)
+      else:
+        entry_name, data = _CompileTemplate(jinja_env, name)
+      manifest["templates"][name] = {"sha1": digest, "file": entry_name}
+      entries.append((entry_name, data))
+  finally:
+    if previous_zip:
+      previous_zip.close()
+
+  buf = io.BytesIO()
+  with zipfile.ZipFile(buf, "w", zipfile.ZIP_STORED) as zip_file:
+    for entry_name, data in sorted(entries):
+      info = zipfile.ZipInfo(entry_name)
+      info.external_attr = 0o755 << 16
+      zip_file.writestr(info, data)
+    zip_file.writestr(zipfile.ZipInfo(_MANIFEST_NAME),
+                      json.dumps(manifest, indent=2, sort_keys=True))
+  WriteFile(buf.getvalue(), bundle_path)
+
+
 def PrecompileTemplates(generator_modules, output_dir):
   for module in generator_modules.values():
     generator = module.Generator(None)
     jinja_env = jinja2.Environment(loader=jinja2.FileSystemLoader([os.path.join(
         os.path.dirname(module.__file__), generator.GetTemplatePrefix())]))
-    jinja_env.filters.update(generator.GetFilters())
-    jinja_env.compile_templates(
-        os.path.join(output_dir, "%s.zip" % generator.GetTemplatePrefix()),
-        extensions=["tmpl"],
-        zip="stored",
-        py_compile=True,
-        ignore_errors=False)
+    filters = generator.GetFilters()
+    jinja_env.filters.update(filters)
+    _PrecompileBundle(
+        jinja_env, filters,
+        os.path.join(output_dir, "%s.zip" % generator.GetTemplatePrefix()))
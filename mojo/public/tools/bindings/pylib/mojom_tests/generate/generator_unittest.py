@@ -4,8 +4,11 @@
 
 import imp
 import os.path
+import shutil
 import sys
+import tempfile
 import unittest
+import zipfile
 
 def _GetDirAbove(dirname):
   """Returns the directory "above" this file containing |dirname| (which must
@@ -36,6 +39,62 @@ class StringManipulationTest(unittest.TestCase):
                                                      dilimiter=' '))
     self.assertEquals("CaMelCaSe", generator.ToCamel("caMel_caSe"))
 
+
+class OutputSinkTest(unittest.TestCase):
+  """Tests the OutputSink implementations."""
+
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.temp_dir)
+
+  def testMemorySink(self):
+    sink = generator.MemorySink()
+    sink.Write(b"foo", "a/foo.h")
+    sink.Close()
+    self.assertEquals({"a/foo.h": b"foo"}, sink.files)
+
+  def testFileSystemSinkSkipsUnchangedFiles(self):
+    sink = generator.FileSystemSink(self.temp_dir)
+    path = os.path.join(self.temp_dir, "a", "foo.h")
+    sink.Write(b"foo", "a/foo.h")
+    os.utime(path, (0, 0))
+    sink.Write(b"foo", "a/foo.h")
+    self.assertEquals(0, os.path.getmtime(path))
+    sink.Write(b"bar", "a/foo.h")
+    self.assertNotEquals(0, os.path.getmtime(path))
+
+  def testZipSink(self):
+    zip_path = os.path.join(self.temp_dir, "out.zip")
+    sink = generator.ZipSink(zip_path)
+    sink.Write(b"bar", "b/bar.h")
+    sink.Write(b"foo", "a/foo.h")
+    sink.Close()
+    with zipfile.ZipFile(zip_path) as archive:
+      self.assertEquals(["a/foo.h", "b/bar.h"], archive.namelist())
+      self.assertEquals(b"foo", archive.read("a/foo.h"))
+    os.utime(zip_path, (0, 0))
+    sink = generator.ZipSink(zip_path)
+    sink.Write(b"foo", "a/foo.h")
+    sink.Write(b"bar", "b/bar.h")
+    sink.Close()
+    self.assertEquals(0, os.path.getmtime(zip_path))
+
+  def testStagingSink(self):
+    sink = generator.StagingSink(self.temp_dir)
+    sink.Write(b"foo", "a/foo.h")
+    sink.Write(b"foo", "b/foo.h")
+    sink.Close()
+    objects = []
+    for _, _, filenames in os.walk(os.path.join(self.temp_dir, "objects")):
+      objects.extend(filenames)
+    self.assertEquals(1, len(objects))
+    with open(os.path.join(self.temp_dir, "manifest.json")) as f:
+      manifest = f.read()
+    self.assertIn('"a/foo.h"', manifest)
+    self.assertIn('"b/foo.h"', manifest)
+
 if __name__ == "__main__":
   unittest.main()
 
@@ -0,0 +1,111 @@
+# Copyright 2020 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+import imp
+import os.path
+import shutil
+import sys
+import tempfile
+import unittest
+
+def _GetDirAbove(dirname):
+  """Returns the directory "above" this file containing |dirname| (which must
+  also be "above" this file)."""
+  path = os.path.abspath(__file__)
+  while True:
+    path, tail = os.path.split(path)
+    assert tail
+    if tail == dirname:
+      return path
+
+try:
+  imp.find_module("mojom")
+except ImportError:
+  sys.path.append(os.path.join(_GetDirAbove("pylib"), "pylib"))
+from mojom.generate import template_expander
+import jinja2
+
+
+class FakeGenerator(object):
+  def __init__(self, bytecode_path, filters):
+    self.bytecode_path = bytecode_path
+    self._filters = filters
+
+  def GetTemplatePrefix(self):
+    return "test_templates"
+
+  def GetJinjaParameters(self):
+    return {}
+
+  def GetGlobals(self):
+    return {}
+
+  def GetFilters(self):
+    return self._filters
+
+
+class TemplateBundleTest(unittest.TestCase):
+  """Tests precompiled template bundles and their manifest."""
+
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp()
+    self.template_dir = os.path.join(self.temp_dir, "templates")
+    os.mkdir(self.template_dir)
+    self.bundle_path = os.path.join(self.temp_dir, "test_templates.zip")
+    self.filters = {"upper": lambda s: s.upper()}
+
+  def tearDown(self):
+    shutil.rmtree(self.temp_dir)
+
+  def _WriteTemplate(self, name, contents):
+    with open(os.path.join(self.template_dir, name), "w") as f:
+      f.write(contents)
+
+  def _Precompile(self):
+    jinja_env = jinja2.Environment(
+        loader=jinja2.FileSystemLoader([self.template_dir]))
+    jinja_env.filters.update(self.filters)
+    template_expander._PrecompileBundle(jinja_env, self.filters,
+                                        self.bundle_path)
+
+  def _Apply(self, name, params, filters=None):
+    generator = FakeGenerator(self.temp_dir, filters or self.filters)
+    return template_expander.ApplyTemplate(generator, name, params)
+
+  def testApplyTemplate(self):
+    self._WriteTemplate("a.tmpl", "{{ x|upper }}")
+    self._Precompile()
+    self.assertEquals("FOO", self._Apply("a.tmpl", {"x": "foo"}))
+
+  def testUnchangedBundleIsNotRewritten(self):
+    self._WriteTemplate("a.tmpl", "{{ x|upper }}")
+    self._Precompile()
+    os.utime(self.bundle_path, (0, 0))
+    self._Precompile()
+    self.assertEquals(0, os.path.getmtime(self.bundle_path))
+
+  def testChangedTemplateIsRecompiled(self):
+    self._WriteTemplate("a.tmpl", "{{ x|upper }}")
+    self._WriteTemplate("b.tmpl", "b")
+    self._Precompile()
+    self._WriteTemplate("a.tmpl", "{{ x }}")
+    self._Precompile()
+    self.assertEquals("foo", self._Apply("a.tmpl", {"x": "foo"}))
+    self.assertEquals("b", self._Apply("b.tmpl", {}))
+
+  def testMismatchedFiltersAreRejected(self):
+    self._WriteTemplate("a.tmpl", "{{ x|upper }}")
+    self._Precompile()
+    with self.assertRaises(Exception):
+      self._Apply("a.tmpl", {"x": "foo"}, {"lower": lambda s: s.lower()})
+
+  def testMissingTemplateIsRejected(self):
+    self._WriteTemplate("a.tmpl", "a")
+    self._Precompile()
+    with self.assertRaises(Exception):
+      self._Apply("b.tmpl", {})
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -8,9 +8,16 @@ For example,
 generate_mojom.py content/common/file_utilities_messages.h
     --output_mojom=content/common/file_utilities.mojom
     --output_typemap=content/common/file_utilities.typemap
+
+Many headers can be converted in one run, in which case the output paths are
+derived from the input paths (foo_messages.h => foo.mojom and foo.typemap):
+generate_mojom.py --index_file=/tmp/ipc_index.json \
+    content/common/*_messages.h
 """
 
 import argparse
+import hashlib
+import json
 import logging
 import os
 import re
@@ -43,18 +50,131 @@ def _git_multigrep(patterns, paths):
     paths = [paths]
   if isinstance(patterns, str):
     patterns = [patterns]
-  for pattern in patterns:
-    # Search only the files that matched previous patterns.
-    paths = _git_grep(pattern, paths)
-    if not paths:
-      return []
-  return paths
+  if len(patterns) == 1:
+    return _git_grep(patterns[0], paths)
+  # A single git grep with --all-match lists the files that contain a match
+  # for every pattern, which saves one full search per extra pattern.
+  try:
+    args = ['git', 'grep', '-l', '--all-match']
+    for pattern in patterns:
+      args.extend(['-e', pattern])
+    args.append('--')
+    args.extend(paths)
+    result = subprocess.check_output(args).strip().splitlines()
+    logging.debug('%s => %s', ' '.join(args), result)
+    return result
+  except subprocess.CalledProcessError:
+    logging.debug('%s => []', ' '.join(args))
+    return []
+
+
+def _git_head():
+  try:
+    return subprocess.check_output(['git', 'rev-parse', 'HEAD']).strip()
+  except subprocess.CalledProcessError:
+    return None
+
+
+def _load_typemap(content):
+  """Returns the custom mappings declared by the given typemap content."""
+  typemap = {}
+  exec content.replace('=\n', '=') in typemap
+  mappings = {}
+  for mapping in typemap['type_mappings']:
+    mojom, native = mapping.split('=')
+    mappings[native] = {'name': mojom, 'mojom': typemap['mojom'].strip('/')}
+  return mappings
+
+
+class TypemapIndex(object):
+  """Typemaps and header lookups shared by all inputs of a run.
+
+  Every typemap in the checkout is parsed at most once per run and the results
+  of git grep queries are memoized. If |index_file| is given, the index is
+  also read from and written back to that file so that later runs only
+  re-parse the typemaps whose content changed. Cached header lookups are only
+  reused while the checkout HEAD is unchanged.
+  """
+
+  _VERSION = 1
+
+  def __init__(self, index_file=None):
+    self._index_file = index_file
+    self._head = _git_head()
+    # Typemap path => {'sha1': content digest, 'mappings': custom mappings}.
+    self._typemaps = {}
+    # (patterns, paths) => list of matching files.
+    self._greps = {}
+    self._custom_mappings = None
+    if index_file:
+      self._read()
+
+  def _read(self):
+    try:
+      with open(self._index_file) as f:
+        data = json.load(f)
+    except (IOError, ValueError):
+      return
+    if data.get('version') != self._VERSION:
+      return
+    self._typemaps = data['typemaps']
+    if self._head and data.get('head') == self._head:
+      for patterns, paths, result in data['greps']:
+        self._greps[(tuple(patterns), tuple(paths))] = result
+
+  def write(self):
+    if not self._index_file:
+      return
+    data = {
+        'version': self._VERSION,
+        'head': self._head,
+        'typemaps': self._typemaps,
+        'greps': [[list(patterns), list(paths), result]
+                  for (patterns, paths), result in sorted(self._greps.items())],
+    }
+    with open(self._index_file, 'w') as f:
+      json.dump(data, f, sort_keys=True)
+
+  @staticmethod
+  def _find_typemaps():
+    return subprocess.check_output(
+        ['git', 'ls-files', '*.typemap']).strip().split('\n')
+
+  def custom_mappings(self):
+    """Returns the mappings of all typemaps. Callers must not modify it."""
+    if self._custom_mappings is not None:
+      return self._custom_mappings
+    typemaps = {}
+    self._custom_mappings = {}
+    for path in self._find_typemaps():
+      with open(path) as f:
+        content = f.read()
+      digest = hashlib.sha1(content).hexdigest()
+      entry = self._typemaps.get(path)
+      if not entry or entry['sha1'] != digest:
+        logging.debug('Loading typemap %s', path)
+        entry = {'sha1': digest, 'mappings': _load_typemap(content)}
+      typemaps[path] = entry
+      self._custom_mappings.update(entry['mappings'])
+    self._typemaps = typemaps
+    return self._custom_mappings
+
+  def multigrep(self, patterns, paths):
+    """Memoized version of _git_multigrep()."""
+    if isinstance(paths, str):
+      paths = [paths]
+    if isinstance(patterns, str):
+      patterns = [patterns]
+    key = (tuple(patterns), tuple(paths))
+    if key not in self._greps:
+      self._greps[key] = _git_multigrep(patterns, paths)
+    return self._greps[key]
 
 
 class Typemap(object):
 
-  def __init__(self, typemap_files):
-    self._typemap_files = typemap_files
+  def __init__(self, index):
+    self._index = index
     self._custom_mappings = {}
     self._new_custom_mappings = {}
     self._imports = set()
@@ -63,18 +183,9 @@ class Typemap(object):
     self._enums = set()
 
   def load_typemaps(self):
-    for typemap in self._typemap_files:
-      self.load_typemap(typemap)
-
-  def load_typemap(self, path):
-    typemap = {}
-    with open(path) as f:
-      content = f.read().replace('=\n', '=')
-    exec content in typemap
-    for mapping in typemap['type_mappings']:
-      mojom, native = mapping.split('=')
-      self._custom_mappings[native] = {'name': mojom,
-                                       'mojom': typemap['mojom'].strip('/')}
+    # Copy so that the types generated for this input do not leak into the
+    # shared index.
+    self._custom_mappings = dict(self._index.custom_mappings())
 
   def generate_typemap(self, output_mojom, input_filename, namespace):
     new_mappings = sorted(self._format_new_mappings(namespace))
@@ -196,9 +307,9 @@ class Typemap(object):
       if namespace:
         patterns.extend(r'namespace %s' % namespace_component
                         for namespace_component in namespace.split('.'))
-      includes = _git_multigrep(patterns, '*.h')
+      includes = self._index.multigrep(patterns, '*.h')
       if includes:
-        if _git_grep(r'enum[A-Z_ ]* %s {' % subname, includes):
+        if self._index.multigrep(r'enum[A-Z_ ]* %s {' % subname, includes):
           self._enums.add(fullname)
           is_enum = True
         logging.info('%s => public_headers = %s', fullname, includes)
@@ -209,7 +320,7 @@ class Typemap(object):
       patterns = ['IPC_ENUM_TRAITS[A-Z_]*(%s' % fullname]
     else:
       patterns = [r'\(IPC_STRUCT_TRAITS_BEGIN(\|ParamTraits<\)%s' % fullname]
-    includes = _git_multigrep(
+    includes = self._index.multigrep(
         patterns,
         ['*messages.h', '*struct_traits.h', 'ipc/ipc_message_utils.h'])
     if includes:
@@ -329,12 +440,16 @@ class Message(object):
 
 class Generator(object):
 
-  def __init__(self, input_name, output_namespace):
+  def __init__(self, input_name, output_namespace, index=None):
+    # Number unnamed arguments per input so that batch runs produce the same
+    # output as converting each input separately.
+    global _unused_arg_count
+    _unused_arg_count = 0
     self._input_name = input_name
     with open(input_name) as f:
       self._content = f.read()
     self._namespace = output_namespace
-    self._typemaps = Typemap(self._find_typemaps())
+    self._typemaps = Typemap(index or TypemapIndex())
     self._interface_definitions = []
 
   def _get_messages(self):
@@ -384,11 +499,6 @@ class Generator(object):
     return '\n'.join(self._typemaps.generate_typemap(
         output_mojom, input_filename, self._namespace)).strip()
 
-  @staticmethod
-  def _find_typemaps():
-    return subprocess.check_output(
-        ['git', 'ls-files', '*.typemap']).strip().split('\n')
-
   def _format_interface(self, name, messages):
     return 'interface %s {\n  %s\n};' % (name,
                                          '\n  '.join(m.format(self._typemaps)
@@ -397,7 +507,7 @@ class Generator(object):
 
 def parse_args():
   parser = argparse.ArgumentParser(description=__doc__)
-  parser.add_argument('input', help='input messages.h file')
+  parser.add_argument('input', nargs='+', help='input messages.h file(s)')
   parser.add_argument(
       '--output_namespace',
       default='mojom',
@@ -405,6 +515,14 @@ def parse_args():
       '(default: %(default)s)')
   parser.add_argument('--output_mojom', help='output mojom path')
   parser.add_argument('--output_typemap', help='output typemap path')
+  parser.add_argument(
+      '--output_dir',
+      help='directory the outputs are written to when converting several '
+      'inputs; the paths below it mirror the input paths (default: next to '
+      'each input)')
+  parser.add_argument(
+      '--index_file',
+      help='file used to persist the typemap and header index between runs')
   parser.add_argument(
       '--count',
       action='store_true',
@@ -416,38 +534,76 @@ def parse_args():
                       action='store_true',
                       help='enable logging')
   parser.add_argument('-vv', action='store_true', help='enable debug logging')
-  return parser.parse_args()
+  args = parser.parse_args()
+  if len(args.input) > 1 and (args.output_mojom or args.output_typemap):
+    parser.error('--output_mojom and --output_typemap can only be used with a '
+                 'single input')
+  return args
 
 
-def main():
-  args = parse_args()
-  if args.vv:
-    logging.basicConfig(level=logging.DEBUG)
-  elif args.verbose:
-    logging.basicConfig(level=logging.INFO)
-  generator = Generator(args.input, args.output_namespace)
+def _batch_output_paths(input_name):
+  """Returns the source-relative mojom and typemap paths for an input."""
+  base = os.path.normpath(input_name)
+  for suffix in ('_messages.h', '.h'):
+    if base.endswith(suffix):
+      base = base[:-len(suffix)]
+      break
+  return base + '.mojom', base + '.typemap'
+
+
+def _write_output(path, content):
+  dirname = os.path.dirname(path)
+  if dirname and not os.path.isdir(dirname):
+    os.makedirs(dirname)
+  with open(path, 'w') as f:
+    f.write(content)
+
+
+def _convert(input_name, args, index, batch):
+  generator = Generator(input_name, args.output_namespace, index)
   if args.count:
     count = generator.count()
     if count:
-      print '%d %s' % (generator.count(), args.input)
+      print '%d %s' % (count, input_name)
     return
   mojom = '\n'.join(generator.generate_mojom()).strip()
   if not mojom:
     return
-  typemap = generator.generate_typemap(args.output_mojom, args.input)
-
-  if args.output_mojom:
-    with open(args.output_mojom, 'w') as f:
-      f.write(mojom)
+  if batch:
+    output_mojom, output_typemap = _batch_output_paths(input_name)
+  else:
+    output_mojom, output_typemap = args.output_mojom, args.output_typemap
+  typemap = generator.generate_typemap(output_mojom, input_name)
+
+  if batch and args.output_dir:
+    output_mojom = os.path.join(args.output_dir, output_mojom)
+    output_typemap = os.path.join(args.output_dir, output_typemap)
+  if output_mojom:
+    _write_output(output_mojom, mojom)
   else:
     print mojom
   if typemap:
-    if args.output_typemap:
-      with open(args.output_typemap, 'w') as f:
-        f.write(typemap)
+    if output_typemap:
+      _write_output(output_typemap, typemap)
     else:
       print typemap
 
 
+def main():
+  args = parse_args()
+  if args.vv:
+    logging.basicConfig(level=logging.DEBUG)
+  elif args.verbose:
+    logging.basicConfig(level=logging.INFO)
+  index = TypemapIndex(args.index_file)
+  batch = len(args.input) > 1 or bool(args.output_dir)
+  try:
+    for input_name in args.input:
+      logging.info('Converting %s', input_name)
+      _convert(input_name, args, index, batch)
+  finally:
+    index.write()
+
+
 if __name__ == '__main__':
   sys.exit(main())